@@ -0,0 +1,94 @@
+"""
+Benchmark: one RoutePacket per route vs. batched RouteBatchPackets
+
+Builds a router with a large table and several ports, then times a full
+table advertisement (send_routes(force=True)) and the neighbor's handling
+of the resulting packets, for a few MAX_ROUTES_PER_PACKET settings.
+Packets are handed straight from one router to the other; the simulator's
+own event loop is not involved, so the numbers measure router-side costs.
+
+Run from the simulator's root directory:
+  python bench_batching.py [routes] [ports]
+"""
+
+import sys
+import time
+
+import sim.api as api
+from cs168.dv import TableEntry, FOREVER
+
+from dv_router import DVRouter
+
+
+class _BenchHost(api.HostEntity):
+    pass
+
+
+class _RecordingRouter(DVRouter):
+    """
+    A DVRouter that records what it sends instead of putting it on a wire.
+    """
+
+    def start_timer(self, interval=None):
+        pass
+
+    def send(self, packet, port=None, flood=False):
+        self.sent.append((port, packet))
+
+
+def _make_router(max_routes):
+    router = _RecordingRouter()
+    router.MAX_ROUTES_PER_PACKET = max_routes
+    router.sent = []
+    return router
+
+
+def run(route_count=10000, port_count=8, settings=(1, 16, 64, 256)):
+    hosts = [_BenchHost() for _ in range(route_count)]
+    results = []
+
+    for max_routes in settings:
+        sender = _make_router(max_routes)
+        for port in range(port_count):
+            sender.handle_link_up(port, 1)
+        for i, host in enumerate(hosts):
+            sender.table[host] = TableEntry(
+                dst=host, port=i % port_count, latency=1, expire_time=FOREVER
+            )
+        sender.table.take_changes()
+        sender.sent = []
+
+        start = time.perf_counter()
+        sender.send_routes(force=True)
+        send_time = time.perf_counter() - start
+        packets = sender.sent
+
+        receiver = _make_router(max_routes)
+        receiver.handle_link_up(0, 1)
+        start = time.perf_counter()
+        for port, packet in packets:
+            if port == 0:
+                receiver.handle_rx(packet, 0)
+        recv_time = time.perf_counter() - start
+
+        results.append((max_routes, len(packets), send_time, recv_time))
+
+    return results
+
+
+def main():
+    route_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    port_count = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    print("%s routes, %s ports" % (route_count, port_count))
+    print("{:>10} {:>10} {:>10} {:>10}".format("per-pkt", "packets", "send ms", "recv ms"))
+    for max_routes, packets, send_time, recv_time in run(route_count, port_count):
+        print(
+            "{:>10} {:>10} {:>10.1f} {:>10.1f}".format(
+                max_routes, packets, send_time * 1000, recv_time * 1000
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
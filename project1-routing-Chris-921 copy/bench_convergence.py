@@ -0,0 +1,447 @@
+"""
+Convergence benchmark for DVRouter
+
+Builds synthetic topologies (line, ring, grid, Erdos-Renyi, fat-tree) of
+DVRouters, brings every link up, then takes one link down and brings it
+back.  For each phase it reports how long the routers took to converge, in
+simulated and wall-clock time, how much advertisement traffic they sent,
+and whether the final tables hold the shortest paths.  Every combination
+of SPLIT_HORIZON / POISON_REVERSE / POISON_EXPIRED / SEND_ON_LINK_UP is run
+separately.
+
+Routers run on the headless backend (see headless.py): packets are
+delivered after the link latency and timers fire every TIMER_INTERVAL
+simulated seconds, but nothing ever sleeps.
+
+Run from the simulator's root directory, e.g.:
+  python bench_convergence.py --output conv.json
+  python bench_convergence.py --sizes 1000 10000 --topologies grid fat_tree
+  python bench_convergence.py --compare conv.json
+
+A phase that has not gone quiet within --max-time simulated seconds (e.g.
+counting to infinity) is reported as a timeout.
+"""
+
+import argparse
+import heapq
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+import cs168.dv as dv
+from cs168.dv import INFINITY
+
+from dv_router import DVRouter
+import headless
+
+
+# How often each router's handle_timer() runs, in simulated seconds.
+TIMER_INTERVAL = 5
+
+# Latency of every router-router and router-host link.
+LINK_LATENCY = 1
+
+TOPOLOGIES = ("line", "ring", "grid", "erdos_renyi", "fat_tree")
+
+
+# ----------------------------------------------------------------------
+# Topologies.  Each returns (node_count, edges), edges being (a, b) pairs
+# of router indexes.
+
+
+def line_topology(n, rng):
+    return n, [(i, i + 1) for i in range(n - 1)]
+
+
+def ring_topology(n, rng):
+    n, edges = line_topology(n, rng)
+    if n > 2:
+        edges.append((n - 1, 0))
+    return n, edges
+
+
+def grid_topology(n, rng):
+    side = int(math.ceil(math.sqrt(n)))
+    edges = []
+    for i in range(n):
+        if (i + 1) % side and i + 1 < n:
+            edges.append((i, i + 1))
+        if i + side < n:
+            edges.append((i, i + side))
+    return n, edges
+
+
+def erdos_renyi_topology(n, rng, mean_degree=4):
+    """
+    G(n, m) with m chosen for the given mean degree, plus a random
+    spanning tree so that the graph is connected.
+    """
+    edges = set()
+    for i in range(1, n):
+        edges.add((rng.randrange(i), i))
+    wanted = min(n * (n - 1) // 2, int(n * mean_degree / 2))
+    while len(edges) < wanted:
+        a, b = rng.randrange(n), rng.randrange(n)
+        if a != b:
+            edges.add((min(a, b), max(a, b)))
+    return n, sorted(edges)
+
+
+def fat_tree_topology(n, rng):
+    """
+    A k-ary fat-tree of switches with the smallest even k giving at least
+    n switches (5k^2/4 of them).
+    """
+    k = 2
+    while 5 * k * k // 4 < n:
+        k += 2
+    half = k // 2
+    core = list(range(half * half))
+    next_id = len(core)
+    edges = []
+    for _ in range(k):
+        aggs = list(range(next_id, next_id + half))
+        next_id += half
+        edge_switches = list(range(next_id, next_id + half))
+        next_id += half
+        for a in aggs:
+            for e in edge_switches:
+                edges.append((a, e))
+        for i, a in enumerate(aggs):
+            for c in core[i * half:(i + 1) * half]:
+                edges.append((c, a))
+    return next_id, edges
+
+
+TOPOLOGY_BUILDERS = {
+    "line": line_topology,
+    "ring": ring_topology,
+    "grid": grid_topology,
+    "erdos_renyi": erdos_renyi_topology,
+    "fat_tree": fat_tree_topology,
+}
+
+
+# ----------------------------------------------------------------------
+# Flag combinations
+
+
+def flag_combinations():
+    for mode in ("none", "split_horizon", "poison_reverse"):
+        for poison_expired in (False, True):
+            for send_on_link_up in (False, True):
+                yield {
+                    "SPLIT_HORIZON": mode == "split_horizon",
+                    "POISON_REVERSE": mode == "poison_reverse",
+                    "POISON_EXPIRED": poison_expired,
+                    "SEND_ON_LINK_UP": send_on_link_up,
+                }
+
+
+def _flags_key(flags):
+    return ",".join(k for k in sorted(flags) if flags[k]) or "none"
+
+
+# ----------------------------------------------------------------------
+# The network
+
+
+def _watch_table(table, net):
+    """
+    Makes `table` report real route changes (new, removed, or a different
+    port or latency; not mere refreshes) to `net`, and its size whenever it
+    gains or loses a destination.
+    """
+    note_write = table._note_write
+    note_delete = table._note_delete
+    routes = {}  # dst -> (port, latency) as last written
+
+    def _note_write(dst, old_port, port, expire_time):
+        # Called after the write, so the table already has the new latency.
+        route = (port, table.latency_of(dst))
+        if dst not in routes:
+            net.table_resized(table)
+        if routes.get(dst) != route:
+            routes[dst] = route
+            net.last_change = net.now
+        note_write(dst, old_port, port, expire_time)
+
+    def _note_delete(dst, old_port):
+        routes.pop(dst, None)
+        net.last_change = net.now
+        note_delete(dst, old_port)
+        net.table_resized(table)
+
+    table._note_write = _note_write
+    table._note_delete = _note_delete
+
+
+def _table_bytes(table):
+    size = sys.getsizeof(table)
+    if isinstance(table, dv.CompactTable):
+        size += sys.getsizeof(table._slot_of) + sys.getsizeof(table._dsts)
+        for column in (table._ports, table._latencies, table._expire_times):
+            size += sys.getsizeof(column)
+    else:
+        size += sum(sys.getsizeof(entry) for entry in table.values())
+    return size
+
+
+class _BenchNetwork(headless.Network):
+    """
+    A headless network that also tracks when routes last changed and can
+    check the routers' tables against the true shortest paths.
+    """
+
+    def __init__(self, router_class, node_count, edges, host_count, scheduler):
+        super(_BenchNetwork, self).__init__(router_class, scheduler, TIMER_INTERVAL)
+        self.last_change = 0.0
+        self._table_sizes = {}  # id(table) -> bytes when last resized
+        self.current_table_bytes = 0
+        self.peak_table_bytes = 0
+        for _ in range(node_count):
+            i = self.add_router()
+            _watch_table(self.routers[i].table, self)
+            self.table_resized(self.routers[i].table)
+        for a, b in edges:
+            self.add_link(a, b, LINK_LATENCY)
+        hosts = scheduler.rng.sample(range(node_count), min(host_count, node_count))
+        for i in sorted(hosts):
+            self.add_host(i, LINK_LATENCY)
+
+    @property
+    def now(self):
+        return self.scheduler.now
+
+    def run_until_quiet(self, quiet, max_time):
+        """
+        Runs events until no route has changed for `quiet` simulated
+        seconds, or until `max_time`.
+
+        Returns True if the routes went quiet, False if time ran out.
+        """
+        return self.scheduler.run(
+            until=max_time, stop_when=lambda t: t > self.last_change + quiet
+        )
+
+    def shortest_paths(self):
+        """
+        Returns {host: {router id: latency}} over the links that are up.
+        """
+        adjacency = {i: [] for i in self.routers}
+        for link in self.links:
+            if link.up:
+                adjacency[link.a].append((link.b, link.latency))
+                adjacency[link.b].append((link.a, link.latency))
+        result = {}
+        for host, attached in self.hosts.items():
+            dist = dict.fromkeys(self.routers, float("inf"))
+            dist[attached] = LINK_LATENCY
+            heap = [(LINK_LATENCY, attached)]
+            while heap:
+                d, node = heapq.heappop(heap)
+                if d > dist[node]:
+                    continue
+                for peer, latency in adjacency[node]:
+                    if d + latency < dist[peer]:
+                        dist[peer] = d + latency
+                        heapq.heappush(heap, (d + latency, peer))
+            result[host] = dist
+        return result
+
+    def routes_correct(self):
+        for host, dist in self.shortest_paths().items():
+            for i, router in self.routers.items():
+                entry = router.table.get(host)
+                have = INFINITY if entry is None else min(entry.latency, INFINITY)
+                if have != min(dist[i], INFINITY):
+                    return False
+        return True
+
+    def table_bytes(self):
+        return sum(_table_bytes(r.table) for r in self.routers.values())
+
+    def table_resized(self, table):
+        """
+        Updates the running total of table bytes (and its peak) after
+        `table` gained or lost a destination.
+        """
+        size = _table_bytes(table)
+        self.current_table_bytes += size - self._table_sizes.get(id(table), 0)
+        self._table_sizes[id(table)] = size
+        self.peak_table_bytes = max(self.peak_table_bytes, self.current_table_bytes)
+
+
+# ----------------------------------------------------------------------
+# Running
+
+
+def _phase(net, name, event, quiet, max_time):
+    start_adv, start_routes = net.packets_sent, net.routes_advertised
+    start = net.now
+    net.last_change = net.now
+    net.peak_table_bytes = net.current_table_bytes
+    wall = time.perf_counter()
+    if event is not None:
+        event()
+    converged = net.run_until_quiet(quiet, start + max_time)
+    wall = time.perf_counter() - wall
+    return {
+        "phase": name,
+        "converged": converged,
+        "sim_convergence_time": net.last_change - start,
+        "wall_time": wall,
+        "advertisements": net.packets_sent - start_adv,
+        "routes_advertised": net.routes_advertised - start_routes,
+        "table_bytes": net.table_bytes(),
+        "peak_table_bytes": net.peak_table_bytes,
+        "correct": net.routes_correct(),
+    }
+
+
+def run_one(topology, size, flags, hosts, seed, max_time):
+    rng = random.Random(seed)
+    node_count, edges = TOPOLOGY_BUILDERS[topology](size, rng)
+    router_class = type("DVRouter", (DVRouter,), dict(flags))
+    quiet = router_class.ROUTE_TTL + 2 * TIMER_INTERVAL
+
+    scheduler = headless.Scheduler(seed)
+    with scheduler.installed():
+        setup = time.perf_counter()
+        net = _BenchNetwork(router_class, node_count, edges, hosts, scheduler)
+        setup = time.perf_counter() - setup
+        phases = [_phase(net, "initial", None, quiet, max_time)]
+        if net.links:
+            link = rng.choice(net.links)
+            phases.append(
+                _phase(net, "link_down", lambda: net.link_down(link), quiet, max_time)
+            )
+            phases.append(
+                _phase(net, "link_up", lambda: net.link_up(link), quiet, max_time)
+            )
+
+    return {
+        "topology": topology,
+        "size": size,
+        "nodes": node_count,
+        "links": len(edges),
+        "hosts": len(net.hosts),
+        "flags": flags,
+        "seed": seed,
+        "setup_wall_time": setup,
+        "peak_table_bytes": max(p["peak_table_bytes"] for p in phases),
+        "phases": phases,
+    }
+
+
+def run(topologies, sizes, hosts, seed, max_time, report=None):
+    results = []
+    for topology in topologies:
+        for size in sizes:
+            for flags in flag_combinations():
+                result = run_one(topology, size, flags, hosts, seed, max_time)
+                results.append(result)
+                if report:
+                    report(result)
+    return results
+
+
+def _result_key(result):
+    return (result["topology"], result["size"], _flags_key(result["flags"]))
+
+
+def _print_result(result):
+    for p in result["phases"]:
+        print(
+            "{:>12} {:>6} {:>40} {:>9} {:>8} {:>9.3f} {:>9} {:>7}".format(
+                result["topology"],
+                result["nodes"],
+                _flags_key(result["flags"]),
+                p["phase"],
+                "%.1f" % p["sim_convergence_time"] if p["converged"] else "timeout",
+                p["wall_time"],
+                p["advertisements"],
+                "ok" if p["correct"] else "WRONG",
+            )
+        )
+
+
+def _print_comparison(results, baseline):
+    old = {_result_key(r): r for r in baseline["results"]}
+    print()
+    print("Compared with baseline (new / old):")
+    for result in results:
+        before = old.get(_result_key(result))
+        if before is None:
+            continue
+        before_phases = {p["phase"]: p for p in before["phases"]}
+        for p in result["phases"]:
+            q = before_phases.get(p["phase"])
+            if q is None:
+                continue
+            ratios = []
+            for field in ("sim_convergence_time", "wall_time", "advertisements"):
+                ratios.append(
+                    "%s %.2fx" % (field, p[field] / q[field]) if q[field]
+                    else "%s n/a" % (field,)
+                )
+            print(
+                "{:>12} {:>6} {:>40} {:>9}  {}".format(
+                    result["topology"],
+                    result["nodes"],
+                    _flags_key(result["flags"]),
+                    p["phase"],
+                    ", ".join(ratios),
+                )
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--topologies", nargs="+", default=list(TOPOLOGIES),
+                        choices=TOPOLOGIES)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100])
+    parser.add_argument("--hosts", type=int, default=32,
+                        help="number of routers that get a host attached")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-time", type=float, default=600,
+                        help="simulated seconds allowed per phase")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON file from an earlier run")
+    args = parser.parse_args(argv)
+
+    print(
+        "{:>12} {:>6} {:>40} {:>9} {:>8} {:>9} {:>9} {:>7}".format(
+            "topology", "nodes", "flags", "phase", "sim s", "wall s", "adverts", "correct"
+        )
+    )
+    results = run(args.topologies, args.sizes, args.hosts, args.seed,
+                  args.max_time, report=_print_result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "time": time.time(),
+                        "python": platform.python_version(),
+                        "argv": sys.argv[1:] if argv is None else argv,
+                        "timer_interval": TIMER_INTERVAL,
+                        "link_latency": LINK_LATENCY,
+                    },
+                    "results": results,
+                },
+                f,
+                indent=1,
+            )
+
+    if args.compare:
+        with open(args.compare) as f:
+            _print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Benchmark: exact-match table lookups vs. the longest-prefix-match Fib
+
+Builds a network of `blocks` /24 address blocks with `hosts` hosts each,
+then routes data packets to random hosts two ways:
+  dict -- one Table entry per host, looked up the way handle_data_packet
+          used to (dst in table, then table[dst]);
+  fib  -- one Table entry per /24 block, compiled into a Fib.
+Fib lookups are timed both with an empty lookup cache (a full trie walk
+per packet) and with a warm one.  It also reports the number of routes
+each needs, and how long it takes to sync the Fib after a handful of
+routes change compared to a full rebuild.
+
+Run from the simulator's root directory:
+  python bench_fib.py [blocks] [hosts per block] [lookups]
+"""
+
+import ipaddress
+import random
+import sys
+import time
+
+import sim.api as api
+from cs168.dv import Fib, Table, TableEntry, FOREVER, INFINITY
+
+
+class _BenchHost(api.HostEntity):
+    pass
+
+
+def _make_host(**attrs):
+    host = _BenchHost()
+    for name, value in attrs.items():
+        setattr(host, name, value)
+    return host
+
+
+def _dict_lookups(table, dsts):
+    found = 0
+    for dst in dsts:
+        if dst in table:
+            entry = table[dst]
+            if entry.latency < INFINITY:
+                found += 1
+    return found
+
+
+def _fib_lookups(fib, dsts):
+    found = 0
+    lookup = fib.lookup
+    for dst in dsts:
+        if lookup(dst) is not None:
+            found += 1
+    return found
+
+
+def run(block_count=1000, hosts_per_block=64, lookup_count=200000, seed=0):
+    rng = random.Random(seed)
+    base = int(ipaddress.IPv4Address("10.0.0.0"))
+    hosts = []
+    host_table = Table()
+    block_table = Table()
+    for b in range(block_count):
+        network = base + (b << 8)
+        port = rng.randrange(16)
+        block = _make_host(prefix="%s/24" % ipaddress.IPv4Address(network))
+        block_table[block] = TableEntry(block, port, 1, FOREVER)
+        for h in range(hosts_per_block):
+            host = _make_host(address=str(ipaddress.IPv4Address(network + h + 1)))
+            host_table[host] = TableEntry(host, port, 1, FOREVER)
+            hosts.append(host)
+    dsts = [rng.choice(hosts) for _ in range(lookup_count)]
+
+    fib = Fib()
+    # Big enough for every host, so "steady state" means every lookup hits.
+    fib.CACHE_SIZE = len(hosts)
+    start = time.perf_counter()
+    fib.sync(block_table)
+    build_time = time.perf_counter() - start
+    _fib_lookups(fib, hosts)  # Parse each host's address once
+
+    start = time.perf_counter()
+    dict_found = _dict_lookups(host_table, dsts)
+    dict_time = time.perf_counter() - start
+
+    # Walking the trie for every packet, as right after a change...
+    start = time.perf_counter()
+    for i in range(0, lookup_count, 1000):
+        fib._cache.clear()
+        _fib_lookups(fib, dsts[i : i + 1000])
+    trie_time = time.perf_counter() - start
+
+    # ...and in the steady state between changes.
+    start = time.perf_counter()
+    fib_found = _fib_lookups(fib, dsts)
+    fib_time = time.perf_counter() - start
+    assert dict_found == fib_found == lookup_count
+
+    blocks = list(block_table)
+    for block in rng.sample(blocks, min(10, len(blocks))):
+        block_table[block] = TableEntry(block, rng.randrange(16), 2, FOREVER)
+    start = time.perf_counter()
+    fib.sync(block_table)
+    sync_time = time.perf_counter() - start
+    start = time.perf_counter()
+    Fib().rebuild(block_table)
+    rebuild_time = time.perf_counter() - start
+
+    return {
+        "dict routes": len(host_table),
+        "fib routes": len(block_table),
+        "fib installed": len(fib),
+        "dict lookups/s": lookup_count / dict_time,
+        "trie lookups/s": lookup_count / trie_time,
+        "fib lookups/s": lookup_count / fib_time,
+        "fib build ms": build_time * 1000,
+        "sync 10 ms": sync_time * 1000,
+        "rebuild ms": rebuild_time * 1000,
+    }
+
+
+def main():
+    block_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    hosts_per_block = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    lookup_count = int(sys.argv[3]) if len(sys.argv) > 3 else 200000
+
+    results = run(block_count, hosts_per_block, lookup_count)
+    for name, value in results.items():
+        print("{:>16} {:>14,.1f}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Microbenchmarks for loading and updating routing tables
+
+For 1k, 10k and 100k routes, times:
+  setitem      -- table[dst] = entry, one route at a time
+  update       -- table.update({dst: entry, ...})
+  bulk_load    -- table.bulk_load(entries)
+  bulk trusted -- table.bulk_load(entries, trusted=True)
+  small update -- table.update() of 10 routes into the full table
+for both Table and CompactTable.
+
+Run from the simulator's root directory:
+  python bench_table.py
+"""
+
+import gc
+import time
+
+import sim.api as api
+from cs168.dv import Table, CompactTable, TableEntry
+
+
+SIZES = (1000, 10000, 100000)
+
+
+class _BenchHost(api.HostEntity):
+    pass
+
+
+def _timed(f):
+    # Like timeit, keep the collector from landing in one run but not another.
+    gc.collect()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        f()
+        return time.perf_counter() - start
+    finally:
+        gc.enable()
+
+
+def _setitem(table, entries):
+    for entry in entries:
+        table[entry.dst] = entry
+
+
+def run(sizes=SIZES, table_classes=(Table, CompactTable)):
+    results = []
+    for size in sizes:
+        hosts = [_BenchHost() for _ in range(size)]
+        entries = [
+            TableEntry(dst=h, port=i % 16, latency=i % 50, expire_time=100.0 + i)
+            for i, h in enumerate(hosts)
+        ]
+        as_dict = {e.dst: e for e in entries}
+        small = {e.dst: e for e in entries[:10]}
+
+        for cls in table_classes:
+            row = {"table": cls.__name__, "size": size}
+            row["setitem"] = _timed(lambda: _setitem(cls(), entries))
+            row["update"] = _timed(lambda: cls().update(as_dict))
+            row["bulk_load"] = _timed(lambda: cls().bulk_load(entries))
+            row["bulk trusted"] = _timed(
+                lambda: cls().bulk_load(entries, trusted=True)
+            )
+            full = cls()
+            full.bulk_load(entries, trusted=True)
+            row["small update"] = _timed(lambda: full.update(small))
+            results.append(row)
+    return results
+
+
+def main():
+    columns = ("setitem", "update", "bulk_load", "bulk trusted", "small update")
+    print(
+        "{:>13} {:>7} ".format("table", "size")
+        + " ".join("{:>12}".format(c) for c in columns)
+        + "   (ms)"
+    )
+    for row in run():
+        print(
+            "{:>13} {:>7} ".format(row["table"], row["size"])
+            + " ".join("{:>12.2f}".format(row[c] * 1000) for c in columns)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,47 @@ class RoutePacket(api.Packet):
         return "<RoutePacket to %s at cost %s>" % (self.destination, self.latency)
 
 
+class CompactRoutePacket(RoutePacket):
+    """
+    A RoutePacket that doesn't build two colour lists per packet
+
+    The colours are class attributes shared by every instance instead of
+    two fresh lists each; they are tuples, so no packet can change them
+    for the others.  Otherwise it is an ordinary RoutePacket.
+    """
+
+    outer_color = (1, 0, 1, 1)
+    inner_color = (1, 0, 1, 1)
+
+    def __init__(self, destination, latency):
+        api.Packet.__init__(self)
+        self.destination = destination
+        self.latency = latency
+
+
+class RouteBatchPacket(api.Packet):
+    """
+    Several DV route advertisements carried in one packet
+
+    .routes is a list of (destination, latency) pairs; each pair means the
+    same thing as a single RoutePacket with that .destination and .latency.
+    Batching lets a router send a large part of its distance vector with
+    one packet instead of one packet per route.
+    """
+
+    def __init__(self, routes):
+        super(RouteBatchPacket, self).__init__()
+        self.routes = list(routes)
+        self.outer_color = [1, 0, 1, 1]
+        self.inner_color = [1, 0, 1, 1]
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __repr__(self):
+        return "<RouteBatchPacket with %s routes>" % (len(self.routes),)
+
+
 class Ports:
     ...
 
@@ -73,6 +114,14 @@ class DVRouterBase(api.Entity):
         pkt = RoutePacket(destination=dst, latency=latency)
         self.send(pkt, port=port)
 
+    def send_route_batch(self, port, routes):
+        """
+        Creates a single control packet from (dst, latency) pairs and sends it.
+        """
+
+        pkt = RouteBatchPacket(routes)
+        self.send(pkt, port=port)
+
     def s_log(self, format, *args):
         ...
 
@@ -80,7 +129,12 @@ class DVRouterBase(api.Entity):
 # TODO: Move this stuff to top of file?
 
 # import abc
-from collections import namedtuple
+from array import array
+from collections import OrderedDict, namedtuple
+from collections.abc import MutableMapping
+import heapq
+import ipaddress
+import itertools
 from numbers import Number  # Available in Python >= 2.7.
 import unittest
 
@@ -110,8 +164,865 @@ class _ValidatedDict(dict):
         return super(_ValidatedDict, self).__setitem__(key, value)
 
     def update(self, *args, **kwargs):
-        super(_ValidatedDict, self).update(*args, **kwargs)
-        for k, v in self.items():
+        # Only the incoming items can be invalid; validate them all before
+        # touching the dict so a bad item leaves it unchanged.
+        incoming = dict(*args, **kwargs)
+        for k, v in incoming.items():
             self.validate(k, v)
+        super(_ValidatedDict, self).update(incoming)
+
+    # @abc.abstractmethod
+    def validate(self, key, value):
+        """Raises ValueError if key or value is not valid."""
+        pass
+
+
+class _RouteIndexes(object):
+    """
+    Bookkeeping shared by the routing table implementations
+
+    Keeps track of:
+    * which destinations have been written or removed since the router
+      last asked (see `take_changes()`), so triggered updates only need
+      to look at routes that actually changed;
+    * a min-heap on expire_time of the entries that can expire, so finding
+      expired routes (see `take_expired()`) needs no scan of the table.
+      Replaced or removed entries are left in the heap and skipped when
+      they reach the top;
+    * a port -> destinations index (see `destinations_via()`), so the
+      routes using a given port can be found without a scan;
+    * a second change set for the forwarding table (see
+      `take_forwarding_changes()` and `Fib.sync()`), kept apart from the
+      first so advertising routes and forwarding packets don't consume
+      each other's changes.
+
+    Subclasses call _note_write() / _note_delete() / _reset_indexes()
+    whenever their contents change, and provide port_of(), latency_of(),
+    expire_time_of() and set_route(), which read and write one route's
+    fields without going through a TableEntry.
+
+    The change set and the port index are dicts used as ordered sets, so
+    iterating over them follows the order of the writes rather than host
+    hash order, and repeated simulations behave identically.
+    """
+
+    owner = None
+
+    def _init_indexes(self):
+        self._changed = {}
+        self._fib_changed = {}
+        self._expiry = []
+        self._expiry_seq = itertools.count()
+        self._by_port = {}
+
+    def _reset_indexes(self):
+        self._changed.update(dict.fromkeys(self.keys()))
+        self._fib_changed.update(dict.fromkeys(self.keys()))
+        self._expiry = []
+        self._by_port = {}
+
+    def _note_write(self, dst, old_port, port, expire_time):
+        """
+        Records a write of a route via `port`; old_port is the port of the
+        route it replaced, or None if there was none.
+        """
+        self._changed[dst] = None
+        self._fib_changed[dst] = None
+        self._index_port(dst, old_port, port)
+        self._track_expiry(dst, expire_time)
+
+    def _note_bulk_write(self, writes):
+        """
+        Like _note_write() for many (dst, old, new) triples at once.
+        """
+        self._changed.update(dict.fromkeys(dst for dst, _, _ in writes))
+        self._fib_changed.update(dict.fromkeys(dst for dst, _, _ in writes))
+
+        by_port = {}
+        for dst, old, new in writes:
+            if old is not None and old.port != new.port:
+                self._index_port(dst, old.port, None)
+            by_port.setdefault(new.port, []).append(dst)
+        for port, dsts in by_port.items():
+            self._by_port.setdefault(port, {}).update(dict.fromkeys(dsts))
+
+        seq = self._expiry_seq
+        self._expiry.extend(
+            (new.expire_time, next(seq), dst)
+            for dst, _, new in writes
+            if new.expire_time != FOREVER
+        )
+        heapq.heapify(self._expiry)
+
+    def _check_bulk(self, entries):
+        """
+        Validates entries for bulk_load() in a single pass.
+
+        Keys are taken from entry.dst, so only the types need checking.
+        """
+        for entry in entries:
+            if not isinstance(entry, TableEntry) or not isinstance(
+                entry.dst, HostEntity
+            ):
+                raise ValueError("entry %s isn't a valid table entry" % (entry,))
+
+    def _note_delete(self, dst, old_port):
+        self._changed[dst] = None
+        self._fib_changed[dst] = None
+        self._index_port(dst, old_port, None)
+
+    def validate(self, dst, entry):
+        """Raises ValueError if dst and entry have incorrect types."""
+        if not isinstance(dst, HostEntity):
+            raise ValueError("destination %s is not a host" % (dst,))
+
+        if not isinstance(entry, TableEntry):
+            raise ValueError("entry %s isn't a table entry" % (entry,))
+
+        if entry.dst != dst:
+            raise ValueError(
+                "entry destination %s doesn't match key %s" % (entry.dst, dst)
+            )
+
+    @property
+    def changed(self):
+        """Destinations written or removed since the last take_changes()."""
+        return tuple(self._changed)
+
+    def take_changes(self):
+        """
+        Returns the destinations changed since the last call, in the order
+        they were first changed, and starts a new (empty) change set.
+
+        A returned destination that is no longer a key in the table was
+        removed.
+        """
+        changed, self._changed = self._changed, {}
+        return tuple(changed)
+
+    def take_forwarding_changes(self):
+        """
+        Like take_changes(), but with its own change set, for keeping a
+        forwarding table (Fib) in step with this table.
+        """
+        changed, self._fib_changed = self._fib_changed, {}
+        return tuple(changed)
+
+    def _index_port(self, dst, old_port, port):
+        if old_port is not None and old_port != port:
+            dsts = self._by_port.get(old_port)
+            if dsts is not None:
+                dsts.pop(dst, None)
+                if not dsts:
+                    del self._by_port[old_port]
+        if port is not None:
+            self._by_port.setdefault(port, {})[dst] = None
+
+    def destinations_via(self, port):
+        """
+        Returns the destinations whose route currently uses `port`.
+
+        The result is a copy, so the table may be modified while iterating.
+        """
+        return tuple(self._by_port.get(port, ()))
+
+    def _track_expiry(self, dst, expire_time):
+        if expire_time == FOREVER:
+            return
+        heapq.heappush(self._expiry, (expire_time, next(self._expiry_seq), dst))
+        # Stale heap items normally drain as their time passes, but a table
+        # whose routes are refreshed much faster than they expire can pile
+        # them up; rebuild once they clearly outnumber the live ones.
+        if len(self._expiry) > 2 * len(self) + 64:
+            expire_time_of = self.expire_time_of
+            self._expiry = [
+                (t, next(self._expiry_seq), d)
+                for d, t in ((d, expire_time_of(d)) for d in self)
+                if t != FOREVER
+            ]
+            heapq.heapify(self._expiry)
+
+    def take_expired(self, now=None):
+        """
+        Returns the destinations whose current entry has expired.
+
+        Each expired entry is reported once; the caller is expected to
+        remove or replace it.  Entries with a FOREVER expire time never
+        show up here.
+
+        :param now: the current time (defaults to current_time()).
+        """
+        if now is None:
+            now = current_time()
+        expired = []
+        seen = set()
+        heap = self._expiry
+        while heap and heap[0][0] < now:
+            expire_time, _, dst = heapq.heappop(heap)
+            if dst in seen:
+                continue
+            # Anything else is a stale heap item for a replaced entry.
+            if dst in self and self.expire_time_of(dst) == expire_time:
+                expired.append(dst)
+                seen.add(dst)
+        return expired
+
+    def __str__(self):
+        o = "=== Table"
+        if self.owner and getattr(self.owner, "name"):
+            o += " for " + str(self.owner.name)
+        o += " ===\n"
+
+        if not self:
+            o += "(empty table)"
+        else:
+            o += "{:>14} {:>4} {:>3} {:>5}\n".format("name", "prt", "lat", "sec")
+            o += "-------------- ---- --- -----\n"
+            for entry in self.values():
+                o += "{:>14} {:>4} {:>3} {:>5}\n".format(
+                    get_name(entry.dst),
+                    entry.port,
+                    entry.latency,
+                    entry.expire_time - current_time()
+                    if entry.expire_time != FOREVER
+                    else "inf",
+                )
+
+        return o.strip()
+
+
+class Table(_RouteIndexes, _ValidatedDict):
+    """
+    A routing table
+
+    You should use a `Table` instance as a `dict` that maps a
+    destination host to a `TableEntry` object.
+
+    See _RouteIndexes for the change set, expiry heap and port index it
+    maintains alongside the dict.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._init_indexes()
+        super(Table, self).__init__(*args, **kwargs)
+        for dst, entry in self.items():
+            self._note_write(dst, None, entry.port, entry.expire_time)
+
+    def __setitem__(self, dst, entry):
+        old = self.get(dst)
+        super(Table, self).__setitem__(dst, entry)
+        self._note_write(
+            dst, old.port if old is not None else None, entry.port,
+            entry.expire_time,
+        )
+
+    def __delitem__(self, dst):
+        old = self[dst]
+        super(Table, self).__delitem__(dst)
+        self._note_delete(dst, old.port)
+
+    def update(self, *args, **kwargs):
+        incoming = dict(*args, **kwargs)
+        old = {dst: self.get(dst) for dst in incoming}
+        super(Table, self).update(incoming)
+        for dst, entry in incoming.items():
+            self._note_write(
+                dst, old[dst].port if old[dst] is not None else None,
+                entry.port, entry.expire_time,
+            )
+
+    def setdefault(self, dst, entry=None):
+        if dst not in self:
+            self[dst] = entry
+        return self[dst]
+
+    def pop(self, dst, *default):
+        if dst in self:
+            self._note_delete(dst, self[dst].port)
+        return super(Table, self).pop(dst, *default)
+
+    def popitem(self):
+        dst, entry = super(Table, self).popitem()
+        self._note_delete(dst, entry.port)
+        return dst, entry
+
+    def port_of(self, dst):
+        return self[dst].port
+
+    def latency_of(self, dst):
+        return self[dst].latency
+
+    def expire_time_of(self, dst):
+        return self[dst].expire_time
+
+    def set_route(self, dst, port, latency, expire_time):
+        """
+        Same as table[dst] = TableEntry(dst, port, latency, expire_time).
+        """
+        self[dst] = TableEntry(dst, port, latency, expire_time)
+
+    def clear(self):
+        self._reset_indexes()
+        super(Table, self).clear()
+
+    def bulk_load(self, entries, trusted=False):
+        """
+        Adds many TableEntry objects at once, each keyed by its .dst.
+
+        Much cheaper than setting them one at a time: the entries are
+        validated in one pass before anything is inserted (so a bad entry
+        leaves the table unchanged), inserted with a single dict update,
+        and the expiry heap is rebuilt once instead of pushed per entry.
+
+        :param entries: an iterable of TableEntry.
+        :param trusted: if True, skip validation.  Only for entries the
+                        router built itself (via TableEntry()).
+        """
+        entries = list(entries)
+        if not trusted:
+            self._check_bulk(entries)
+        # As with dict.update(), the last entry for a destination wins.
+        entries = list({e.dst: e for e in entries}.values())
+        get = self.get
+        writes = [(e.dst, get(e.dst), e) for e in entries]
+        dict.update(self, ((e.dst, e) for e in entries))
+        self._note_bulk_write(writes)
+
 
-  ...
+class _DestinationIds(object):
+    """
+    Numbers destinations 0, 1, 2... so they can be stored in typed arrays
+
+    Shared by every CompactTable: destinations are hosts, so in a
+    simulation there are only as many ids as hosts, however many tables
+    hold routes to them.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self.dsts = []
+
+    def id_of(self, dst):
+        try:
+            return self._ids[dst]
+        except KeyError:
+            i = self._ids[dst] = len(self.dsts)
+            self.dsts.append(dst)
+            return i
+
+
+class CompactTable(_RouteIndexes, MutableMapping):
+    """
+    A routing table stored column-wise
+
+    Behaves like `Table` (a mapping from destination host to `TableEntry`,
+    with the same change set, expiry heap and port index), but stores
+    routes as slots in typed arrays of destination ids, ports, latencies
+    and expire times instead of one TableEntry object per route.  Arrays
+    hold no object references, so the garbage collector never scans them.
+
+    Indexing the table builds a TableEntry for the slot on the fly, as a
+    Mapping has to.  The router's own hot paths use port_of(),
+    latency_of(), expire_time_of() and set_route() instead, which read and
+    write the columns directly and allocate nothing.
+
+    This is meant for simulations with very many routers, where per-route
+    objects dominate memory and GC time.
+    """
+
+    _ids = _DestinationIds()
+
+    def __init__(self, *args, **kwargs):
+        self._init_indexes()
+        self._init_columns()
+        self.update(*args, **kwargs)
+
+    def _init_columns(self):
+        self._slot_of = {}
+        self._dsts = array("l")  # Destination ids; -1 for a free slot
+        self._ports = array("l")
+        self._latencies = array("d")
+        self._expire_times = array("d")
+        self._free = []
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __iter__(self):
+        return iter(self._slot_of)
+
+    def __contains__(self, dst):
+        return dst in self._slot_of
+
+    def _entry(self, slot):
+        # Already validated when it was stored, so skip TableEntry.__new__.
+        return tuple.__new__(
+            TableEntry,
+            (
+                self._ids.dsts[self._dsts[slot]],
+                self._ports[slot],
+                self._latencies[slot],
+                self._expire_times[slot],
+            ),
+        )
+
+    def __getitem__(self, dst):
+        return self._entry(self._slot_of[dst])
+
+    def get(self, dst, default=None):
+        slot = self._slot_of.get(dst)
+        if slot is None:
+            return default
+        return self._entry(slot)
+
+    def port_of(self, dst):
+        return self._ports[self._slot_of[dst]]
+
+    def latency_of(self, dst):
+        return self._latencies[self._slot_of[dst]]
+
+    def expire_time_of(self, dst):
+        return self._expire_times[self._slot_of[dst]]
+
+    def __setitem__(self, dst, entry):
+        self.validate(dst, entry)
+        self._write(dst, entry.port, entry.latency, entry.expire_time)
+
+    def set_route(self, dst, port, latency, expire_time):
+        """
+        Same as table[dst] = TableEntry(dst, port, latency, expire_time),
+        checking the same things, but without building the TableEntry.
+        """
+        if not isinstance(dst, HostEntity):
+            raise ValueError("Provided destination %s is not a host" % dst)
+        if not isinstance(port, int):
+            raise ValueError("Provided port %s is not an integer" % port)
+        if not isinstance(expire_time, Number):
+            raise ValueError("Provided expire time %s is not a number" % expire_time)
+        if not isinstance(latency, Number):
+            raise ValueError("Provided latency %s is not a number" % latency)
+        self._write(dst, port, latency, expire_time)
+
+    def _write(self, dst, port, latency, expire_time):
+        slot = self._slot_of.get(dst)
+        if slot is None:
+            old_port = None
+            if self._free:
+                slot = self._free.pop()
+                self._dsts[slot] = self._ids.id_of(dst)
+                self._ports[slot] = port
+                self._latencies[slot] = latency
+                self._expire_times[slot] = expire_time
+            else:
+                slot = len(self._dsts)
+                self._dsts.append(self._ids.id_of(dst))
+                self._ports.append(port)
+                self._latencies.append(latency)
+                self._expire_times.append(expire_time)
+            self._slot_of[dst] = slot
+        else:
+            old_port = self._ports[slot]
+            self._ports[slot] = port
+            self._latencies[slot] = latency
+            self._expire_times[slot] = expire_time
+        self._note_write(dst, old_port, port, expire_time)
+
+    def __delitem__(self, dst):
+        slot = self._slot_of.pop(dst)
+        self._dsts[slot] = -1
+        self._free.append(slot)
+        self._note_delete(dst, self._ports[slot])
+
+    def bulk_load(self, entries, trusted=False):
+        """
+        Adds many TableEntry objects at once, each keyed by its .dst.
+
+        See Table.bulk_load(); new destinations are appended to the
+        columns in one go.
+        """
+        entries = list(entries)
+        if not trusted:
+            self._check_bulk(entries)
+        entries = {e.dst: e for e in entries}.values()
+        writes = []
+        for entry in entries:
+            dst = entry.dst
+            slot = self._slot_of.get(dst)
+            if slot is None:
+                writes.append((dst, None, entry))
+                continue
+            writes.append((dst, self._entry(slot), entry))
+            self._ports[slot] = entry.port
+            self._latencies[slot] = entry.latency
+            self._expire_times[slot] = entry.expire_time
+
+        fresh = [new for _, old, new in writes if old is None]
+        base = len(self._dsts)
+        id_of = self._ids.id_of
+        self._dsts.extend(id_of(e.dst) for e in fresh)
+        self._ports.extend(e.port for e in fresh)
+        self._latencies.extend(e.latency for e in fresh)
+        self._expire_times.extend(e.expire_time for e in fresh)
+        self._slot_of.update((e.dst, base + i) for i, e in enumerate(fresh))
+        self._note_bulk_write(writes)
+
+    def clear(self):
+        self._reset_indexes()
+        self._init_columns()
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self.items()))
+
+
+class TableEntry(
+    namedtuple("TableEntry", ["dst", "port", "latency", "expire_time"])
+):
+    """
+    An entry in a Table, representing a route from a neighbor to some
+    destination host.
+
+    Example usage:
+        rte = TableEntry(
+            dst=h1, port=3, latency=10, expire_time=api.current_time()+10
+        )
+    """
+
+    def __new__(cls, dst, port, latency, expire_time):
+        """
+        Creates a routing table entry.
+
+        :param dst: the destination host.
+        :param port: the port that the router can use to reach dst.
+        :param latency: the latency from this router to dst.
+        :param expire_time: time point (seconds) at which this route expires.
+        """
+        if not isinstance(dst, HostEntity):
+            raise ValueError("Provided destination %s is not a host" % dst)
+
+        if not isinstance(port, int):
+            raise ValueError("Provided port %s is not an integer" % port)
+
+        if not isinstance(expire_time, Number):
+            raise ValueError("Provided expire time %s is not a number" % expire_time)
+
+        if not isinstance(latency, Number):
+            raise ValueError("Provided latency %s is not a number" % latency)
+
+        return super(TableEntry, cls).__new__(cls, dst, port, latency, expire_time)
+
+    @property
+    def has_expired(self):
+        return current_time() > self.expire_time
+
+    def __str__(self):
+        return "%s(dst=%s, port=%s, latency=%s, expire_time=%s)" % (
+            self.__class__.__name__,
+            get_name(self.dst),
+            self.port,
+            self.latency,
+            self.expire_time,
+        )
+
+
+def _parse_prefix(dst):
+    """
+    Returns (ip version, network address as an int, prefix length) for the
+    address block a destination stands for, or None if it has none.
+
+    A destination's block is its `prefix` attribute (anything
+    ipaddress.ip_network() accepts, e.g. "10.1.0.0/16"), or else its
+    `address` attribute as a single-address block.  A destination whose
+    prefix or address isn't an IP one has no block.
+    """
+    prefix = getattr(dst, "prefix", None)
+    if prefix is None:
+        prefix = getattr(dst, "address", None)
+        if prefix is None:
+            return None
+    try:
+        net = ipaddress.ip_network(prefix, strict=False)
+    except (ValueError, TypeError):
+        return None
+    return net.version, int(net.network_address), net.prefixlen
+
+
+class _FibNode(object):
+    __slots__ = ("value", "length", "port", "fwd", "installed", "children")
+
+    def __init__(self, value, length, fwd):
+        self.value = value  # Network address; bits past `length` are zero
+        self.length = length
+        self.port = None  # Port of the route for exactly this prefix
+        self.fwd = fwd  # Port for addresses whose longest match is here
+        self.installed = False
+        self.children = [None, None]
+
+
+class Fib(object):
+    """
+    A forwarding table compiled from a routing table
+
+    Maps a data packet's destination to an output port by longest-prefix
+    match.  Destinations with an address block (see _parse_prefix()) are
+    kept in a path-compressed binary trie per IP version; destinations
+    without one fall back to an exact-match dict, which is what the
+    routing table itself offers.
+
+    Each trie node stores the port that applies to addresses whose longest
+    match ends there (its own route's port, or else the closest enclosing
+    route's), so a lookup just walks down while the prefixes match.  A
+    route with the same port as the closest enclosing route forwards
+    nothing differently and is not counted as installed; len() is the size
+    of this aggregated table.
+
+    Only routes usable for forwarding are kept: a route whose latency is
+    INFINITY is left out, and packets fall back to a shorter prefix.
+
+    Lookup results are cached per destination until the next change, so
+    between changes a lookup costs a single dict access.  The cache keeps
+    the CACHE_SIZE most recently looked up destinations.
+
+    Example:
+        fib = Fib()
+        fib.sync(table)  # Picks up only what changed since the last sync
+        port = fib.lookup(packet.dst)
+    """
+
+    _WIDTHS = {4: 32, 6: 128}
+
+    # Most destinations whose lookup result (and address) is remembered.
+    CACHE_SIZE = 4096
+
+    def __init__(self):
+        self._exact = {}  # dst -> port, for destinations with no prefix
+        self._roots = {v: _FibNode(0, 0, None) for v in self._WIDTHS}
+        self._prefixes = {}  # dst -> _parse_prefix(dst)
+        self._addresses = OrderedDict()  # dst -> (version, address as int)
+        self._routes = {}  # (version, value, length) -> {dst: port}
+        self._installed = 0
+        self._cache = OrderedDict()  # dst -> lookup() result, LRU first
+
+    def __len__(self):
+        return len(self._exact) + self._installed
+
+    def _prefix_of(self, dst):
+        try:
+            return self._prefixes[dst]
+        except KeyError:
+            prefix = self._prefixes[dst] = _parse_prefix(dst)
+            return prefix
+
+    def sync(self, table):
+        """
+        Applies the changes made to `table` since the last sync().
+        """
+        get = table.get
+        for dst in table.take_forwarding_changes():
+            entry = get(dst)
+            if entry is None or entry.latency >= INFINITY:
+                self.set(dst, None)
+            else:
+                self.set(dst, entry.port)
+
+    def rebuild(self, table):
+        """
+        Recompiles the whole table from scratch.
+        """
+        self.__init__()
+        table.take_forwarding_changes()
+        for dst, entry in table.items():
+            if entry.latency < INFINITY:
+                self.set(dst, entry.port)
+
+    def set(self, dst, port):
+        """
+        Sets the port for destination `dst`, or removes it if port is None.
+        """
+        prefix = self._prefix_of(dst)
+        if prefix is None:
+            if self._exact.get(dst) == port:
+                return
+            self._cache.clear()
+            if port is None:
+                del self._exact[dst]
+            else:
+                self._exact[dst] = port
+            return
+
+        # Several destinations may name the same block; the one set most
+        # recently wins, as a later route for the same key would.
+        routes = self._routes.get(prefix)
+        if port is None:
+            if routes is None or dst not in routes:
+                return
+            del routes[dst]
+            if not routes:
+                del self._routes[prefix]
+        else:
+            if routes is None:
+                routes = self._routes[prefix] = {}
+            routes.pop(dst, None)
+            routes[dst] = port
+        port = next(reversed(routes.values())) if routes else None
+
+        version, value, length = prefix
+        width = self._WIDTHS[version]
+        path = self._path(
+            self._roots[version], value, length, width, port is not None
+        )
+        node = path[-1]
+        if node.length != length or node.port == port:
+            return
+        self._cache.clear()
+        node.port = port
+        self._propagate(node, path[-2].fwd if len(path) > 1 else None)
+        if port is None:
+            self._prune(path)
+
+    def _path(self, node, value, length, width, create):
+        """
+        Returns the nodes from `node` down to the one for value/length,
+        inserting it if `create` is set.  Without `create`, the list ends
+        at the deepest existing node on the way.
+        """
+        path = [node]
+        while node.length < length:
+            bit = (value >> (width - node.length - 1)) & 1
+            child = node.children[bit]
+            if child is None:
+                if not create:
+                    return path
+                child = node.children[bit] = _FibNode(value, length, node.fwd)
+                path.append(child)
+                return path
+            shared = min(child.length, length)
+            diff = (child.value ^ value) >> (width - shared) if shared else 0
+            common = shared - diff.bit_length()
+            if common == child.length:
+                node = child
+                path.append(node)
+                continue
+            if not create:
+                return path
+            # The new prefix and `child` part ways at `common`: put a node
+            # there (the new one, if it is that short) above both.
+            if common == length:
+                fork = _FibNode(value, length, node.fwd)
+                path.append(fork)
+            else:
+                mask = ((1 << common) - 1) << (width - common)
+                fork = _FibNode(value & mask, common, node.fwd)
+                leaf = _FibNode(value, length, node.fwd)
+                fork.children[(value >> (width - common - 1)) & 1] = leaf
+                path += [fork, leaf]
+            fork.children[(child.value >> (width - common - 1)) & 1] = child
+            node.children[bit] = fork
+            return path
+        return path
+
+    def _propagate(self, node, inherited):
+        """
+        Updates fwd and installed for `node` and the part of its subtree
+        that inherits from it.
+        """
+        stack = [(node, inherited)]
+        while stack:
+            node, inherited = stack.pop()
+            installed = node.port is not None and node.port != inherited
+            self._installed += installed - node.installed
+            node.installed = installed
+            fwd = node.fwd = node.port if node.port is not None else inherited
+            for child in node.children:
+                if child is None:
+                    continue
+                if child.port is None:
+                    stack.append((child, fwd))
+                else:
+                    child_installed = child.port != fwd
+                    self._installed += child_installed - child.installed
+                    child.installed = child_installed
+
+    def _prune(self, path):
+        """
+        Removes routeless nodes at the end of `path` that no longer split
+        the trie.
+        """
+        while len(path) > 1:
+            node = path.pop()
+            if node.port is not None:
+                return
+            children = [c for c in node.children if c is not None]
+            if len(children) == 2:
+                return
+            parent = path[-1]
+            index = parent.children.index(node)
+            parent.children[index] = children[0] if children else None
+
+    def _remember(self, cache, dst, value):
+        cache[dst] = value
+        if len(cache) > self.CACHE_SIZE:
+            cache.popitem(last=False)
+        return value
+
+    def _address_of(self, dst):
+        address = getattr(dst, "address", None)
+        if address is not None:
+            try:
+                address = ipaddress.ip_address(address)
+            except (ValueError, TypeError):
+                return None, None
+            return address.version, int(address)
+        prefix = self._prefix_of(dst)
+        return prefix[:2] if prefix is not None else (None, None)
+
+    def lookup(self, dst):
+        """
+        Returns the port for packets to `dst`, or None if there is no route.
+        """
+        cache = self._cache
+        try:
+            port = cache[dst]
+        except KeyError:
+            return self._remember(cache, dst, self._lookup(dst))
+        cache.move_to_end(dst)
+        return port
+
+    def _lookup(self, dst):
+        port = self._exact.get(dst)
+        if port is not None or not self._installed:
+            return port
+        addresses = self._addresses
+        try:
+            version, address = addresses[dst]
+            addresses.move_to_end(dst)
+        except KeyError:
+            version, address = self._remember(
+                addresses, dst, self._address_of(dst)
+            )
+        if version is None:
+            return None
+        width = self._WIDTHS[version]
+        node = self._roots[version]
+        fwd = node.fwd
+        while node.length < width:
+            child = node.children[(address >> (width - node.length - 1)) & 1]
+            if child is None or (address ^ child.value) >> (width - child.length):
+                break
+            node = child
+            fwd = node.fwd
+        return fwd
+
+    def entries(self):
+        """
+        Yields (destination or network, port) for each installed route.
+        """
+        for dst, port in self._exact.items():
+            yield dst, port
+        for version, root in self._roots.items():
+            network = ipaddress.IPv4Network if version == 4 else ipaddress.IPv6Network
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                if node.installed:
+                    yield network((node.value, node.length)), node.port
+                stack.extend(c for c in reversed(node.children) if c is not None)
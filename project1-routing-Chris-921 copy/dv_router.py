@@ -8,7 +8,11 @@ Based on skeleton code by:
 import sim.api as api
 from cs168.dv import (
     RoutePacket,
+    RouteBatchPacket,
+    CompactRoutePacket,
     Table,
+    CompactTable,
+    Fib,
     TableEntry,
     DVRouterBase,
     Ports,
@@ -37,6 +41,26 @@ class DVRouter(DVRouterBase):
     # Determines if you send poison when a link goes down
     POISON_ON_LINK_DOWN = False
 
+    # Determines if the timer periodically re-advertises the whole table.
+    # Changes are always sent as triggered updates; the periodic refresh
+    # only repairs lost advertisements and keeps neighbors' routes alive.
+    PERIODIC_FULL_REFRESH = True
+
+    # Minimum number of seconds between two full refreshes.  Timer ticks in
+    # between only send pending changes.  Keep this below ROUTE_TTL, or
+    # neighbors will time out routes that have not changed.
+    FULL_REFRESH_INTERVAL = 0
+
+    # Most routes packed into one RouteBatchPacket (an MTU-like limit).
+    # 1 sends a plain RoutePacket per route, as the original protocol does;
+    # only raise it if every neighbor understands RouteBatchPacket.
+    MAX_ROUTES_PER_PACKET = 1
+
+    # Determines if the table is stored column-wise (CompactTable) and
+    # single-route advertisements use CompactRoutePacket.  Saves memory and
+    # GC time in simulations with very many routers.
+    COMPACT_MODE = False
+
     def __init__(self):
         """
         Called when the instance is initialized.
@@ -55,10 +79,26 @@ class DVRouter(DVRouterBase):
 
         # This is the table that contains all current routes
         self.table = Table()
+        if self.COMPACT_MODE:
+            self.table = CompactTable()
         self.table.owner = self
 
+        # Forwarding table for data packets, compiled from self.table by
+        # longest-prefix match.  Brought up to date lazily, from the
+        # table's changes, when a data packet arrives.
+        self.fib = Fib()
+
+        # Last latency advertised for each destination, per port:
+        # {port: {dst: latency}}.  Used to suppress duplicate advertisements.
         self.route_history = {}
 
+        # When the last full-table refresh was sent (None if never).
+        self.last_full_refresh = None
+
+        # True while a RouteBatchPacket is being unpacked; triggered updates
+        # are held back until the whole batch has been applied.
+        self.deferring_updates = False
+
     def add_static_route(self, host, port):
         """
         Adds a static route to this router's table.
@@ -77,6 +117,7 @@ class DVRouter(DVRouterBase):
         # TODO: fill this in!
         port_latency = self.ports.get_latency(port)
         self.table[host] = TableEntry(dst=host, port=port, latency=port_latency, expire_time=FOREVER)
+        self.triggered_update()
 
     def handle_data_packet(self, packet, in_port):
         """
@@ -91,11 +132,57 @@ class DVRouter(DVRouterBase):
         # TODO: fill this in!
         #If no route exists for a packet’s destination, 
         #do nothing.   if there exists:
-        if packet.dst in self.table:
-            route_entry = self.table[packet.dst]
-            if route_entry.latency < INFINITY:
-                self.send(packet, port=route_entry.port)
+        self.fib.sync(self.table)
+        port = self.fib.lookup(packet.dst)
+        if port is not None:
+            self.send(packet, port=port)
+
+
+    def handle_rx(self, packet, port):
+        """
+        Called by the framework when this router receives a packet.
+
+        Batched advertisements are unpacked into handle_route_advertisement()
+        one route at a time; everything else is handled as before.
+        """
+        if isinstance(packet, RouteBatchPacket):
+            self.deferring_updates = True
+            try:
+                for route_dst, route_latency in packet.routes:
+                    self.handle_route_advertisement(route_dst, route_latency, port)
+            finally:
+                self.deferring_updates = False
+            self.triggered_update()
+        else:
+            super(DVRouter, self).handle_rx(packet, port)
+
+    def triggered_update(self):
+        """
+        Advertises pending table changes, unless a batch is being unpacked.
+        """
+        if not self.deferring_updates:
+            self.send_routes(force=False)
+
+    def handle_timer(self):
+        """
+        Called periodically by the framework.
+
+        Expires stale routes, then advertises.  Whether the advertisement is
+        a full-table refresh or only the pending changes is decided by
+        PERIODIC_FULL_REFRESH and FULL_REFRESH_INTERVAL.
+        """
+        self.expire_routes()
+        self.send_routes(force=self._full_refresh_due())
 
+    def _full_refresh_due(self):
+        """
+        Returns True if the next timer tick should advertise the whole table.
+        """
+        if not self.PERIODIC_FULL_REFRESH:
+            return False
+        if self.last_full_refresh is None:
+            return True
+        return api.current_time() - self.last_full_refresh >= self.FULL_REFRESH_INTERVAL
 
     def send_routes(self, force=False, single_port=None):
         """
@@ -108,51 +195,100 @@ class DVRouter(DVRouterBase):
                             be used in conjunction with handle_link_up.
         :return: nothing.
         """
-        # TODO: fill this in!
-        #Get all ports to send
         if single_port is not None:
             ports_to_send = [single_port]
         else:
             ports_to_send = self.ports.get_all_ports()
 
-        for port in ports_to_send:
-            for route in self.table.values():
-                # broadcast
-                if (force or route in self.changed_routes or self.if_route_changed(route, port)) and (not self.SPLIT_HORIZON or port != route.port):
-                    if self.POISON_REVERSE and route.port == port:  
-                        self.send_route(port, route.dst, INFINITY) 
-                    else:
-                        self.send_route(port, route.dst, route.latency)
-                    self.route_history[(route.dst, port)] = route
-
-    def if_route_changed(self, route, port):
-        """
-        Check if a route has changed since the last advertisement on a specific port.
-        the route & port to check.
-        """
-        key = (route.dst, port)
-        if key in self.route_history:
-            last_route, last_time = self.route_history[key]
-            return route != last_route
-        return True
-    
+        if force:
+            dsts = list(self.table.keys())
+            if single_port is None:
+                # Everything is about to go out on every port, so the
+                # pending changes are covered too.
+                self.table.take_changes()
+                self.last_full_refresh = api.current_time()
+        elif single_port is None:
+            dsts = self.table.take_changes()
+        else:
+            # Other ports still need to hear about these changes, so leave
+            # them pending.
+            dsts = self.table.changed
+
+        outgoing = {port: [] for port in ports_to_send}
+        for dst in dsts:
+            route = self.table.get(dst)
+            if route is None:
+                # The route was removed; forget what we told everyone so a
+                # later route to the same place is always advertised.
+                for history in self.route_history.values():
+                    history.pop(dst, None)
+                continue
+
+            for port in ports_to_send:
+                history = self.route_history.setdefault(port, {})
+                latency = self._advertised_latency(route, port)
+                if latency is None:
+                    history.pop(dst, None)
+                    continue
+                if not force and history.get(dst) == latency:
+                    # Neighbor already has exactly this; nothing to say.
+                    continue
+                outgoing[port].append((dst, latency))
+                history[dst] = latency
+
+        for port, routes in outgoing.items():
+            self._send_advertisements(port, routes)
+
+    def send_route(self, port, dst, latency):
+        """
+        Sends a single route advertisement, compactly if COMPACT_MODE is on.
+        """
+        if self.COMPACT_MODE:
+            self.send(CompactRoutePacket(dst, latency), port=port)
+        else:
+            super(DVRouter, self).send_route(port, dst, latency)
+
+    def _send_advertisements(self, port, routes):
+        """
+        Sends (dst, latency) pairs out of `port`, at most
+        MAX_ROUTES_PER_PACKET of them per packet.
+        """
+        if self.MAX_ROUTES_PER_PACKET <= 1:
+            for dst, latency in routes:
+                self.send_route(port, dst, latency)
+            return
+        for i in range(0, len(routes), self.MAX_ROUTES_PER_PACKET):
+            chunk = routes[i:i + self.MAX_ROUTES_PER_PACKET]
+            if len(chunk) == 1:
+                self.send_route(port, chunk[0][0], chunk[0][1])
+            else:
+                self.send_route_batch(port, chunk)
+
+    def _advertised_latency(self, route, port):
+        """
+        Returns the latency to advertise for `route` out of `port`, or None
+        if split horizon says the route must not be sent there at all.
+        """
+        if route.port == port:
+            if self.SPLIT_HORIZON:
+                return None
+            if self.POISON_REVERSE:
+                return INFINITY
+        return min(route.latency, INFINITY)
+
     def expire_routes(self):
         """
         Clears out expired routes from table.
         accordingly.
         """
         # TODO: fill this in!
-        expired_routes = []
-        for dst, entry in self.table.items():
-            if entry.has_expired:
-                expired_routes.append(dst)
-    
-        for dst in expired_routes:
+        table = self.table
+        for dst in table.take_expired():
             if self.POISON_EXPIRED:
-                route = self.table[dst]
-                self.table[dst] = TableEntry(route.dst, route.port, INFINITY, route.expire_time)
+                if table.latency_of(dst) < INFINITY:
+                    table.set_route(dst, table.port_of(dst), INFINITY, table.expire_time_of(dst))
             else:
-                del self.table[dst]
+                del table[dst]
 
     def handle_route_advertisement(self, route_dst, route_latency, port):
         """
@@ -164,17 +300,24 @@ class DVRouter(DVRouterBase):
         :return: nothing.
         """
         # TODO: fill this in!
+        # The table's field accessors and set_route() don't build a
+        # TableEntry per advertisement (see CompactTable).
+        table = self.table
         total_latency = route_latency + self.ports.get_latency(port)
-        if route_dst in self.table:
-            current_entry = self.table[route_dst]
+        if route_dst in table:
+            current_latency = table.latency_of(route_dst)
              #poisoned route
             if route_latency == INFINITY:
-                self.table[route_dst] = TableEntry(route_dst, port, INFINITY, FOREVER)
-            elif (total_latency < current_entry.latency or
-             (total_latency == current_entry.latency and current_entry.expire_time < api.current_time())) or current_entry.port == port:
-                self.table[route_dst] = TableEntry( route_dst, port, total_latency, api.current_time() + self.ROUTE_TTL,)
+                # Only the next hop can take our route away; poison from
+                # any other neighbor just means it has no better one.
+                if table.port_of(route_dst) == port:
+                    table.set_route(route_dst, port, INFINITY, FOREVER)
+            elif (total_latency < current_latency or
+             (total_latency == current_latency and table.expire_time_of(route_dst) < api.current_time())) or table.port_of(route_dst) == port:
+                table.set_route(route_dst, port, total_latency, api.current_time() + self.ROUTE_TTL)
         else:
-            self.table[route_dst] = TableEntry(route_dst, port, total_latency, api.current_time() + self.ROUTE_TTL,)
+            table.set_route(route_dst, port, total_latency, api.current_time() + self.ROUTE_TTL)
+        self.triggered_update()
 
 
     def handle_link_up(self, port, latency):
@@ -187,9 +330,12 @@ class DVRouter(DVRouterBase):
         """
         self.ports.add_port(port, latency)
 
+        # Whoever is on the other end has not heard anything from us yet.
+        self.route_history.pop(port, None)
+
         # TODO: fill in the rest!
         if self.SEND_ON_LINK_UP:
-            self.send_routes(port)
+            self.send_routes(force=True, single_port=port)
 
     def handle_link_down(self, port):
         """
@@ -199,18 +345,17 @@ class DVRouter(DVRouterBase):
         :returns: nothing.
         """
         self.ports.remove_port(port)
+        self.route_history.pop(port, None)
 
         # TODO: fill this in!
         # Invalidate and poison routes using the link that went down
         # Checking if the current route's next port is the one that went down
-        invalidated_routes = []
-        for dst, entry in self.table.items():
-            if entry.port == port:
-                invalidated_routes.append(dst)
-
-        for dst in invalidated_routes:
+        for dst in self.table.destinations_via(port):
             if self.POISON_ON_LINK_DOWN:
                 self.table[dst] = TableEntry(dst, port, INFINITY, api.current_time() + self.ROUTE_TTL)
-                self.send_route(port, dst, INFINITY)
             else:
                 del self.table[dst]
+
+        # The poison (if any) goes out on the remaining ports.
+        self.triggered_update()
+
@@ -0,0 +1,352 @@
+"""
+Headless discrete-event backend for running DV router simulations
+
+The regular simulator ties routers to wall-clock timers, so reproducing
+something like a ROUTE_TTL expiry storm takes as long in real time as it
+does in simulated time.  This module runs routers with no GUI and no
+sleeping: a heap of pending events is processed in time order and the
+virtual clock jumps straight to the next one.
+
+Everything is deterministic for a given seed.  Events at the same time
+are ordered by a key derived from where they came from (the sending
+router and how many events it has scheduled so far), not by where they
+happen to sit in memory or in which process they run, so the same
+simulation split across several schedulers (see partitioned.py) runs
+events in the same order.  Timer phases come from a random.Random per
+router, seeded from the scheduler's seed and the router's id.
+
+Example:
+  scheduler = Scheduler(seed=1)
+  net = Network(DVRouter, scheduler)
+  with scheduler.installed():
+      a, b = net.add_router(), net.add_router()
+      net.add_link(a, b)
+      net.add_host(a)
+      scheduler.run(until=60)
+"""
+
+import contextlib
+import heapq
+import itertools
+import random
+
+import sim.api as api
+import cs168.dv as dv
+from cs168.dv import RouteBatchPacket
+
+
+# Default interval between a router's handle_timer() calls, in seconds.
+TIMER_INTERVAL = 5
+
+
+class _Event(object):
+    __slots__ = ("when", "f", "args", "cancelled")
+
+    def __init__(self, when, f, args):
+        self.when = when
+        self.f = f
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _Timer(object):
+    """
+    A recurring event, as returned by Scheduler.call_every().
+    """
+
+    def __init__(self, scheduler, interval, f, args, key):
+        self._scheduler = scheduler
+        self.interval = interval
+        self._f = f
+        self._args = args
+        self._key = key
+        self._event = None
+        self.cancelled = False
+
+    def _fire(self):
+        self._event = self._scheduler.call_later(
+            self.interval, self._fire, key=self._key
+        )
+        self._f(*self._args)
+
+    def cancel(self):
+        self.cancelled = True
+        if self._event is not None:
+            self._event.cancel()
+
+
+class Scheduler(object):
+    """
+    A virtual clock plus a heap of events ordered by (time, key, scheduling
+    order)
+
+    Keys are tuples; events without one sort first among events at the
+    same time.
+    """
+
+    def __init__(self, seed=0, start_time=0.0):
+        self.now = start_time
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.events_run = 0
+        self._events = []
+        self._seq = itertools.count()
+
+    def current_time(self):
+        return self.now
+
+    def rng_for(self, name):
+        """
+        Returns a random.Random that depends only on the seed and `name`.
+        """
+        return random.Random("%s/%s" % (self.seed, name))
+
+    def call_at(self, when, f, *args, key=()):
+        """
+        Runs f(*args) at simulated time `when`.  Returns a cancellable event.
+        """
+        event = _Event(max(when, self.now), f, args)
+        heapq.heappush(self._events, (event.when, key, next(self._seq), event))
+        return event
+
+    def call_later(self, delay, f, *args, key=()):
+        return self.call_at(self.now + delay, f, *args, key=key)
+
+    def call_every(self, interval, f, *args, first=None, key=()):
+        """
+        Runs f(*args) every `interval` seconds.
+
+        The first call happens after `first` seconds (defaults to
+        `interval`).  Returns a timer with a cancel() method.
+        """
+        if first is None:
+            first = interval
+        timer = _Timer(self, interval, f, args, key)
+        timer._event = self.call_later(first, timer._fire, key=key)
+        return timer
+
+    def next_time(self):
+        """
+        Returns the time of the next pending event, or None if there is none.
+        """
+        events = self._events
+        while events and events[0][3].cancelled:
+            heapq.heappop(events)
+        return events[0][0] if events else None
+
+    def _run_next(self, t):
+        event = heapq.heappop(self._events)[3]
+        self.now = t
+        self.events_run += 1
+        event.f(*event.args)
+
+    def run_before(self, end):
+        """
+        Runs every event scheduled strictly before `end`.
+        """
+        while True:
+            t = self.next_time()
+            if t is None or t >= end:
+                return
+            self._run_next(t)
+
+    def run(self, until=None, stop_when=None):
+        """
+        Runs events in time order.
+
+        Stops when there are no events left, when the next event is later
+        than `until`, or when stop_when(next_event_time) returns True.  The
+        clock is left at the last event run (or at `until`, if that is what
+        stopped it).
+
+        Returns False if it stopped because of `until`, otherwise True.
+        """
+        while True:
+            t = self.next_time()
+            if t is None:
+                return True
+            if stop_when is not None and stop_when(t):
+                return True
+            if until is not None and t > until:
+                self.now = until
+                return False
+            self._run_next(t)
+
+    @contextlib.contextmanager
+    def installed(self):
+        """
+        Makes api.current_time() (and the copy imported into cs168.dv)
+        return this scheduler's virtual time for the duration of the block.
+        """
+        saved = (api.current_time, dv.current_time)
+        api.current_time = dv.current_time = self.current_time
+        try:
+            yield self
+        finally:
+            api.current_time, dv.current_time = saved
+
+
+class Link(object):
+    """
+    A link between router ports, or from a router port to a host (b is None)
+    """
+
+    def __init__(self, a, a_port, b, b_port, latency):
+        self.a = a
+        self.a_port = a_port
+        self.b = b
+        self.b_port = b_port
+        self.latency = latency
+        self.up = True
+
+
+class _HeadlessRouterMixin(object):
+    """
+    Hooks a router class into a Network instead of the simulator.
+    """
+
+    net = None
+
+    def start_timer(self, interval=None):
+        self.net._start_timer(self, interval)
+
+    def send(self, packet, port=None, flood=False):
+        self.net.transmit(self, port, packet)
+
+
+class _Host(api.HostEntity):
+    def __init__(self, host_id):
+        super(_Host, self).__init__()
+        self.host_id = host_id
+
+    def __repr__(self):
+        return "<host %s>" % (self.host_id,)
+
+
+class Network(object):
+    """
+    Routers and links driven by a Scheduler
+
+    Routers are instances of a subclass of `router_class` whose send() and
+    start_timer() go through this network.  Packets arrive at the far end
+    of a link after its latency (and are lost if the link goes down in the
+    meantime); packets sent to a host are counted and dropped.
+
+    Routers are identified by integer ids (`routers` maps id -> router)
+    and ports are numbered per router in the order links and hosts are
+    added to it.
+    """
+
+    def __init__(self, router_class, scheduler=None, timer_interval=TIMER_INTERVAL):
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.timer_interval = timer_interval
+        self.router_class = type(
+            router_class.__name__,
+            (_HeadlessRouterMixin, router_class),
+            {"net": self},
+        )
+        self.routers = {}  # id -> router
+        self.links = []  # Router-to-router links only
+        self.hosts = {}  # host -> router id
+        self.packets_sent = 0
+        self.routes_advertised = 0
+        self._ids = {}  # id(router object) -> router id
+        self._counters = {}  # router id -> count of events it has scheduled
+        self._ports = {}  # (router id, port) -> Link
+        self._next_port = {}
+        self._creating = None
+
+    def _take_port(self, i):
+        port = self._next_port[i]
+        self._next_port[i] += 1
+        return port
+
+    def _key(self, i):
+        return (i, next(self._counters[i]))
+
+    def add_router(self, router_id=None):
+        """
+        Creates a router and returns its id.
+        """
+        if router_id is None:
+            router_id = len(self.routers)
+        self._next_port[router_id] = 0
+        self._counters[router_id] = itertools.count()
+        self._creating = router_id
+        try:
+            router = self.router_class()
+        finally:
+            self._creating = None
+        self.routers[router_id] = router
+        self._ids[id(router)] = router_id
+        return router_id
+
+    def _start_timer(self, router, interval):
+        if interval is None:
+            interval = self.timer_interval
+        router_id = self._ids.get(id(router), self._creating)
+        first = self.scheduler.rng_for(router_id).uniform(0, interval)
+        self.scheduler.call_every(
+            interval, router.handle_timer, first=first, key=(router_id, -1)
+        )
+
+    def add_link(self, a, b, latency=1):
+        link = Link(a, self._take_port(a), b, self._take_port(b), latency)
+        self._ports[(a, link.a_port)] = link
+        self._ports[(b, link.b_port)] = link
+        self.links.append(link)
+        self.routers[a].handle_link_up(link.a_port, latency)
+        self.routers[b].handle_link_up(link.b_port, latency)
+        return link
+
+    def add_host(self, i, latency=1, host=None):
+        """
+        Attaches a host to router `i` and returns it.
+        """
+        if host is None:
+            host = _Host(len(self.hosts))
+        port = self._take_port(i)
+        self._ports[(i, port)] = Link(i, port, None, None, latency)
+        self.routers[i].handle_link_up(port, latency)
+        self.routers[i].add_static_route(host, port)
+        self.hosts[host] = i
+        return host
+
+    def link_down(self, link):
+        link.up = False
+        self.routers[link.a].handle_link_down(link.a_port)
+        self.routers[link.b].handle_link_down(link.b_port)
+
+    def link_up(self, link):
+        link.up = True
+        self.routers[link.a].handle_link_up(link.a_port, link.latency)
+        self.routers[link.b].handle_link_up(link.b_port, link.latency)
+
+    def _count(self, packet):
+        self.packets_sent += 1
+        if isinstance(packet, RouteBatchPacket):
+            self.routes_advertised += len(packet)
+        elif isinstance(packet, dv.RoutePacket):
+            self.routes_advertised += 1
+
+    def transmit(self, router, port, packet):
+        self._count(packet)
+        i = self._ids[id(router)]
+        key = self._key(i)
+        link = self._ports.get((i, port))
+        if link is None or not link.up or link.b is None:
+            return
+        if i == link.a:
+            peer, peer_port = link.b, link.b_port
+        else:
+            peer, peer_port = link.a, link.a_port
+        self.scheduler.call_later(
+            link.latency, self._deliver, link, peer, peer_port, packet, key=key
+        )
+
+    def _deliver(self, link, peer, peer_port, packet):
+        if link.up:
+            self.routers[peer].handle_rx(packet, peer_port)
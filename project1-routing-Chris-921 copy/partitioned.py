@@ -0,0 +1,496 @@
+"""
+Partitioned, multi-process execution of headless DV simulations
+
+A large topology is split into groups of routers, and each group runs in
+its own worker process on its own headless Scheduler.  Synchronisation is
+conservative: the smallest latency of any link between two groups is the
+lookahead L, and workers advance in windows of L simulated seconds.
+Anything a router sends across a group boundary during a window cannot
+arrive before the window ends, so workers only exchange those packets
+(in one batch per window) at the barrier between windows.
+
+Events are keyed the same way as in a single headless.Network (by origin
+router and per-router count), and timers use per-router random phases,
+so a partitioned run executes every router's events in exactly the same
+order as a single-process run, and ends with identical tables.
+
+Only route advertisements (RoutePacket, CompactRoutePacket and
+RouteBatchPacket) can cross a group boundary; they travel as plain tuples
+with hosts given by id.
+
+Example (from the simulator's root directory):
+  python partitioned.py --topology grid --size 2500 --parts 4 --until 120
+"""
+
+import argparse
+import math
+import multiprocessing
+import time
+import traceback
+
+from cs168.dv import RoutePacket, CompactRoutePacket, RouteBatchPacket
+
+import headless
+
+
+class Topology(object):
+    """
+    Routers 0..node_count-1, links between them and attached hosts
+
+    Ports are assigned up front, the same way headless.Network.add_link()
+    and add_host() would assign them if the links and then the hosts were
+    added in order.
+    """
+
+    def __init__(self, node_count, edges, host_routers, latency=1):
+        self.node_count = node_count
+        self.latency = latency
+        next_port = [0] * node_count
+
+        def take(i):
+            next_port[i] += 1
+            return next_port[i] - 1
+
+        self.links = []  # (a, a_port, b, b_port)
+        for a, b in edges:
+            self.links.append((a, take(a), b, take(b)))
+        self.hosts = []  # (host id, router, port)
+        for host_id, r in enumerate(host_routers):
+            self.hosts.append((host_id, r, take(r)))
+
+
+def partition(node_count, edges, parts):
+    """
+    Assigns each router to one of `parts` groups.
+
+    Routers are put in breadth-first order and the order is cut into
+    equal-sized runs, which keeps neighbors together on mesh-like graphs.
+    Returns a list mapping router -> group.
+    """
+    adjacency = [[] for _ in range(node_count)]
+    for a, b in edges:
+        adjacency[a].append(b)
+        adjacency[b].append(a)
+    seen = [False] * node_count
+    order = []
+    for start in range(node_count):
+        if seen[start]:
+            continue
+        seen[start] = True
+        order.append(start)
+        i = len(order) - 1
+        while i < len(order):
+            for peer in adjacency[order[i]]:
+                if not seen[peer]:
+                    seen[peer] = True
+                    order.append(peer)
+            i += 1
+    size = max(1, int(math.ceil(node_count / float(parts))))
+    owner = [0] * node_count
+    for position, router in enumerate(order):
+        owner[router] = position // size
+    return owner
+
+
+def _encode(packet):
+    if isinstance(packet, RouteBatchPacket):
+        return ("batch", [(dst.host_id, latency) for dst, latency in packet.routes])
+    if isinstance(packet, CompactRoutePacket):
+        return ("compact", packet.destination.host_id, packet.latency)
+    if isinstance(packet, RoutePacket):
+        return ("route", packet.destination.host_id, packet.latency)
+    raise ValueError("%r can't be sent between partitions" % (packet,))
+
+
+class _Partition(headless.Network):
+    """
+    The part of the network owned by one group
+
+    Routers outside the group do not exist here; packets to them are
+    collected in an outbox instead of being scheduled.
+    """
+
+    def __init__(self, router_class, topology, owner, part, seed, timer_interval):
+        super(_Partition, self).__init__(
+            router_class, headless.Scheduler(seed), timer_interval
+        )
+        self.topology = topology
+        self.owner = owner
+        self.part = part
+        self.outbox = []
+        self._hosts_by_id = {}
+        self._link_by_index = {}
+
+    def _host(self, host_id):
+        host = self._hosts_by_id.get(host_id)
+        if host is None:
+            host = self._hosts_by_id[host_id] = headless._Host(host_id)
+        return host
+
+    def _decode(self, encoded):
+        kind = encoded[0]
+        if kind == "batch":
+            return RouteBatchPacket(
+                [(self._host(host_id), latency) for host_id, latency in encoded[1]]
+            )
+        if kind == "compact":
+            return CompactRoutePacket(self._host(encoded[1]), encoded[2])
+        return RoutePacket(self._host(encoded[1]), encoded[2])
+
+    def build(self):
+        """
+        Creates the group's routers, links and hosts.  Returns the outbox.
+        """
+        topology = self.topology
+        for r in range(topology.node_count):
+            if self.owner[r] == self.part:
+                self.add_router(r)
+        for index, (a, a_port, b, b_port) in enumerate(topology.links):
+            if a not in self.routers and b not in self.routers:
+                continue
+            link = headless.Link(a, a_port, b, b_port, topology.latency)
+            self._link_by_index[index] = link
+            self.links.append(link)
+            for r, port in ((a, a_port), (b, b_port)):
+                if r in self.routers:
+                    self._ports[(r, port)] = link
+            for r, port in ((a, a_port), (b, b_port)):
+                if r in self.routers:
+                    self.routers[r].handle_link_up(port, link.latency)
+        for host_id, r, port in topology.hosts:
+            if r not in self.routers:
+                continue
+            host = self._host(host_id)
+            self._ports[(r, port)] = headless.Link(r, port, None, None, topology.latency)
+            self.routers[r].handle_link_up(port, topology.latency)
+            self.routers[r].add_static_route(host, port)
+            self.hosts[host] = r
+        return self.take_outbox()
+
+    def take_outbox(self):
+        outbox, self.outbox = self.outbox, []
+        return outbox
+
+    def transmit(self, router, port, packet):
+        i = self._ids[id(router)]
+        link = self._ports.get((i, port))
+        if link is not None and link.up and link.b is not None:
+            if i == link.a:
+                peer, peer_port = link.b, link.b_port
+            else:
+                peer, peer_port = link.a, link.a_port
+            if peer not in self.routers:
+                self._count(packet)
+                self.outbox.append(
+                    (
+                        self.scheduler.now + link.latency,
+                        self._key(i),
+                        peer,
+                        peer_port,
+                        _encode(packet),
+                    )
+                )
+                return
+        super(_Partition, self).transmit(router, port, packet)
+
+    def step(self, inbound, end, inclusive=False):
+        """
+        Schedules packets from other groups, then runs every event before
+        `end` (or up to and including it, if `inclusive`).  Returns the
+        outbox.
+        """
+        for when, key, peer, peer_port, encoded in inbound:
+            link = self._ports[(peer, peer_port)]
+            self.scheduler.call_at(
+                when, self._deliver, link, peer, peer_port, self._decode(encoded),
+                key=key,
+            )
+        if inclusive:
+            self.scheduler.run(until=end)
+        else:
+            self.scheduler.run_before(end)
+        # Every group's clock must agree before link events at `end`.
+        self.scheduler.now = max(self.scheduler.now, end)
+        return self.take_outbox()
+
+    def set_link_state(self, index, up):
+        """
+        Takes topology link `index` down or brings it back up on whichever
+        ends are in this group.  Returns the outbox.
+        """
+        link = self._link_by_index.get(index)
+        if link is not None:
+            link.up = up
+            for r, port in ((link.a, link.a_port), (link.b, link.b_port)):
+                if r not in self.routers:
+                    continue
+                if up:
+                    self.routers[r].handle_link_up(port, link.latency)
+                else:
+                    self.routers[r].handle_link_down(port)
+        return self.take_outbox()
+
+    def snapshot(self):
+        """
+        Returns ({router: [(host id, port, latency, expire_time), ...]},
+        packets sent, routes advertised).
+        """
+        tables = {}
+        for r, router in self.routers.items():
+            tables[r] = [
+                (dst.host_id, e.port, e.latency, e.expire_time)
+                for dst, e in router.table.items()
+            ]
+        return tables, self.packets_sent, self.routes_advertised
+
+
+class _WorkerError(object):
+    def __init__(self, text):
+        self.text = text
+
+
+def _worker_main(conn, router_class, topology, owner, part, seed, timer_interval):
+    try:
+        p = _Partition(router_class, topology, owner, part, seed, timer_interval)
+        with p.scheduler.installed():
+            conn.send(p.build())
+            while True:
+                method, args = conn.recv()
+                if method is None:
+                    break
+                conn.send(getattr(p, method)(*args))
+    except Exception:
+        conn.send(_WorkerError(traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+class _ProcessWorker(object):
+    def __init__(self, *args):
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_worker_main, args=(child,) + args, daemon=True
+        )
+        self._process.start()
+        child.close()
+
+    def send(self, method, *args):
+        self._conn.send((method, args))
+
+    def recv(self):
+        result = self._conn.recv()
+        if isinstance(result, _WorkerError):
+            raise RuntimeError("partition worker failed:\n" + result.text)
+        return result
+
+    def close(self):
+        try:
+            self._conn.send((None, ()))
+        except (OSError, EOFError):
+            pass
+        self._process.join()
+
+
+class _LocalWorker(object):
+    """
+    Same interface as _ProcessWorker, but runs the partition in this process.
+    """
+
+    def __init__(self, *args):
+        self._partition = _Partition(*args)
+        self._result = self._call("build")
+
+    def _call(self, method, *args):
+        with self._partition.scheduler.installed():
+            return getattr(self._partition, method)(*args)
+
+    def send(self, method, *args):
+        self._result = self._call(method, *args)
+
+    def recv(self):
+        return self._result
+
+    def close(self):
+        pass
+
+
+class PartitionedSimulation(object):
+    """
+    Runs a Topology of `router_class` routers split over `parts` workers.
+
+    With processes=False the partitions run one after another in this
+    process, which is handy for checking results; parts=1 in that mode is
+    an ordinary single-process run.
+    """
+
+    def __init__(self, router_class, topology, parts=2, seed=0,
+                 timer_interval=headless.TIMER_INTERVAL, processes=True):
+        edges = [(a, b) for a, _, b, _ in topology.links]
+        self.owner = partition(topology.node_count, edges, parts)
+        self.parts = max(self.owner) + 1 if self.owner else 1
+        cut = [
+            i for i, (a, _, b, _) in enumerate(topology.links)
+            if self.owner[a] != self.owner[b]
+        ]
+        # Nothing crosses a boundary sooner than this after being sent.
+        self.lookahead = topology.latency if cut else float("inf")
+        self.cut_links = len(cut)
+        self.now = 0.0
+
+        worker_class = _ProcessWorker if processes else _LocalWorker
+        self._workers = [
+            worker_class(router_class, topology, self.owner, part, seed,
+                         timer_interval)
+            for part in range(self.parts)
+        ]
+        self._pending = self._collect()
+
+    def _collect(self):
+        """
+        Gathers every worker's outbox and sorts the packets by destination
+        group.
+        """
+        inbound = [[] for _ in self._workers]
+        for worker in self._workers:
+            for message in worker.recv():
+                inbound[self.owner[message[2]]].append(message)
+        return inbound
+
+    def _broadcast(self, method, *args):
+        for worker in self._workers:
+            worker.send(method, *args)
+        return self._collect()
+
+    def run(self, until):
+        """
+        Runs the simulation up to and including simulated time `until`.
+        """
+        while self.now < until:
+            end = min(self.now + self.lookahead, until)
+            pending = self._pending
+            for worker, inbound in zip(self._workers, pending):
+                worker.send("step", inbound, end)
+            self._pending = self._collect()
+            self.now = end
+        pending = self._pending
+        for worker, inbound in zip(self._workers, pending):
+            worker.send("step", inbound, until, True)
+        self._pending = self._collect()
+
+    def set_link_state(self, index, up):
+        """
+        Takes topology link `index` down (up=False) or back up, at the
+        current simulated time.
+        """
+        for worker, inbound in zip(self._workers, self._pending):
+            worker.send("step", inbound, self.now, True)
+        self._pending = self._collect()
+        outboxes = self._broadcast("set_link_state", index, up)
+        for mine, more in zip(self._pending, outboxes):
+            mine.extend(more)
+
+    def snapshot(self):
+        """
+        Returns ({router: table rows}, packets sent, routes advertised)
+        merged over all workers.
+        """
+        tables = {}
+        packets = routes = 0
+        for worker in self._workers:
+            worker.send("snapshot")
+        for worker in self._workers:
+            t, p, r = worker.recv()
+            tables.update(t)
+            packets += p
+            routes += r
+        return dict(sorted(tables.items())), packets, routes
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+
+
+def run_headless(router_class, topology, seed, half, until, flap=None):
+    """
+    Runs `topology` on a plain headless.Network, with none of the code in
+    this module, taking link `flap` down at `half`.
+
+    Returns the same (tables, packets sent, routes advertised) triple as
+    PartitionedSimulation.snapshot(), as a reference to check it against.
+    """
+    scheduler = headless.Scheduler(seed)
+    net = headless.Network(router_class, scheduler)
+    with scheduler.installed():
+        for _ in range(topology.node_count):
+            net.add_router()
+        links = [
+            net.add_link(a, b, topology.latency)
+            for a, _, b, _ in topology.links
+        ]
+        for host_id, r, _ in topology.hosts:
+            net.add_host(r, topology.latency, headless._Host(host_id))
+        scheduler.run(until=half)
+        if flap is not None:
+            scheduler.now = max(scheduler.now, half)
+            net.link_down(links[flap])
+        scheduler.run(until=until)
+    tables = {}
+    for r, router in sorted(net.routers.items()):
+        tables[r] = [
+            (dst.host_id, e.port, e.latency, e.expire_time)
+            for dst, e in router.table.items()
+        ]
+    return tables, net.packets_sent, net.routes_advertised
+
+
+def main(argv=None):
+    import random
+    import bench_convergence
+    from dv_router import DVRouter
+
+    parser = argparse.ArgumentParser(
+        description="Compare a partitioned DV run with a single-process one"
+    )
+    parser.add_argument("--topology", default="grid",
+                        choices=sorted(bench_convergence.TOPOLOGY_BUILDERS))
+    parser.add_argument("--size", type=int, default=400)
+    parser.add_argument("--hosts", type=int, default=32)
+    parser.add_argument("--parts", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--until", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    node_count, edges = bench_convergence.TOPOLOGY_BUILDERS[args.topology](
+        args.size, rng
+    )
+    hosts = sorted(rng.sample(range(node_count), min(args.hosts, node_count)))
+    topology = Topology(node_count, edges, hosts)
+    flap = rng.randrange(len(edges)) if edges else None
+
+    half = args.until / 2
+    start = time.perf_counter()
+    single = run_headless(DVRouter, topology, args.seed, half, args.until, flap)
+    print("%-12s %3s parts %5s cut links  %8.2f s wall" % (
+        "single", 1, 0, time.perf_counter() - start))
+
+    start = time.perf_counter()
+    sim = PartitionedSimulation(DVRouter, topology, args.parts, args.seed)
+    try:
+        sim.run(half)
+        if flap is not None:
+            sim.set_link_state(flap, False)
+        sim.run(args.until)
+        partitioned = sim.snapshot()
+    finally:
+        sim.close()
+    print("%-12s %3s parts %5s cut links  %8.2f s wall" % (
+        "partitioned", sim.parts, sim.cut_links, time.perf_counter() - start))
+
+    same = single == partitioned
+    print("results match" if same else "RESULTS DIFFER")
+    return 0 if same else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,93 @@
+""" Microbenchmark: reply parsing throughput in packets/sec.
+
+Compares parse_probe_reply() (struct.Struct.unpack_from() at offsets into
+the received buffer, lazily formatted addresses) with the slice-and-copy
+style it replaced, on valid time exceeded replies and on irrelevant
+packets (ICMP echo replies and stray UDP) that the pre-filter rejects
+without building any objects.
+
+Usage: python3 bench_parse.py [packets]
+"""
+import socket
+import struct
+import sys
+import time
+
+from traceroute import parse_probe_reply, probe_reply_offsets
+
+
+def _ipv4(src: str, dst: str, proto: int, payload: bytes) -> bytes:
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 0, 0,
+                       64, proto, 0, socket.inet_aton(src),
+                       socket.inet_aton(dst)) + payload
+
+
+def _time_exceeded(router: str, dst: str, port: int) -> bytes:
+    probe = _ipv4('10.0.0.1', dst, 17, struct.pack('!HHHH', 40000, port, 8, 0))
+    return _ipv4(router, '10.0.0.1', 1, struct.pack('!BBHI', 11, 0, 0, 0) + probe)
+
+
+class _SlicedHeader:
+    """ The previous style: a copy of the header, every field eagerly. """
+
+    def __init__(self, buffer: bytes, fmt: str, names: tuple[str, ...]):
+        buffer = buffer[:struct.calcsize(fmt)]
+        for name, value in zip(names, struct.unpack(fmt, buffer)):
+            if isinstance(value, bytes):
+                value = socket.inet_ntoa(value)
+            setattr(self, name, value)
+
+
+def _sliced_parse(buf: bytes):
+    outer = _SlicedHeader(buf, '!BBHHHBBH4s4s',
+                          ('vhl', 'tos', 'length', 'id', 'ff', 'ttl', 'proto',
+                           'cksum', 'src', 'dst'))
+    if outer.proto != 1:
+        return None
+    hl = (outer.vhl & 0xF) * 4
+    icmp = _SlicedHeader(buf[hl:], '!BBH', ('type', 'code', 'cksum'))
+    if icmp.type not in (3, 11):
+        return None
+    inner = _SlicedHeader(buf[hl + 8:], '!BBHHHBBH4s4s',
+                          ('vhl', 'tos', 'length', 'id', 'ff', 'ttl', 'proto',
+                           'cksum', 'src', 'dst'))
+    udp = _SlicedHeader(buf[hl + 8 + (inner.vhl & 0xF) * 4:], '!HHHH',
+                        ('src_port', 'dst_port', 'len', 'cksum'))
+    return icmp, inner, udp
+
+
+def _rate(f, packets: list[bytes]) -> float:
+    start = time.perf_counter()
+    for buf in packets:
+        f(buf)
+    return len(packets) / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    replies = [_time_exceeded(f'192.0.2.{i % 200}', '198.51.100.7', 33435 + i % 30)
+               for i in range(count)]
+    echo = _ipv4('192.0.2.1', '10.0.0.1', 1, struct.pack('!BBHI', 0, 0, 0, 0))
+    stray = _ipv4('192.0.2.1', '10.0.0.1', 17, struct.pack('!HHHH', 53, 9, 8, 0))
+    irrelevant = [echo, stray] * (count // 2)
+
+    def parse_and_match(buf):
+        icmp, inner, udp = parse_probe_reply(buf)
+        return inner.dst, udp.dst_port
+
+    def sliced_and_match(buf):
+        icmp, inner, udp = _sliced_parse(buf)
+        return inner.dst, udp.dst_port
+
+    rows = [
+        ('replies, slice and copy', _rate(sliced_and_match, replies)),
+        ('replies, unpack_from', _rate(parse_and_match, replies)),
+        ('irrelevant, slice and copy', _rate(_sliced_parse, irrelevant)),
+        ('irrelevant, pre-filter', _rate(probe_reply_offsets, irrelevant)),
+    ]
+    for name, rate in rows:
+        print(f'{name:>28} {rate:>14,.0f} packets/sec')
+
+
+if __name__ == '__main__':
+    main()
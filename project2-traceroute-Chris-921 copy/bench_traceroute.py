@@ -0,0 +1,175 @@
+""" Benchmark: probes sent and (virtual) time taken by each traceroute mode.
+
+Runs traceroute(), traceroute_parallel() and traceroute_adaptive() against
+the emulator, first on every spec scenario in emulator.SCENARIOS (checking
+each result against the expected one), then on `traces` random paths of
+5 to 20 hops with some multipath hops, silent routers and dropped replies.
+Then runs traceroute_multipath() on every scenario in
+emulator.MULTIPATH_SCENARIOS, checking that it finds every router.  Last,
+compares traceroute_adaptive() of every destination in a tree of 20 hosts
+in 4 /24s with traceroute_doubletree() of the same destinations.
+Times are in the emulator's virtual seconds; the wall clock time of the
+whole run is printed at the end.
+
+Usage: python3 bench_traceroute.py [traces] [seed]
+"""
+import random
+import sys
+import time
+
+import traceroute
+from emulator import MULTIPATH_SCENARIOS, SCENARIOS, Emulator, Topology
+
+MODES = {
+    'sequential': lambda emulator, send, recv, ip:
+        traceroute.traceroute(send, recv, ip),
+    'parallel': lambda emulator, send, recv, ip:
+        traceroute.traceroute_parallel(send, recv, ip),
+    'adaptive': lambda emulator, send, recv, ip:
+        traceroute.traceroute_adaptive(send, recv, ip,
+                                       max_silent=traceroute.TRACEROUTE_MAX_TTL,
+                                       clock=emulator.clock).path,
+}
+
+
+def _same(path: list[list[str]], expected: list[list[str]]) -> bool:
+    return [sorted(hop) for hop in path] == [sorted(hop) for hop in expected]
+
+
+def _run(mode, topology: Topology, ip: str) \
+        -> tuple[list[list[str]], Emulator]:
+    emulator = Emulator(topology)
+    path = mode(emulator, emulator.make_udp(), emulator.make_icmp(), ip)
+    return path, emulator
+
+
+def _random_topology(rng: random.Random, ip: str) \
+        -> tuple[Topology, list[list[str]]]:
+    hops = [[f'172.16.{i}.{j + 1}'
+             for j in range(2 if rng.random() < 0.15 else 1)]
+            for i in range(rng.randint(5, 20))]
+    topology = Topology.chain(hops, ip, balancing='packet')
+    for hop in hops:
+        for address in hop:
+            r = rng.random()
+            if r < 0.05:
+                topology.nodes[address].silent = True
+            elif r < 0.15 and len(hop) == 1:
+                # Dropping on a multipath hop could hide a router for good.
+                topology.nodes[address].faults = {'drop': rng.randint(1, 2)}
+    expected = [[a for a in hop if not topology.nodes[a].silent]
+                for hop in hops]
+    return topology, expected + [[ip]]
+
+
+def _bench_multipath():
+    print(f"\n{'multipath scenario':36}{'correct':>10}{'probes':>10}"
+          f"{'virtual s':>12}")
+    for name, (build, expected) in MULTIPATH_SCENARIOS.items():
+        topology, ip = build()
+        emulator = Emulator(topology)
+        result = traceroute.traceroute_multipath(
+            emulator.make_udp(), emulator.make_icmp(), ip)
+        ok = 'ok' if _same(result.path, expected) else 'WRONG'
+        print(f'{name:36}{ok:>10}{emulator.probes_sent:>10}'
+              f'{emulator.now:>12.2f}')
+
+
+def _tree_topology() -> tuple[Topology, dict[str, list[list[str]]]]:
+    # A 6 hop core, then 3 hops per /24, then an extra hop for odd hosts.
+    topology = Topology()
+    core = [f'10.1.0.{i}' for i in range(1, 7)]
+    paths = {}
+    previous = topology.source
+    for address in core:
+        topology.add_router(address)
+        topology.add_link(previous, address)
+        previous = address
+    for a in range(4):
+        branch = [f'11.{a}.0.{i}' for i in range(3)]
+        previous = core[-1]
+        for address in branch:
+            topology.add_router(address)
+            topology.add_link(previous, address)
+            previous = address
+        for b in range(5):
+            ip = f'20.{a}.0.{b}'
+            hops = core + branch
+            topology.add_host(ip)
+            if b % 2:
+                topology.add_router(f'12.{a}.{b}.1')
+                topology.add_link(branch[-1], f'12.{a}.{b}.1')
+                topology.add_link(f'12.{a}.{b}.1', ip)
+                hops = hops + [f'12.{a}.{b}.1']
+            else:
+                topology.add_link(branch[-1], ip)
+            paths[ip] = [[address] for address in hops] + [[ip]]
+    return topology, paths
+
+
+def _bench_doubletree():
+    print('\ntree of 20 destinations in 4 /24s:')
+    print(f"{'mode':24}{'correct':>10}{'probes':>10}{'virtual s':>12}")
+    topology, paths = _tree_topology()
+    emulator = Emulator(topology)
+    correct = 0
+    for ip, expected in paths.items():
+        result = traceroute.traceroute_adaptive(
+            emulator.make_udp(), emulator.make_icmp(), ip,
+            clock=emulator.clock)
+        correct += _same(result.path, expected)
+    print(f"{'adaptive':24}{correct:>10}{emulator.probes_sent:>10}"
+          f'{emulator.now:>12.2f}')
+    for prefix_len in (24, 0):
+        emulator = Emulator(topology)
+        stop_set = traceroute.StopSet(prefix_len)
+        correct = sum(_same(result.path, paths[ip])
+                      for ip, result in traceroute.traceroute_doubletree(
+                          emulator.make_udp(), emulator.make_icmp(),
+                          list(paths), stop_set, clock=emulator.clock))
+        print(f"{f'doubletree /{prefix_len}':24}{correct:>10}"
+              f'{emulator.probes_sent:>10}{emulator.now:>12.2f}')
+
+
+def main():
+    traces = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    wall = time.perf_counter()
+
+    print(f"{'scenario':36}" + ''.join(f'{name:>24}' for name in MODES))
+    for name, (build, expected) in SCENARIOS.items():
+        row = []
+        for mode in MODES.values():
+            topology, ip = build()
+            path, emulator = _run(mode, topology, ip)
+            ok = 'ok' if _same(path, expected) else 'WRONG'
+            row.append(f'{ok:>6} {emulator.probes_sent:4d}p '
+                       f'{emulator.now:8.2f}s')
+        print(f'{name:36}' + ''.join(f'{cell:>24}' for cell in row))
+
+    print(f'\n{traces} random paths:')
+    print(f"{'mode':12}{'correct':>10}{'probes':>10}{'timeouts':>10}"
+          f"{'virtual s':>12}{'s/trace':>10}")
+    for name, mode in MODES.items():
+        rng = random.Random(seed)
+        correct = probes = timeouts = 0
+        elapsed = 0.0
+        for i in range(traces):
+            ip = f'198.51.{i // 250}.{i % 250 + 1}'
+            topology, expected = _random_topology(rng, ip)
+            path, emulator = _run(mode, topology, ip)
+            correct += _same(path, expected)
+            probes += emulator.probes_sent
+            timeouts += emulator.timeouts
+            elapsed += emulator.now
+        print(f'{name:12}{correct:>10}{probes:>10}{timeouts:>10}'
+              f'{elapsed:>12.1f}{elapsed / traces:>10.3f}')
+
+    _bench_multipath()
+    _bench_doubletree()
+
+    print(f'\nwall clock: {time.perf_counter() - wall:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+""" Decodes many captured ICMP replies at once, one column per header field.
+
+Replaying a capture through IPv4/ICMP/UDP one packet at a time spends
+nearly all of its time in the interpreter.  decode() instead takes a whole
+batch of packets, either one buffer of fixed-size records or a list of
+buffers, and returns the fields of every packet as columns: the outer IPv4
+header, the ICMP header, and the IPv4 and UDP headers of the probe quoted
+inside it.  With NumPy installed the result is a structured array and all
+of the work is vectorised; without it the columns are array.array objects
+filled by a plain loop.
+
+A packet's `valid` field says whether it is a reply to a UDP probe, by the
+same rules as traceroute.probe_reply_offsets(); the other fields of invalid
+packets may be zero.  Addresses are unsigned 32-bit integers.
+
+Example:
+    table = decode(buffers)
+    hops = routers_by_ttl(table, inner_dst='198.51.100.7')
+    # {probe ttl: [router address, ...]}
+"""
+import array
+import socket
+import struct
+
+from traceroute import (ICMP_HEADER_LEN, TRACEROUTE_MAX_TTL,
+                        TRACEROUTE_PORT_NUMBER, UDP_HEADER_LEN,
+                        probe_reply_offsets)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# (name, NumPy type, array.array type code)
+FIELDS = (
+    ('length', 'u4', 'L'),
+    ('header_len', 'u1', 'B'),
+    ('proto', 'u1', 'B'),
+    ('frag_offset', 'u2', 'H'),
+    ('ttl', 'u1', 'B'),
+    ('src', 'u4', 'L'),
+    ('dst', 'u4', 'L'),
+    ('icmp_type', 'u1', 'B'),
+    ('icmp_code', 'u1', 'B'),
+    ('inner_header_len', 'u1', 'B'),
+    ('inner_proto', 'u1', 'B'),
+    ('inner_ttl', 'u1', 'B'),
+    ('inner_src', 'u4', 'L'),
+    ('inner_dst', 'u4', 'L'),
+    ('src_port', 'u2', 'H'),
+    ('dst_port', 'u2', 'H'),
+    ('udp_len', 'u2', 'H'),
+    ('valid', '?', 'B'),
+)
+
+_OUTER = struct.Struct('!BxxxxxHBBxxII')
+_QUOTE = struct.Struct('!BxxxxxxxBBxxII')
+_PORTS = struct.Struct('!HHH')
+
+
+def decode(packets, stride: int | None = None, use_numpy: bool | None = None):
+    """ Decodes a batch of packets into columns.
+
+    Arguments:
+    packets -- A list of buffers, one per packet, or a single buffer holding
+        packets back to back in records of `stride` bytes each (shorter
+        packets padded, e.g. a capture with a fixed snap length).
+    stride -- Record size when `packets` is a single buffer.
+    use_numpy -- Force (True) or avoid (False) NumPy; by default it's used
+        when available.
+
+    Returns a NumPy structured array with the FIELDS as its fields, or a
+    dict of field name -> array.array.
+    """
+    if use_numpy is None:
+        use_numpy = np is not None
+    if use_numpy:
+        return _decode_numpy(packets, stride)
+    return _decode_loop(packets, stride)
+
+
+def _records(packets, stride):
+    if stride is None:
+        return list(packets)
+    view = memoryview(packets)
+    return [view[i:i + stride] for i in range(0, len(view) - stride + 1, stride)]
+
+
+def _decode_loop(packets, stride):
+    columns = {name: array.array(code) for name, _, code in FIELDS}
+    appends = [columns[name].append for name, _, _ in FIELDS]
+    for buf in _records(packets, stride):
+        row = [len(buf)] + [0] * (len(FIELDS) - 1)
+        if len(buf) >= 20:
+            vhl, ff, row[4], row[2], row[5], row[6] = _OUTER.unpack_from(buf)
+            row[1] = (vhl & 0xF) * 4
+            row[3] = ff & 0x1FFF
+            offsets = probe_reply_offsets(buf)
+            if offsets is not None:
+                icmp_start, quote_start, udp_start = offsets
+                row[7], row[8] = buf[icmp_start], buf[icmp_start + 1]
+                vhl, row[11], row[10], row[12], row[13] = \
+                    _QUOTE.unpack_from(buf, quote_start)
+                row[9] = (vhl & 0xF) * 4
+                row[14], row[15], row[16] = _PORTS.unpack_from(buf, udp_start)
+                row[17] = 1
+        for append, value in zip(appends, row):
+            append(value)
+    return columns
+
+
+def _decode_numpy(packets, stride):
+    if stride is None:
+        packets = list(packets)
+        lengths = np.fromiter((len(p) for p in packets), dtype=np.int64,
+                              count=len(packets))
+        starts = np.cumsum(lengths) - lengths
+        flat = np.frombuffer(b''.join(packets), dtype=np.uint8)
+    else:
+        flat = np.frombuffer(packets, dtype=np.uint8)
+        starts = np.arange(len(flat) // stride, dtype=np.int64) * stride
+        lengths = np.full(len(starts), stride, dtype=np.int64)
+
+    count = len(starts)
+    table = np.zeros(count, dtype=[(name, t) for name, t, _ in FIELDS])
+    table['length'] = lengths
+    if not count:
+        return table
+    # Each header is gathered for every packet at once by fancy indexing
+    # from the packets' starts.  Reads past the end of a short packet land
+    # in the next packet (or in the padding after the last one); the length
+    # checks below decide whether a field counts.
+    flat = np.concatenate([flat, np.zeros(ICMP_HEADER_LEN + 2 * 60 + 8,
+                                          dtype=np.uint8)])
+
+    # Row i of `windows` is a view of the bytes from flat[i] on.
+    windows = np.lib.stride_tricks.sliding_window_view(
+        flat, ICMP_HEADER_LEN + 20)
+
+    def gather(offsets, size):
+        return windows[starts + offsets, :size]
+
+    def u16(cols, i):
+        return (cols[:, i].astype(np.int64) << 8) | cols[:, i + 1]
+
+    def u32(cols, i):
+        return (u16(cols, i) << 16) | u16(cols, i + 2)
+
+    outer = gather(0, 20)
+    has_header = lengths >= 20
+    header_len = (outer[:, 0] & 0xF).astype(np.int64) * 4
+    frag_offset = u16(outer, 6) & 0x1FFF
+    proto = outer[:, 9]
+
+    # Same rules as probe_reply_offsets().
+    icmp_start = np.minimum(header_len, 60)
+    quote_start = icmp_start + ICMP_HEADER_LEN
+    icmp = gather(icmp_start, ICMP_HEADER_LEN + 20)
+    icmp_type = icmp[:, 0]
+    icmp_code = icmp[:, 1]
+    quote = icmp[:, ICMP_HEADER_LEN:]
+    inner_header_len = (quote[:, 0] & 0xF).astype(np.int64) * 4
+    udp_start = quote_start + inner_header_len
+    udp = gather(udp_start, 6)
+    valid = (has_header & (proto == 1) & (frag_offset == 0)
+             & (header_len >= 20) & (lengths >= quote_start + 20)
+             & ((icmp_type == 3) | ((icmp_type == 11) & (icmp_code == 0)))
+             & (quote[:, 9] == 17) & (inner_header_len >= 20)
+             & (lengths >= udp_start + UDP_HEADER_LEN))
+
+    columns = {
+        'header_len': (has_header, header_len),
+        'proto': (has_header, proto),
+        'frag_offset': (has_header, frag_offset),
+        'ttl': (has_header, outer[:, 8]),
+        'src': (has_header, u32(outer, 12)),
+        'dst': (has_header, u32(outer, 16)),
+        'icmp_type': (valid, icmp_type),
+        'icmp_code': (valid, icmp_code),
+        'inner_header_len': (valid, inner_header_len),
+        'inner_proto': (valid, quote[:, 9]),
+        'inner_ttl': (valid, quote[:, 8]),
+        'inner_src': (valid, u32(quote, 12)),
+        'inner_dst': (valid, u32(quote, 16)),
+        'src_port': (valid, u16(udp, 0)),
+        'dst_port': (valid, u16(udp, 2)),
+        'udp_len': (valid, u16(udp, 4)),
+    }
+    for name, (mask, values) in columns.items():
+        table[name] = np.where(mask, values, 0)
+    table['valid'] = valid
+    return table
+
+
+def routers_by_ttl(table, base_port: int = TRACEROUTE_PORT_NUMBER,
+                   inner_dst: int | str | None = None) \
+        -> dict[int, list[int]]:
+    """ Groups the routers that sent valid replies by probe TTL.
+
+    The TTL of a probe is taken from its quoted destination port, as
+    traceroute_parallel() encodes it (base_port + ttl); replies whose port
+    gives a TTL outside [1, TRACEROUTE_MAX_TTL] don't quote one of our
+    probes and are left out.  With `inner_dst` (an address, as an integer
+    or a dotted string), so are replies quoting probes to anywhere else.
+    Returns {ttl: sorted router addresses}.
+    """
+    if isinstance(inner_dst, str):
+        inner_dst = struct.unpack('!I', socket.inet_aton(inner_dst))[0]
+    if np is not None and isinstance(table, np.ndarray):
+        ttls = table['dst_port'].astype(np.int64) - base_port
+        ours = table['valid'] & (ttls >= 1) & (ttls <= TRACEROUTE_MAX_TTL)
+        if inner_dst is not None:
+            ours &= table['inner_dst'] == inner_dst
+        # One sortable key per (ttl, router) pair.
+        keys = np.unique((ttls[ours] << 32) | table['src'][ours])
+        ttls, first = np.unique(keys >> 32, return_index=True)
+        groups = np.split(keys & 0xFFFFFFFF, first[1:])
+        return {int(t): g.tolist() for t, g in zip(ttls, groups)}
+    hops: dict[int, set[int]] = {}
+    for valid, port, src, dst in zip(table['valid'], table['dst_port'],
+                                     table['src'], table['inner_dst']):
+        ttl = port - base_port
+        if valid and 1 <= ttl <= TRACEROUTE_MAX_TTL \
+                and (inner_dst is None or dst == inner_dst):
+            hops.setdefault(ttl, set()).add(src)
+    return {ttl: sorted(hops[ttl]) for ttl in sorted(hops)}
@@ -0,0 +1,469 @@
+""" A deterministic, in-process network to run traceroute against.
+
+Emulator.make_udp() and Emulator.make_icmp() return sockets with the same
+interface as util.Socket (set_ttl(), sendto(), recv_select(), recvfrom()),
+so any of the traceroute functions can be pointed at a Topology instead of
+the internet.  Nothing really waits: the emulator keeps a virtual clock
+that recv_select() moves straight to the next reply (or forward by its
+timeout, if there is none), so thousands of traces take seconds, and
+Emulator.clock() gives the functions that take a `clock` the same time.
+
+A Topology is a graph of routers and hosts.  Probes follow shortest paths
+to their destination (or the routes set with set_route(), e.g. for loops
+or destinations that don't exist), choosing among equal-cost next hops per
+flow (Paris style, by a hash of the addresses and ports) or per packet
+(round-robin).  Routers can be silent, and can misbehave in the ways the
+project spec describes, through `faults`: a dict of fault name -> how many
+of the first probes that expire at the router it applies to (None: all).
+
+    drop -- No reply.
+    dup_probe, dup_reply -- Two replies instead of one.
+    late_probe, late_reply -- An extra reply, `late_delay` seconds later.
+    ip_options -- IPv4 options in the reply's header (still valid).
+    icmp_type, icmp_code -- An ICMP type other than 3 or 11, or time
+        exceeded with a code other than 0, instead of the reply.
+    udp -- A UDP packet instead of the reply.
+    garbage -- An IPv4 packet with a random payload instead.
+    ip_proto -- The reply with a protocol other than ICMP.
+    frag_offset -- The reply with a non-zero fragment offset.
+    truncated -- The reply cut short.
+    irrelevant_ttl -- A valid time exceeded for a probe someone else sent.
+
+SCENARIOS has the spec's example topologies, with their expected results;
+MULTIPATH_SCENARIOS has load-balanced ones for traceroute_multipath().
+
+Example:
+    emulator = Emulator(Topology.chain([['2.2.2.2'], ['3.3.3.3']],
+                                       '4.4.4.4'))
+    path = traceroute(emulator.make_udp(), emulator.make_icmp(), '4.4.4.4')
+"""
+import collections
+import hashlib
+import heapq
+import itertools
+import random
+import socket
+import struct
+from typing import Callable
+
+_IPV4 = struct.Struct('!BBHHHBBH4s4s')
+_ICMP = struct.Struct('!BBHI')
+_UDP = struct.Struct('!HHHH')
+
+# Invalid replies, in the order they take precedence if several apply.
+_REPLACING_FAULTS = ('icmp_type', 'icmp_code', 'udp', 'garbage', 'ip_proto',
+                     'frag_offset', 'truncated', 'irrelevant_ttl')
+FAULTS = ('drop', 'dup_probe', 'dup_reply', 'late_probe', 'late_reply',
+          'ip_options') + _REPLACING_FAULTS
+
+
+def _ipv4(src: str, dst: str, proto: int, payload: bytes, ttl: int = 64,
+          options: bytes = b'', frag_offset: int = 0) -> bytes:
+    header_len = 20 + len(options)
+    return _IPV4.pack(0x40 | header_len // 4, 0, header_len + len(payload), 0,
+                      frag_offset, ttl, proto, 0, socket.inet_aton(src),
+                      socket.inet_aton(dst)) + options + payload
+
+
+class Router:
+    """ A router or host in a Topology.
+
+    Hosts answer probes addressed to them with port unreachable; routers
+    answer probes whose TTL runs out at them with time exceeded.  A silent
+    one never answers.  See the module docstring for `faults`.
+    """
+
+    def __init__(self, address: str, host: bool = False, silent: bool = False,
+                 faults: dict[str, int | None] | None = None):
+        for fault in faults or ():
+            if fault not in FAULTS:
+                raise ValueError(f"unknown fault {fault!r}")
+        self.address = address
+        self.host = host
+        self.silent = silent
+        self.faults = dict(faults or {})
+
+
+class Topology:
+    """ Routers, hosts and the links between them.
+
+    `source` is the address traceroute runs on; it's linked to the first
+    routers like any other node.  Link latencies are one way, in seconds.
+    `balancing` is 'flow' or 'packet' (see the module docstring).
+    """
+
+    def __init__(self, source: str = '10.0.0.1', balancing: str = 'flow'):
+        if balancing not in ('flow', 'packet'):
+            raise ValueError(f"unknown balancing {balancing!r}")
+        self.source = source
+        self.balancing = balancing
+        self.nodes: dict[str, Router] = {}
+        self._links: dict[str, dict[str, float]] = {source: {}}
+        self._routes: dict[tuple[str, str | None], list[str]] = {}
+        self._next_hops: dict[str, dict[str, list[str]]] = {}
+
+    def add_router(self, address: str, **kw) -> Router:
+        self.nodes[address] = router = Router(address, **kw)
+        self._links.setdefault(address, {})
+        self._next_hops.clear()
+        return router
+
+    def add_host(self, address: str, **kw) -> Router:
+        return self.add_router(address, host=True, **kw)
+
+    def add_link(self, a: str, b: str, latency: float = 0.005):
+        self._links[a][b] = latency
+        self._links[b][a] = latency
+        self._next_hops.clear()
+
+    def set_route(self, router: str, dst: str | None, next_hops: list[str]):
+        """ Sends probes for `dst` (None: any destination without another
+        route) from `router` (or the source) to `next_hops`. """
+        self._routes[(router, dst)] = list(next_hops)
+
+    def latency(self, a: str, b: str) -> float:
+        return self._links[a].get(b, 0.005)
+
+    def next_hops(self, node: str, dst: str) -> list[str]:
+        """ Where `node` forwards probes for `dst`.  Set routes come first,
+        then shortest paths to a host, then default routes. """
+        route = self._routes.get((node, dst))
+        if route is not None:
+            return route
+        target = self.nodes.get(dst)
+        if target is not None and target.host:
+            if dst not in self._next_hops:
+                self._next_hops[dst] = self._shortest_paths(dst)
+            return self._next_hops[dst].get(node, [])
+        return self._routes.get((node, None), [])
+
+    def _shortest_paths(self, dst: str) -> dict[str, list[str]]:
+        # Hop counts from dst, then every neighbour one hop closer.
+        distance = {dst: 0}
+        queue = collections.deque([dst])
+        while queue:
+            node = queue.popleft()
+            if node != dst and self.nodes.get(node, None) is not None \
+                    and self.nodes[node].host:
+                continue  # Hosts don't forward.
+            for peer in self._links[node]:
+                if peer not in distance:
+                    distance[peer] = distance[node] + 1
+                    queue.append(peer)
+        return {node: [peer for peer in self._links[node]
+                       if distance.get(peer, -1) == distance[node] - 1]
+                for node in distance if node != dst}
+
+    @classmethod
+    def chain(cls, hops: list[list[str]], dst: str | None = None,
+              source: str = '10.0.0.1', balancing: str = 'flow',
+              latency: float = 0.005, **hosts) -> 'Topology':
+        """ Builds a path of routers, one list of routers per hop.
+
+        Each router is linked to every router of the next hop, so a hop
+        with several routers is multipath.  The last hop leads to host
+        `dst`, if given; probes for any other destination also follow the
+        chain (as default routes) and are dropped after its last hop.
+        Keyword arguments are passed to add_host() for `dst`.
+        """
+        topology = cls(source, balancing)
+        previous = [source]
+        for hop in hops:
+            for address in hop:
+                if address not in topology.nodes:
+                    topology.add_router(address)
+            for a in previous:
+                topology.set_route(a, None, hop)
+                for b in hop:
+                    topology.add_link(a, b, latency)
+            previous = hop
+        if dst is not None:
+            topology.add_host(dst, **hosts)
+            for a in previous:
+                topology.add_link(a, dst, latency)
+        return topology
+
+
+class Emulator:
+    """ Runs a Topology on virtual time.
+
+    Arguments:
+    timeout -- How long recv_select() waits for a reply, in virtual
+        seconds.
+    late_delay -- How much later the late_* faults' extra replies arrive.
+    jitter -- Up to this much random delay is added to each reply.
+    seed -- Seeds everything random (jitter and the fault payloads), so
+        runs are repeatable.
+
+    Counts probes_sent, replies_sent and timeouts (recv_select() calls
+    that returned False).
+    """
+
+    def __init__(self, topology: Topology, timeout: float = 1.0,
+                 late_delay: float = 2.5, jitter: float = 0.0, seed: int = 0):
+        self.topology = topology
+        self.timeout = timeout
+        self.late_delay = late_delay
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.probes_sent = 0
+        self.replies_sent = 0
+        self.timeouts = 0
+        self._receivers: list[EmulatedSocket] = []
+        self._ports = itertools.count(40000)
+        self._turns: dict[str, int] = collections.defaultdict(int)
+        self._seen: dict[str, int] = collections.defaultdict(int)
+
+    def make_udp(self) -> 'EmulatedSocket':
+        return EmulatedSocket(self, next(self._ports))
+
+    def make_icmp(self) -> 'EmulatedSocket':
+        sock = EmulatedSocket(self, 0)
+        self._receivers.append(sock)
+        return sock
+
+    def clock(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += max(0.0, seconds)
+
+    def _choose(self, node: str, hops: list[str], flow: tuple) -> str:
+        if len(hops) == 1:
+            return hops[0]
+        if self.topology.balancing == 'packet':
+            self._turns[node] += 1
+            return hops[self._turns[node] % len(hops)]
+        # Not crc32: it's affine, so the choices at different hops would
+        # depend on each other and some paths would never be taken.
+        key = '|'.join(map(str, (node,) + flow)).encode()
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        return hops[int.from_bytes(digest, 'big') % len(hops)]
+
+    def _send(self, sport: int, ttl: int, payload: bytes, addr: tuple[str, int]):
+        self.probes_sent += 1
+        dst, dport = addr
+        topology = self.topology
+        flow = (topology.source, sport, dst, dport)
+        node = topology.source
+        one_way = 0.0
+        for hop in range(1, min(ttl, 255) + 1):
+            hops = topology.next_hops(node, dst)
+            if not hops:
+                return  # No route.
+            peer = self._choose(node, hops, flow)
+            one_way += topology.latency(node, peer)
+            node = peer
+            router = topology.nodes[node]
+            if node == dst or (hop == ttl and not router.host):
+                break
+            if router.host:
+                return  # Hosts don't forward.
+        else:
+            return
+        udp = _UDP.pack(sport, dport, _UDP.size + len(payload), 0) + payload
+        probe = _ipv4(topology.source, dst, 17, udp, ttl=1)
+        self._reply(topology.nodes[node], node == dst, probe, 2 * one_way)
+
+    def _reply(self, router: Router, at_dst: bool, probe: bytes, rtt: float):
+        self._seen[router.address] += 1
+        count = self._seen[router.address]
+        if router.silent:
+            return
+        faults = {fault for fault, first in router.faults.items()
+                  if first is None or count <= first}
+        if 'drop' in faults:
+            return
+
+        icmp_type, code = (3, 3) if at_dst else (11, 0)
+        source = self.topology.source
+        options = b''
+        if 'ip_options' in faults:
+            options = b'\x01' * (4 * self.rng.randint(1, 10))
+        quote = probe[:28]
+        reply = _ipv4(router.address, source, 1,
+                      _ICMP.pack(icmp_type, code, 0, 0) + quote,
+                      options=options)
+        for fault in _REPLACING_FAULTS:
+            if fault in faults:
+                reply = self._invalid(fault, router.address, quote, reply)
+                break
+
+        arrivals = [rtt]
+        if 'dup_probe' in faults:
+            arrivals.append(rtt)
+        if 'dup_reply' in faults:
+            arrivals.append(rtt)
+        if 'late_probe' in faults or 'late_reply' in faults:
+            arrivals.append(rtt + self.late_delay)
+        for delay in arrivals:
+            if self.jitter:
+                delay += self.rng.uniform(0, self.jitter)
+            self.replies_sent += 1
+            for sock in self._receivers:
+                sock._deliver(self.now + delay, reply, router.address)
+
+    def _invalid(self, fault: str, address: str, quote: bytes,
+                 reply: bytes) -> bytes:
+        source = self.topology.source
+        rng = self.rng
+        if fault == 'icmp_type':
+            icmp_type = rng.choice([0, 4, 5, 8, 12, 13, 14])
+            return _ipv4(address, source, 1,
+                         _ICMP.pack(icmp_type, 0, 0, 0) + quote)
+        if fault == 'icmp_code':
+            return _ipv4(address, source, 1,
+                         _ICMP.pack(11, rng.randint(1, 255), 0, 0) + quote)
+        if fault == 'udp':
+            return _ipv4(address, source, 17,
+                         _UDP.pack(rng.randint(1, 65535), 33434, 8, 0))
+        if fault == 'garbage':
+            junk = bytes([rng.choice([0, 8, 42, 200])]) + bytes(
+                rng.randrange(256) for _ in range(rng.randint(0, 40)))
+            return _ipv4(address, source, 1, junk)
+        if fault == 'ip_proto':
+            return reply[:9] + bytes([rng.choice([6, 17, 47, 89])]) + reply[10:]
+        if fault == 'frag_offset':
+            return reply[:6] + struct.pack('!H', rng.randint(1, 0x1FFF)) \
+                + reply[8:]
+        if fault == 'truncated':
+            return reply[:rng.randint(1, len(reply) - 1)]
+        # irrelevant_ttl: someone else's probe, to somewhere else.
+        udp = _UDP.pack(rng.randint(1024, 65535), rng.randint(1024, 65535),
+                        8, 0)
+        other = _ipv4('192.0.2.77', '198.51.100.%d' % rng.randint(1, 254),
+                      17, udp, ttl=1)
+        return _ipv4(address, source, 1, _ICMP.pack(11, 0, 0, 0) + other)
+
+
+class EmulatedSocket:
+    """ A socket of an Emulator, with util.Socket's interface.
+
+    Besides util.Socket's methods, wait_readable(timeout) is recv_select()
+    with a timeout of the caller's choosing.
+    """
+
+    def __init__(self, emulator: Emulator, port: int):
+        self._emulator = emulator
+        self.port = port
+        self.ttl = 64
+        self._queue: list[tuple[float, int, bytes, str]] = []
+        self._order = itertools.count()
+
+    def set_ttl(self, ttl: int):
+        self.ttl = ttl
+
+    def sendto(self, payload: bytes, addr: tuple[str, int]):
+        self._emulator._send(self.port, self.ttl, bytes(payload), addr)
+
+    def _deliver(self, when: float, packet: bytes, source: str):
+        heapq.heappush(self._queue, (when, next(self._order), packet, source))
+
+    def wait_readable(self, timeout: float) -> bool:
+        emulator = self._emulator
+        if self._queue and self._queue[0][0] <= emulator.now + timeout:
+            emulator.now = max(emulator.now, self._queue[0][0])
+            return True
+        emulator.now += max(0.0, timeout)
+        emulator.timeouts += 1
+        return False
+
+    def recv_select(self) -> bool:
+        return self.wait_readable(self._emulator.timeout)
+
+    def recvfrom(self) -> tuple[bytes, tuple[str, int]]:
+        if not self._queue or self._queue[0][0] > self._emulator.now:
+            raise BlockingIOError("no packet to receive")
+        _, _, packet, source = heapq.heappop(self._queue)
+        return packet, (source, 0)
+
+
+def _scenario(hops: list[list[str]], dst: str | None = '4.4.4.4',
+              faults: dict[str, dict[str, int | None]] | None = None,
+              silent: tuple[str, ...] = (),
+              balancing: str = 'packet') -> Topology:
+    topology = Topology.chain(hops, dst, balancing=balancing)
+    for address, router_faults in (faults or {}).items():
+        topology.nodes[address].faults = router_faults
+    for address in silent:
+        topology.nodes[address].silent = True
+    return topology
+
+
+_LINE = [['2.2.2.2'], ['3.3.3.3']]
+_EXPECTED = [['2.2.2.2'], ['3.3.3.3'], ['4.4.4.4']]
+_SILENT_3 = [['2.2.2.2'], [], ['4.4.4.4']]
+_DIAMOND = [['1.1.1.1'], ['2.2.2.2', '4.4.4.4'], ['3.3.3.3', '5.5.5.5'],
+            ['6.6.6.6']]
+
+
+def _loop() -> Topology:
+    topology = Topology.chain(_LINE + [['4.4.4.4']], None)
+    topology.set_route('3.3.3.3', None, ['4.4.4.4'])
+    topology.set_route('4.4.4.4', None, ['3.3.3.3'])
+    return topology
+
+
+def _faulty(fault: str, first: int | None) -> Topology:
+    return _scenario(_LINE, faults={'3.3.3.3': {fault: first}})
+
+
+# Spec example name -> (Callable returning (topology, destination),
+# expected result).  Scenarios that the spec runs twice, with a fault
+# applying to the first two probes and then to all of them, appear as
+# name_first_two and name_all.  Hops are balanced per packet, as in the
+# spec's multipath test.
+SCENARIOS: dict[str, tuple[Callable[[], tuple[Topology, str]],
+                           list[list[str]]]] = {
+    'random_traceroute': (lambda: (_scenario(_LINE), '4.4.4.4'), _EXPECTED),
+    'missing_host': (lambda: (_scenario(_LINE + [['4.4.4.4']], None),
+                              '5.5.5.5'),
+                     _EXPECTED + [[]] * 27),
+    'multipath': (lambda: (_scenario(_DIAMOND, '7.7.7.7'), '7.7.7.7'),
+                  _DIAMOND + [['7.7.7.7']]),
+    'silent_routers': (lambda: (_scenario(_LINE, silent=('3.3.3.3',)),
+                                '4.4.4.4'), _SILENT_3),
+    'router_loops': (lambda: (_loop(), '5.5.5.5'),
+                     [['2.2.2.2']] + [['3.3.3.3'], ['4.4.4.4']] * 14
+                     + [['3.3.3.3']]),
+    'delayed_dup_responses': (lambda: (_scenario(_LINE, faults={
+        r: {'late_reply': None} for r in ('2.2.2.2', '3.3.3.3')}),
+        '4.4.4.4'), _EXPECTED),
+    'delayed_dup_probes': (lambda: (_scenario(_LINE, faults={
+        r: {'late_probe': None} for r in ('2.2.2.2', '3.3.3.3')}),
+        '4.4.4.4'), _EXPECTED),
+    'ip_options': (lambda: (_faulty('ip_options', None), '4.4.4.4'),
+                   _EXPECTED),
+}
+for _fault, _name in (('drop', 'occasional_drops'),
+                      ('dup_reply', 'dup_responses'),
+                      ('dup_probe', 'dup_probes'),
+                      ('icmp_type', 'invalid_icmp_type'),
+                      ('icmp_code', 'invalid_icmp_code'),
+                      ('udp', 'irrelevant_udp_response'),
+                      ('garbage', 'unparseable_response'),
+                      ('ip_proto', 'ip_proto'),
+                      ('frag_offset', 'fragmentation_offset'),
+                      ('truncated', 'truncated_buffer'),
+                      ('irrelevant_ttl', 'irrelevant_ttl_response')):
+    _harmless = _fault.startswith('dup_')
+    SCENARIOS[_name + '_first_two'] = (
+        lambda f=_fault: (_faulty(f, 2), '4.4.4.4'), _EXPECTED)
+    SCENARIOS[_name + '_all'] = (
+        lambda f=_fault: (_faulty(f, None), '4.4.4.4'),
+        _EXPECTED if _harmless else _SILENT_3)
+del _fault, _name, _harmless
+
+
+# Like SCENARIOS, for traceroute_multipath(), which should find every
+# router whether hops are balanced per packet or per flow.
+MULTIPATH_SCENARIOS: dict[str, tuple[Callable[[], tuple[Topology, str]],
+                                     list[list[str]]]] = {
+    'diamond_per_packet': (lambda: (_scenario(_DIAMOND, '7.7.7.7'),
+                                    '7.7.7.7'),
+                           _DIAMOND + [['7.7.7.7']]),
+    'diamond_per_flow': (lambda: (_scenario(_DIAMOND, '7.7.7.7',
+                                            balancing='flow'), '7.7.7.7'),
+                         _DIAMOND + [['7.7.7.7']]),
+}
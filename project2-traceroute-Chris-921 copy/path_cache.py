@@ -0,0 +1,127 @@
+""" Remembers the last path traced to each destination.
+
+A PathCache maps destination IPs to the last path found to them (in
+traceroute()'s list[list[str]] form) and the round trip times measured to
+each hop, so that traceroute_incremental() can check a path instead of
+rediscovering it.  Entries expire `max_age` seconds after they were traced,
+and past `max_entries` the least recently used one is dropped.
+
+The cache lives in memory; given a file name it's loaded from that file
+when created and written back by save(), as JSON.
+
+Example:
+    cache = PathCache('paths.json')
+    result = traceroute_incremental(sendsock, recvsock, ip, cache)
+    cache.save()
+"""
+import collections
+import json
+import os
+import time
+from typing import Callable
+
+
+class CachedPath:
+    """ One destination's entry.
+
+    path -- Routers per TTL, as returned by traceroute().
+    rtts -- For each TTL, {router: [round trip times in seconds]}.
+    traced_at -- When it was stored, by the cache's clock.
+    """
+
+    def __init__(self, path: list[list[str]],
+                 rtts: list[dict[str, list[float]]], traced_at: float):
+        self.path = path
+        self.rtts = rtts
+        self.traced_at = traced_at
+
+
+class PathCache:
+    """ Paths by destination IP, with expiry and LRU eviction.
+
+    Arguments:
+    filename -- Where to load the cache from and save it to, or None to
+        keep it in memory only.
+    max_age -- Seconds after which an entry is no longer used.
+    max_entries -- How many destinations to remember.
+    clock -- Returns the current time.  It should be wall clock time
+        (the default) if the cache is saved, since entries outlive the
+        process.
+    """
+
+    def __init__(self, filename: str | None = None, max_age: float = 3600.0,
+                 max_entries: int = 4096,
+                 clock: Callable[[], float] = time.time):
+        self.filename = filename
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.clock = clock
+        # Least recently used first.
+        self._entries: collections.OrderedDict[str, CachedPath] = \
+            collections.OrderedDict()
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, ip: str) -> bool:
+        return self.get(ip, touch=False) is not None
+
+    def get(self, ip: str, touch: bool = True) -> CachedPath | None:
+        """ Returns the entry for `ip`, or None if there isn't a current
+        one.  Unless `touch` is False, it becomes the most recently used. """
+        entry = self._entries.get(ip)
+        if entry is None:
+            return None
+        if self.clock() - entry.traced_at > self.max_age:
+            del self._entries[ip]
+            return None
+        if touch:
+            self._entries.move_to_end(ip)
+        return entry
+
+    def put(self, ip: str, path: list[list[str]],
+            rtts: list[dict[str, list[float]]]):
+        self._entries[ip] = CachedPath(path, rtts, self.clock())
+        self._entries.move_to_end(ip)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard(self, ip: str):
+        self._entries.pop(ip, None)
+
+    def expire(self):
+        """ Drops every entry older than max_age. """
+        cutoff = self.clock() - self.max_age
+        for ip in [ip for ip, entry in self._entries.items()
+                   if entry.traced_at < cutoff]:
+            del self._entries[ip]
+
+    def load(self):
+        """ Replaces the cache's contents with those of its file. """
+        with open(self.filename) as f:
+            saved = json.load(f)
+        self._entries.clear()
+        # Saved least recently used first, so the order carries over.
+        for ip, entry in saved:
+            self._entries[ip] = CachedPath(entry['path'], entry['rtts'],
+                                           entry['traced_at'])
+        self.expire()
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def save(self):
+        """ Writes the current entries to the cache's file.
+
+        The file is replaced atomically, so a crash mid-save leaves the
+        previous version.
+        """
+        self.expire()
+        saved = [(ip, {'path': e.path, 'rtts': e.rtts,
+                       'traced_at': e.traced_at})
+                 for ip, e in self._entries.items()]
+        temp = self.filename + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(saved, f)
+        os.replace(temp, self.filename)
@@ -1,3 +1,14 @@
+import asyncio
+import collections
+import ipaddress
+import math
+import random
+import select
+import struct
+import threading
+import time
+from typing import Callable, Iterable, Iterator
+
 import util
 
 # Your program should send TTLs in the range [1, TRACEROUTE_MAX_TTL] inclusive.
@@ -18,12 +29,35 @@ TRACEROUTE_PORT_NUMBER = 33434  # Cisco traceroute port number.
 # single router before giving up and moving on.
 PROBE_ATTEMPT_COUNT = 3
 
+# traceroute_multipath() tells flows apart by destination port, so staying
+# inside the Cisco range above leaves room for this many of them.
+MULTIPATH_MAX_FLOWS = 31
+
+
+# Precompiled header layouts.  Addresses are unpacked as integers and only
+# turned into dotted strings when asked for.
+_IPV4_HEADER = struct.Struct('!BBHHHBBHII')
+_ICMP_HEADER = struct.Struct('!BBH')
+_UDP_HEADER = struct.Struct('!HHHH')
+
+
+def _dotted(addr: int) -> str:
+    return f'{addr >> 24}.{(addr >> 16) & 255}.{(addr >> 8) & 255}.{addr & 255}'
+
 
 class IPv4:
     # Each member below is a field from the IPv4 packet header.  They are
     # listed below in the order they appear in the packet.  All fields should
     # be stored in host byte order.
     #
+    # The header is read in place from `buffer` (bytes, bytearray or a
+    # memoryview) starting at `offset`, so parsing a header inside a larger
+    # packet doesn't copy it.  src and dst are formatted on first use;
+    # src_addr and dst_addr hold them as integers.
+    __slots__ = ('version', 'header_len', 'tos', 'length', 'id', 'flags',
+                 'frag_offset', 'ttl', 'proto', 'cksum', 'src_addr',
+                 'dst_addr')
+
     version: int
     header_len: int  # Note length in bytes, not the value in the packet.
     tos: int         # Also called DSCP and ECN bits (i.e. on wikipedia).
@@ -36,9 +70,25 @@ class IPv4:
     cksum: int
     src: str
     dst: str
+    src_addr: int
+    dst_addr: int
+
+    def __init__(self, buffer: bytes, offset: int = 0):
+        (version_ihl, self.tos, self.length, self.id, flags_frag, self.ttl,
+         self.proto, self.cksum, self.src_addr, self.dst_addr) = \
+            _IPV4_HEADER.unpack_from(buffer, offset)
+        self.version = version_ihl >> 4
+        self.header_len = (version_ihl & 0xF) * 4
+        self.flags = flags_frag >> 13
+        self.frag_offset = flags_frag & 0x1FFF
+
+    @property
+    def src(self) -> str:
+        return _dotted(self.src_addr)
 
-    def __init__(self, buffer: bytes):
-        ...
+    @property
+    def dst(self) -> str:
+        return _dotted(self.dst_addr)
 
 
 class ICMP:
@@ -47,7 +97,16 @@ class ICMP:
     # host byte order.
     #
     # You should only modify the __init__() function of this class.
-    ...
+    __slots__ = ('type', 'code', 'cksum')
+
+    type: int
+    code: int
+    cksum: int
+
+    def __init__(self, buffer: bytes, offset: int = 0):
+        self.type, self.code, self.cksum = \
+            _ICMP_HEADER.unpack_from(buffer, offset)
+
 
 class UDP:
     # Each member below is a field from the UDP header.  They are listed below
@@ -55,7 +114,16 @@ class UDP:
     # host byte order.
     #
     # You should only modify the __init__() function of this class.
-    ...
+    __slots__ = ('src_port', 'dst_port', 'len', 'cksum')
+
+    src_port: int
+    dst_port: int
+    len: int
+    cksum: int
+
+    def __init__(self, buffer: bytes, offset: int = 0):
+        self.src_port, self.dst_port, self.len, self.cksum = \
+            _UDP_HEADER.unpack_from(buffer, offset)
 
 
 # TODO feel free to add helper functions if you'd like
@@ -80,51 +148,1052 @@ def traceroute(sendsock: util.Socket, recvsock: util.Socket, ip: str) \
     """
 
     # TODO Add your implementation
-    path = [] 
+    path = []
     destination_reached = False
-    ip_have_seen = set()
-    
+
     for ttl in range(1, TRACEROUTE_MAX_TTL + 1):
         sendsock.set_ttl(ttl)
-        found_routers_for_this_ttl = set()
+        found_routers_for_this_ttl = {}
+        # Each TTL's probes go to a port of their own, so replies are
+        # matched by the probe they quote: late or duplicated replies to
+        # other TTLs, and replies to other programs' probes, are ignored,
+        # and the routers of a loop show up at every TTL they answer.
+        port = TRACEROUTE_PORT_NUMBER + ttl
 
         for _ in range(PROBE_ATTEMPT_COUNT):
-            sendsock.sendto(b'', (ip, TRACEROUTE_PORT_NUMBER))
-            try:
-                while recvsock.recv_select():
-                    buf, addr = recvsock.recvfrom()
-                    if len(buf) < 48:
-                        continue
-                    source_ip = addr[0]
-
-                    ipv4_header = IPv4(buf)
-                    if ipv4_header.proto != 1:
-                        continue
-                
-                    icmp_header = ICMP(buf[ipv4_header.header_len:])
-                
-                    if icmp_header.type == 11 and icmp_header.code == 0:
-                            found_routers_for_this_ttl.add(source_ip)
-                
-                    elif icmp_header.type == 3:
-                            found_routers_for_this_ttl.add(source_ip)
-                            destination_reached = True
-                            break  
-                    else:
-                        continue
-            except Exception as e:
-                print(f"Error: {e}")
-        
+            sendsock.sendto(b'', (ip, port))
+            while recvsock.recv_select():
+                buf, addr = recvsock.recvfrom()
+                try:
+                    reply = parse_probe_reply(buf)
+                except struct.error:
+                    continue
+                if reply is None:
+                    continue
+                icmp_header, probe_ip, probe_udp = reply
+                if probe_ip.dst != ip or probe_udp.dst_port != port:
+                    continue
+                found_routers_for_this_ttl[addr[0]] = None
+                if icmp_header.type == 3:
+                    destination_reached = True
+                    break
+
             if destination_reached:
                 break
-        new_ips = found_routers_for_this_ttl - ip_have_seen
-        path.append(list(new_ips))
-        ip_have_seen.update(new_ips)
+        path.append(list(found_routers_for_this_ttl))
         if destination_reached:
-                break
+            break
     return path
 
 
+# Size of the headers in front of the quoted probe in an ICMP error: the
+# ICMP header, then the probe's IPv4 header (at least 20 bytes) and the
+# first 8 bytes of its payload, i.e. the UDP header.
+ICMP_HEADER_LEN = 8
+UDP_HEADER_LEN = 8
+
+# Seconds traceroute_many() waits for a reply to a probe before giving up on
+# it.  Replies for other destinations may keep recv_select() from ever
+# timing out, so lost probes need a deadline of their own.
+BATCH_PROBE_TIMEOUT = 2.0
+
+
+def probe_reply_offsets(buf: bytes) -> tuple[int, int, int] | None:
+    """ Checks whether buf looks like a reply to a UDP probe.
+
+    Looks only at the few bytes that matter, without building any header
+    objects: the outer header must be unfragmented ICMP, the ICMP message a
+    time exceeded (code 0) or destination unreachable, the quoted packet
+    UDP, and the buffer long enough to hold all of it.
+
+    Returns the offsets of the ICMP header, the quoted IPv4 header and the
+    quoted UDP header, or None if buf should be ignored.
+    """
+    size = len(buf)
+    if size < 20 or buf[9] != 1 or (buf[6] & 0x1F) or buf[7]:
+        return None
+    icmp_start = (buf[0] & 0xF) * 4
+    quote_start = icmp_start + ICMP_HEADER_LEN
+    if icmp_start < 20 or size < quote_start + 20:
+        return None
+    icmp_type = buf[icmp_start]
+    if icmp_type != 3 and (icmp_type != 11 or buf[icmp_start + 1] != 0):
+        return None
+    udp_start = quote_start + (buf[quote_start] & 0xF) * 4
+    if buf[quote_start + 9] != 17 or udp_start < quote_start + 20 \
+            or size < udp_start + UDP_HEADER_LEN:
+        return None
+    return icmp_start, quote_start, udp_start
+
+
+def parse_probe_reply(buf: bytes) -> tuple[ICMP, IPv4, UDP] | None:
+    """ Parses an ICMP time exceeded or destination unreachable reply.
+
+    Returns the ICMP header along with the IPv4 and UDP headers of the probe
+    quoted inside it, or None if buf isn't a well-formed reply to a UDP
+    probe (see probe_reply_offsets()).  The caller decides whether the
+    quoted probe is one of its own.
+    """
+    offsets = probe_reply_offsets(buf)
+    if offsets is None:
+        return None
+    icmp_start, quote_start, udp_start = offsets
+    return (ICMP(buf, icmp_start), IPv4(buf, quote_start),
+            UDP(buf, udp_start))
+
+
+def _build_path(routers: dict[int, Iterable[str]],
+                last_ttl: int) -> list[list[str]]:
+    """ Turns the routers that answered each TTL into traceroute()'s result.
+
+    Every reply was matched to the probe it quotes, so a router is reported
+    at each TTL it answered; in a routing loop the same routers come back
+    TTL after TTL. """
+    return [list(routers.get(ttl, ())) for ttl in range(1, last_ttl + 1)]
+
+
+class _Trace:
+    """ Probing state for one destination of traceroute_many().
+
+    TTLs are opened in order, at most `ttl_window` at a time; opening a TTL
+    queues its PROBE_ATTEMPT_COUNT probes.  A TTL closes once each of its
+    probes has been answered or given up on.  Probes are told apart by
+    destination port (TRACEROUTE_PORT_NUMBER + ttl, which stays inside the
+    Cisco range) and payload length (the attempt number), both of which
+    come back in the UDP header quoted by the ICMP reply.
+    """
+
+    def __init__(self, ip: str, ttl_window: int):
+        self.ip = ip
+        self.ttl_window = max(1, ttl_window)
+        self.routers: dict[int, dict[str, None]] = {}
+        self.unsent: collections.deque[tuple[int, int]] = collections.deque()
+        self.outstanding: dict[tuple[int, int], float] = {}  # -> send time
+        self.unresolved: dict[int, int] = {}  # open ttl -> probes left
+        self.reached = TRACEROUTE_MAX_TTL + 1  # Lowest TTL that reached ip
+        self.next_ttl = 1
+        self.probes_sent = 0
+
+    def next_probe(self) -> tuple[int, int] | None:
+        """ Returns the (ttl, attempt) to send next, if any. """
+        while len(self.unresolved) < self.ttl_window \
+                and self.next_ttl < self.reached:
+            ttl = self.next_ttl
+            self.next_ttl += 1
+            self.routers[ttl] = {}
+            self.unresolved[ttl] = PROBE_ATTEMPT_COUNT
+            self.unsent.extend((ttl, a) for a in range(PROBE_ATTEMPT_COUNT))
+        while self.unsent:
+            probe = self.unsent.popleft()
+            if probe[0] < self.reached:
+                return probe
+            self._resolve(probe[0])
+        return None
+
+    def sent(self, probe: tuple[int, int], now: float):
+        self.outstanding[probe] = now
+        self.probes_sent += 1
+
+    def _resolve(self, ttl: int):
+        self.unresolved[ttl] -= 1
+        if not self.unresolved[ttl]:
+            del self.unresolved[ttl]
+
+    def answer(self, ttl: int, attempt: int, router: str,
+               icmp_type: int) -> bool:
+        """ Records a reply.  Returns True if it answered an outstanding
+        probe (rather than being a duplicate or very late). """
+        if ttl not in self.routers or not 0 <= attempt < PROBE_ATTEMPT_COUNT:
+            return False
+        self.routers[ttl][router] = None
+        if icmp_type == 3:
+            self.reached = min(self.reached, ttl)
+        if self.outstanding.pop((ttl, attempt), None) is None:
+            return False
+        self._resolve(ttl)
+        return True
+
+    def expire(self, sent_before: float | None = None) -> int:
+        """ Gives up on outstanding probes sent before `sent_before` (all of
+        them, if it is None).  Returns how many were given up on. """
+        lost = [probe for probe, when in self.outstanding.items()
+                if sent_before is None or when < sent_before]
+        for probe in lost:
+            del self.outstanding[probe]
+            self._resolve(probe[0])
+        return len(lost)
+
+    @property
+    def finished(self) -> bool:
+        return self.next_ttl >= self.reached \
+            and not any(ttl < self.reached for ttl in self.unresolved)
+
+    def path(self) -> list[list[str]]:
+        return _build_path(self.routers, min(self.reached, self.next_ttl - 1))
+
+
+def traceroute_many(sendsock: util.Socket, recvsock: util.Socket,
+                    ips: Iterable[str], rate: float | None = None,
+                    max_in_flight: int | None = 256,
+                    ttl_window: int = TRACEROUTE_MAX_TTL,
+                    probe_timeout: float | None = BATCH_PROBE_TIMEOUT,
+                    clock: Callable[[], float] = time.monotonic,
+                    sleep: Callable[[float], None] = time.sleep) \
+        -> Iterator[tuple[str, list[list[str]]]]:
+    """ Traceroutes many destinations at once over one pair of sockets.
+
+    Yields (ip, path) for each distinct destination as soon as its trace
+    finishes, with path as returned by traceroute().  Probes from all
+    active traces are sent round-robin; replies are matched to a trace by
+    the destination address of the quoted probe, and to a probe within it
+    by the quoted UDP header (see _Trace).
+
+    Arguments:
+    rate -- At most this many probes per second overall (None: no limit).
+    max_in_flight -- At most this many probes awaiting a reply at any time
+        (None: no limit).  New destinations are started only when the
+        active ones can't use the room.
+    ttl_window -- At most this many TTLs of one destination open at once.
+    probe_timeout -- Give up on a probe after this many seconds without a
+        reply (None: only when recv_select() times out, which gives up on
+        every outstanding probe).
+    clock, sleep -- Time source and sleep used for the above.
+    """
+    waiting = collections.deque(dict.fromkeys(ips))
+    active: dict[str, _Trace] = {}
+    in_flight = 0
+    interval = 1.0 / rate if rate else 0.0
+    next_send = clock()
+    ttl = None
+
+    while waiting or active:
+        # Send round-robin until out of room or out of probes.
+        progress = True
+        while progress and (max_in_flight is None
+                            or in_flight < max_in_flight):
+            progress = False
+            for trace in list(active.values()):
+                if max_in_flight is not None and in_flight >= max_in_flight:
+                    break
+                probe = trace.next_probe()
+                if probe is None:
+                    continue
+                if interval:
+                    now = clock()
+                    if now < next_send:
+                        sleep(next_send - now)
+                    next_send = max(now, next_send) + interval
+                if probe[0] != ttl:
+                    ttl = probe[0]
+                    sendsock.set_ttl(ttl)
+                sendsock.sendto(b'\0' * probe[1],
+                                (trace.ip, TRACEROUTE_PORT_NUMBER + ttl))
+                trace.sent(probe, clock())
+                in_flight += 1
+                progress = True
+            if not progress and waiting:
+                ip = waiting.popleft()
+                active[ip] = _Trace(ip, ttl_window)
+                progress = True
+
+        if in_flight:
+            if recvsock.recv_select():
+                buf, addr = recvsock.recvfrom()
+                try:
+                    reply = parse_probe_reply(buf)
+                except struct.error:
+                    reply = None
+                if reply is not None:
+                    icmp, inner, udp = reply
+                    trace = active.get(inner.dst)
+                    if trace is not None and trace.answer(
+                            udp.dst_port - TRACEROUTE_PORT_NUMBER,
+                            udp.len - UDP_HEADER_LEN, addr[0], icmp.type):
+                        in_flight -= 1
+            else:
+                for trace in active.values():
+                    in_flight -= trace.expire()
+            if probe_timeout is not None:
+                cutoff = clock() - probe_timeout
+                for trace in active.values():
+                    in_flight -= trace.expire(cutoff)
+
+        for ip, trace in list(active.items()):
+            if trace.finished:
+                in_flight -= trace.expire()
+                del active[ip]
+                yield ip, trace.path()
+
+
+def traceroute_parallel(sendsock: util.Socket, recvsock: util.Socket, ip: str,
+                        window: int = TRACEROUTE_MAX_TTL) -> list[list[str]]:
+    """ Like traceroute(), but with the probes for many TTLs in flight at once.
+
+    All PROBE_ATTEMPT_COUNT probes for each of the first `window` TTLs are
+    sent up front; every time a TTL finishes, the next one is sent.  Replies
+    that don't quote one of our probes to `ip` are ignored (see _Trace).
+
+    A TTL finishes when all of its probes have been answered, or when
+    recv_select() times out, which gives up on every probe still
+    outstanding.  With the default window the whole trace takes about one
+    round trip, plus one timeout if any probes go unanswered.
+
+    Returns the same list of lists as traceroute().
+    """
+    for _, path in traceroute_many(sendsock, recvsock, [ip], max_in_flight=None,
+                                   ttl_window=window, probe_timeout=None):
+        return path
+    return []
+
+
+class ProbeMux:
+    """ Shares one send and one receive socket among traceroute_async() calls.
+
+    Received replies are dispatched to a future per outstanding probe, keyed
+    by the destination, TTL and attempt of the probe they quote (see _Trace
+    for how those are encoded).  If the receive socket has a fileno() it is
+    watched by the event loop itself, and switched to non-blocking mode if
+    it has setblocking() (until close()); otherwise a single helper thread
+    polls it with recv_select() for all the traces.  Traces to the same
+    destination take turns, since their probes would look alike.
+
+    Must be created from a coroutine running on the loop that will use it.
+    """
+
+    def __init__(self, sendsock: util.Socket, recvsock: util.Socket):
+        self._sendsock = sendsock
+        self._recvsock = recvsock
+        self._loop = asyncio.get_running_loop()
+        self._waiting: dict[tuple[str, int, int], asyncio.Future] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._closed = False
+        self._fd = None
+        self._nonblocking = False
+        self._thread = None
+        fileno = getattr(recvsock, 'fileno', None)
+        if fileno is not None:
+            self._fd = fileno()
+            setblocking = getattr(recvsock, 'setblocking', None)
+            if setblocking is not None:
+                setblocking(False)
+                self._nonblocking = True
+            self._loop.add_reader(self._fd, self._on_readable)
+        else:
+            self._thread = threading.Thread(target=self._poll, daemon=True)
+            self._thread.start()
+
+    def _on_readable(self):
+        # Drain a bounded number of packets per wakeup, so a burst of
+        # replies is dispatched before the timers of the probes they answer
+        # can fire.  A non-blocking socket says when it's empty; a blocking
+        # one is polled before every read after the first, since a
+        # recvfrom() with nothing queued would stall every trace on it.
+        for i in range(256):
+            if i and not self._nonblocking \
+                    and not select.select([self._fd], [], [], 0)[0]:
+                return
+            try:
+                buf, addr = self._recvsock.recvfrom()
+            except (BlockingIOError, InterruptedError):
+                return
+            self._dispatch(buf, addr)
+
+    def _poll(self):
+        while not self._closed:
+            try:
+                if not self._recvsock.recv_select():
+                    continue
+                buf, addr = self._recvsock.recvfrom()
+            except OSError:
+                continue
+            try:
+                self._loop.call_soon_threadsafe(self._dispatch, buf, addr)
+            except RuntimeError:
+                # The loop is closed; nobody is left to dispatch to.
+                return
+
+    def _dispatch(self, buf: bytes, addr: tuple[str, int]):
+        try:
+            reply = parse_probe_reply(buf)
+        except struct.error:
+            return
+        if reply is None:
+            return
+        icmp, inner, udp = reply
+        key = (inner.dst, udp.dst_port - TRACEROUTE_PORT_NUMBER,
+               udp.len - UDP_HEADER_LEN)
+        future = self._waiting.get(key)
+        if future is not None and not future.done():
+            future.set_result((addr[0], icmp.type))
+
+    def lock_for(self, ip: str) -> asyncio.Lock:
+        lock = self._locks.get(ip)
+        if lock is None:
+            lock = self._locks[ip] = asyncio.Lock()
+        return lock
+
+    def send(self, ip: str, ttl: int, attempt: int) -> asyncio.Future:
+        """ Sends a probe and returns a future for its (router, ICMP type).
+
+        Cancelling the future stops waiting for the reply.
+        """
+        key = (ip, ttl, attempt)
+        future = self._loop.create_future()
+        self._waiting[key] = future
+        future.add_done_callback(lambda _: self._waiting.pop(key, None))
+        # No await in between, so no other trace can change the TTL first.
+        self._sendsock.set_ttl(ttl)
+        self._sendsock.sendto(b'\0' * attempt, (ip, TRACEROUTE_PORT_NUMBER + ttl))
+        return future
+
+    def close(self):
+        """ Stops listening and cancels every outstanding probe.
+
+        With a helper thread this waits for its current recv_select() to
+        return, i.e. up to recv_select()'s timeout.
+        """
+        self._closed = True
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._fd = None
+            if self._nonblocking:
+                self._recvsock.setblocking(True)
+                self._nonblocking = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for future in list(self._waiting.values()):
+            future.cancel()
+
+
+async def traceroute_async(sendsock: util.Socket, recvsock: util.Socket,
+                           ip: str, mux: ProbeMux | None = None,
+                           hop_timeout: float = 1.0,
+                           window: int = TRACEROUTE_MAX_TTL) \
+        -> list[list[str]]:
+    """ Coroutine version of traceroute_parallel().
+
+    Probes up to `window` TTLs at once and waits at most `hop_timeout`
+    seconds for the replies to each TTL's probes.  Pass the same `mux` to
+    run many traces concurrently over one pair of sockets (the sockets
+    arguments are then unused); without one, a ProbeMux is made for this
+    call and closed at the end.
+
+    Cancelling the coroutine cancels all of its outstanding probes.
+
+    Returns the same list of lists as traceroute().
+    """
+    own_mux = mux is None
+    if own_mux:
+        mux = ProbeMux(sendsock, recvsock)
+    try:
+        async with mux.lock_for(ip):
+            return await _trace_async(mux, ip, hop_timeout, window)
+    finally:
+        if own_mux:
+            mux.close()
+
+
+async def _trace_async(mux: ProbeMux, ip: str, hop_timeout: float,
+                       window: int) -> list[list[str]]:
+    routers: dict[int, dict[str, None]] = {}
+    reached = TRACEROUTE_MAX_TTL + 1
+    last_ttl = 0
+    slots = asyncio.Semaphore(max(1, window))
+
+    async def probe(ttl: int):
+        nonlocal reached, last_ttl
+        async with slots:
+            if ttl > reached:
+                return
+            last_ttl = max(last_ttl, ttl)
+            futures = [mux.send(ip, ttl, attempt)
+                       for attempt in range(PROBE_ATTEMPT_COUNT)]
+            try:
+                await asyncio.wait(futures, timeout=hop_timeout)
+            finally:
+                for future in futures:
+                    future.cancel()
+            found = routers.setdefault(ttl, {})
+            for future in futures:
+                if future.cancelled():
+                    continue
+                router, icmp_type = future.result()
+                found[router] = None
+                if icmp_type == 3 and ttl < reached:
+                    reached = ttl
+                    for later in tasks[ttl:]:
+                        later.cancel()
+
+    tasks = [asyncio.ensure_future(probe(ttl))
+             for ttl in range(1, TRACEROUTE_MAX_TTL + 1)]
+    try:
+        await asyncio.wait(tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    for task in tasks:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return _build_path(routers, min(reached, last_ttl))
+
+
+def mda_probe_count(found: int, confidence: float = 0.95) -> int:
+    """ Number of flows to send through a hop, having found `found` next
+    hops, before concluding with the given confidence that there are no
+    more (the stopping rule of the Multipath Detection Algorithm).
+
+    If there were found + 1 next hops with equal shares of the traffic, all
+    n flows would miss one of them with probability at most
+    (found + 1) * (found / (found + 1)) ** n.
+    """
+    if found < 1:
+        return 1
+    alpha = 1.0 - confidence
+    return math.ceil(math.log(alpha / (found + 1))
+                     / math.log(found / (found + 1)))
+
+
+class MultipathResult:
+    """ What traceroute_multipath() found.
+
+    path -- Routers per TTL, in the same form as traceroute()'s result.
+    links -- {ttl: {(router at ttl - 1, router at ttl), ...}}, the edges of
+        the hop-level DAG.  The router at TTL 0 is None (this host), as is
+        any router that didn't answer.
+    probes_sent -- Total number of probes, retries included.
+    """
+
+    def __init__(self, path: list[list[str]],
+                 links: dict[int, set[tuple[str | None, str | None]]],
+                 probes_sent: int):
+        self.path = path
+        self.links = links
+        self.probes_sent = probes_sent
+
+
+def traceroute_multipath(sendsock: util.Socket, recvsock: util.Socket,
+                         ip: str, confidence: float = 0.95,
+                         max_flows: int = MULTIPATH_MAX_FLOWS) \
+        -> MultipathResult:
+    """ Finds all load-balanced paths to `ip`, Paris traceroute style.
+
+    Every probe belongs to a flow, and a flow's probes all have the same
+    UDP ports (destination port TRACEROUTE_PORT_NUMBER + flow), so a
+    per-flow load balancer sends them all down the same path; the TTL of a
+    probe is carried in its payload length instead, which balancers don't
+    hash.  Different flows are used to explore different paths.
+
+    Next hops are enumerated with the Multipath Detection Algorithm: for
+    each router R found at one TTL, flows known to pass through R are sent
+    one TTL further until mda_probe_count() of them have been, given the
+    number of distinct next hops seen so far.  If too few known flows pass
+    through R, new flows are sent to R's TTL to find more.  A router with
+    no answering next hop after PROBE_ATTEMPT_COUNT flows is treated as
+    followed by a silent hop, and probing continues from all of its flows.
+
+    At most `max_flows` flows are used, and never more than
+    MULTIPATH_MAX_FLOWS: the source port is the send socket's own, and the
+    payload doesn't count toward a flow, so the destination port is all
+    that can tell flows apart, and it stays inside the Cisco range.  That
+    is enough for MDA to rule out more next hops with 95% confidence after
+    finding up to five.  Stops at the first TTL where every answer came
+    from `ip` (or with a destination unreachable).
+    """
+    max_flows = min(max_flows, MULTIPATH_MAX_FLOWS)
+    answers: dict[tuple[int, int], tuple[str, int] | None] = {}
+    flows_used = 0
+    probes_sent = 0
+
+    def probe(probes: list[tuple[int, int]]):
+        # Sends (flow, ttl) probes and records their answers, retrying
+        # unanswered ones up to PROBE_ATTEMPT_COUNT times in all.
+        nonlocal probes_sent
+        waiting = set(probes)
+        for _ in range(PROBE_ATTEMPT_COUNT):
+            if not waiting:
+                break
+            for flow, ttl in sorted(waiting, key=lambda p: p[1]):
+                sendsock.set_ttl(ttl)
+                sendsock.sendto(b'\0' * ttl, (ip, TRACEROUTE_PORT_NUMBER + flow))
+                probes_sent += 1
+            while waiting and recvsock.recv_select():
+                buf, addr = recvsock.recvfrom()
+                try:
+                    reply = parse_probe_reply(buf)
+                except struct.error:
+                    continue
+                if reply is None:
+                    continue
+                icmp, inner, udp = reply
+                key = (udp.dst_port - TRACEROUTE_PORT_NUMBER,
+                       udp.len - UDP_HEADER_LEN)
+                if inner.dst != ip or key not in waiting:
+                    continue
+                waiting.discard(key)
+                answers[key] = (addr[0], icmp.type)
+        for key in waiting:
+            answers[key] = None
+
+    def router(flow: int, ttl: int) -> str | None:
+        if ttl == 0:
+            return None
+        answer = answers.get((flow, ttl))
+        return answer[0] if answer is not None else None
+
+    def new_flows(count: int) -> list[int]:
+        nonlocal flows_used
+        count = max(0, min(count, max_flows - flows_used))
+        flows_used += count
+        return list(range(flows_used - count, flows_used))
+
+    flows = new_flows(1)  # Flows probed at the previous TTL
+    last_ttl = 0
+    for ttl in range(1, TRACEROUTE_MAX_TTL + 1):
+        last_ttl = ttl
+        # Group the flows by the router they reached at the previous TTL.
+        # Flows lost there share the None group with the flows from a
+        # silent hop.  New flows sent to the previous TTL can turn up
+        # routers (and so groups) that weren't known before.
+        by_router: dict[str | None, list[int]] = {}
+        for flow in flows:
+            by_router.setdefault(router(flow, ttl - 1), []).append(flow)
+        done: set[str | None] = set()
+        while len(done) < len(by_router):
+            previous = next(r for r in by_router if r not in done)
+            done.add(previous)
+            through = by_router[previous]
+            next_hops: set[str] = set()
+            probed = 0
+            while True:
+                needed = mda_probe_count(len(next_hops), confidence) \
+                    if next_hops else PROBE_ATTEMPT_COUNT
+                if probed >= needed:
+                    break
+                batch = through[probed:needed]
+                if not batch:
+                    # Need more flows through `previous`: try new ones at
+                    # its TTL, and file each under the router it reached.
+                    extra = new_flows(needed - probed)
+                    if not extra:
+                        break
+                    if ttl > 1:
+                        probe([(f, ttl - 1) for f in extra])
+                    for flow in extra:
+                        flows.append(flow)
+                        by_router.setdefault(router(flow, ttl - 1), []) \
+                            .append(flow)
+                    continue
+                probe([(f, ttl) for f in batch])
+                probed += len(batch)
+                next_hops.update(router(f, ttl) for f in batch)
+                next_hops.discard(None)
+
+        flows = [f for f in flows if (f, ttl) in answers]
+        answered = [answers[(f, ttl)] for f in flows
+                    if answers[(f, ttl)] is not None]
+        if answered and all(r == ip or t == 3 for r, t in answered):
+            break
+
+    routers: dict[int, dict[str, None]] = {}
+    links: dict[int, set[tuple[str | None, str | None]]] = {}
+    for (flow, ttl), answer in sorted(answers.items(), key=lambda a: a[0][::-1]):
+        if ttl > last_ttl:
+            continue
+        hop = answer[0] if answer is not None else None
+        if hop is not None:
+            routers.setdefault(ttl, {})[hop] = None
+        if ttl == 1 or (flow, ttl - 1) in answers:
+            links.setdefault(ttl, set()).add((router(flow, ttl - 1), hop))
+    return MultipathResult(_build_path(routers, last_ttl), links, probes_sent)
+
+
+def _wait_readable(sock: util.Socket, timeout: float) -> bool:
+    """ recv_select() with a timeout of our choosing, where possible.
+
+    Sockets that expose fileno() are waited on with select(), and those
+    with a wait_readable(timeout) method (emulator.EmulatedSocket) through
+    it; otherwise this falls back to recv_select() and its fixed timeout.
+    """
+    fileno = getattr(sock, 'fileno', None)
+    if fileno is not None:
+        return bool(select.select([fileno()], [], [], max(0.0, timeout))[0])
+    wait_readable = getattr(sock, 'wait_readable', None)
+    if wait_readable is not None:
+        return wait_readable(max(0.0, timeout))
+    return sock.recv_select()
+
+
+class RttEstimator:
+    """ Smoothed round trip times and timeouts, as in TCP (RFC 6298), per TTL.
+
+    Far hops take longer to answer than near ones, so a single SRTT trained
+    on the first few hops would give up on the last ones too early.  Each
+    TTL keeps its own SRTT and RTTVAR instead, and timeout(ttl) is
+    SRTT + 4 * RTTVAR for that TTL.  A TTL without samples yet borrows the
+    timeout of the nearest closer TTL that has some, scaled up by the ratio
+    of their distances; with none at all, it is max_timeout.  Timeouts are
+    clamped to [min_timeout, max_timeout].
+
+    Calls that leave out the TTL share one estimate (TTL 0).  srtt and
+    rttvar are those of the last TTL sampled.
+    """
+
+    def __init__(self, min_timeout: float = 0.05, max_timeout: float = 1.0):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.srtt: float | None = None
+        self.rttvar = 0.0
+        self._hops: dict[int, tuple[float, float]] = {}  # ttl -> srtt, rttvar
+
+    def sample(self, rtt: float, ttl: int = 0):
+        hop = self._hops.get(ttl)
+        if hop is None:
+            srtt, rttvar = rtt, rtt / 2
+        else:
+            srtt, rttvar = hop
+            rttvar = 0.75 * rttvar + 0.25 * abs(srtt - rtt)
+            srtt = 0.875 * srtt + 0.125 * rtt
+        self._hops[ttl] = self.srtt, self.rttvar = srtt, rttvar
+
+    def timeout(self, ttl: int = 0) -> float:
+        hop = self._hops.get(ttl)
+        scale = 1.0
+        if hop is None:
+            closer = [t for t in self._hops if 0 < t < ttl]
+            if not closer:
+                return self.max_timeout
+            nearest = max(closer)
+            hop = self._hops[nearest]
+            scale = ttl / nearest
+        srtt, rttvar = hop
+        return min(self.max_timeout,
+                   max(self.min_timeout, scale * (srtt + 4 * rttvar)))
+
+
+class TimedResult:
+    """ What traceroute_adaptive() found.
+
+    path -- Routers per TTL, in the same form as traceroute()'s result.
+    rtts -- For each TTL, {router: [round trip times in seconds]}, one per
+        probe it answered.
+    gave_up_after -- The last TTL probed, if the trace stopped early
+        because of silent hops; otherwise None.
+    probes_sent -- How many probes the trace took.
+    """
+
+    def __init__(self, path: list[list[str]],
+                 rtts: list[dict[str, list[float]]],
+                 gave_up_after: int | None, probes_sent: int = 0):
+        self.path = path
+        self.rtts = rtts
+        self.gave_up_after = gave_up_after
+        self.probes_sent = probes_sent
+
+
+class _HopProber:
+    """ Sends probes one TTL at a time and times their replies.
+
+    Probes are told apart as in _Trace.  Replies to earlier probes that
+    arrive late still count for their own TTL.
+    """
+
+    def __init__(self, sendsock: util.Socket, recvsock: util.Socket, ip: str,
+                 estimator: RttEstimator, clock: Callable[[], float]):
+        self.sendsock = sendsock
+        self.recvsock = recvsock
+        self.ip = ip
+        self.estimator = estimator
+        self.clock = clock
+        self.routers: dict[int, dict[str, list[float]]] = {}
+        self.reached = TRACEROUTE_MAX_TTL + 1
+        self.probes_sent = 0
+        self._sent_at: dict[tuple[int, int], float] = {}
+        self._attempts: dict[int, int] = {}
+
+    def _receive(self, deadline: float):
+        if not _wait_readable(self.recvsock, deadline - self.clock()):
+            return
+        buf, addr = self.recvsock.recvfrom()
+        now = self.clock()
+        try:
+            reply = parse_probe_reply(buf)
+        except struct.error:
+            return
+        if reply is None:
+            return
+        icmp, inner, udp = reply
+        probe = (udp.dst_port - TRACEROUTE_PORT_NUMBER,
+                 udp.len - UDP_HEADER_LEN)
+        if inner.dst != self.ip or probe not in self._sent_at:
+            return
+        rtt = now - self._sent_at.pop(probe)
+        self.estimator.sample(rtt, probe[0])
+        hop = self.routers.setdefault(probe[0], {})
+        hop.setdefault(addr[0], []).append(rtt)
+        if icmp.type == 3:
+            self.reached = min(self.reached, probe[0])
+
+    def probe(self, ttl: int, attempts: int = PROBE_ATTEMPT_COUNT,
+              until_answered: bool = False) -> dict[str, list[float]]:
+        """ Probes `ttl` up to `attempts` times, waiting for each probe to
+        be answered or to time out.  Returns {router: [rtts]} for `ttl`. """
+        hop = self.routers.setdefault(ttl, {})
+        self.sendsock.set_ttl(ttl)
+        for _ in range(attempts):
+            if until_answered and hop:
+                break
+            attempt = self._attempts.get(ttl, 0)
+            self._attempts[ttl] = attempt + 1
+            probe = (ttl, attempt)
+            self.sendsock.sendto(b'\0' * attempt,
+                                 (self.ip, TRACEROUTE_PORT_NUMBER + ttl))
+            self.probes_sent += 1
+            self._sent_at[probe] = self.clock()
+            deadline = self._sent_at[probe] + self.estimator.timeout(ttl)
+            while probe in self._sent_at and self.clock() < deadline:
+                self._receive(deadline)
+        return hop
+
+    def trace(self, first_ttl: int, max_silent: int) -> int | None:
+        """ Probes every TTL from `first_ttl` until the destination answers.
+        Returns the last TTL probed if it gave up after `max_silent` silent
+        TTLs in a row. """
+        silent = 0
+        for ttl in range(first_ttl, TRACEROUTE_MAX_TTL + 1):
+            if ttl > self.reached:
+                break
+            silent = 0 if self.probe(ttl) else silent + 1
+            if silent >= max_silent and ttl < self.reached:
+                return ttl
+        return None
+
+    def result(self, gave_up_after: int | None) -> TimedResult:
+        path = _build_path(self.routers, min(self.reached, TRACEROUTE_MAX_TTL))
+        rtts = [{r: self.routers.get(ttl, {}).get(r, []) for r in hop}
+                for ttl, hop in enumerate(path, 1)]
+        return TimedResult(path, rtts, gave_up_after, self.probes_sent)
+
+
+def traceroute_adaptive(sendsock: util.Socket, recvsock: util.Socket,
+                        ip: str, estimator: RttEstimator | None = None,
+                        max_silent: int = 5,
+                        clock: Callable[[], float] = time.monotonic) \
+        -> TimedResult:
+    """ Like traceroute(), but waits only as long as the path needs.
+
+    Probes one TTL at a time, PROBE_ATTEMPT_COUNT probes each, and moves on
+    as soon as a probe is answered rather than waiting for recv_select() to
+    time out.  An unanswered probe is given up after the estimator's
+    timeout, which adapts to the round trip times measured so far.
+
+    After `max_silent` TTLs in a row with no answers at all, the trace
+    stops; the TTLs it didn't probe are reported as empty, so the path has
+    the same shape as traceroute()'s.
+
+    Adaptive timeouts need a recvsock with fileno() (see _wait_readable());
+    otherwise each wait takes recv_select()'s own timeout.
+    """
+    prober = _HopProber(sendsock, recvsock, ip,
+                        estimator if estimator is not None else RttEstimator(),
+                        clock)
+    return prober.result(prober.trace(1, max_silent))
+
+
+def traceroute_incremental(sendsock: util.Socket, recvsock: util.Socket,
+                           ip: str, cache, samples: int = 3,
+                           estimator: RttEstimator | None = None,
+                           max_silent: int = 5,
+                           clock: Callable[[], float] = time.monotonic,
+                           rng: random.Random | None = None) -> TimedResult:
+    """ Re-traces `ip`, reusing the path in `cache` while it still holds.
+
+    With no usable cached path (none, expired, or one that never reached
+    the destination) this is traceroute_adaptive().  Otherwise it probes
+    only the destination hop, the hop before it, and `samples` other
+    answering hops picked at random, one answered probe each, in TTL order.
+    A checked hop is unchanged if every router that answers it is one the
+    cache has for that TTL.  If they all are, the cached path is kept (with
+    the new RTTs); otherwise the cached hops are kept only up to the last
+    unchanged check and the rest of the path is traced in full.
+
+    Either way the result is stored back into the cache.
+
+    Arguments:
+    cache -- A path_cache.PathCache, or anything with its get() and put().
+    samples -- How many hops to check besides the last two.
+    rng -- Picks the sampled hops; defaults to the random module.
+    """
+    if estimator is None:
+        estimator = RttEstimator()
+    prober = _HopProber(sendsock, recvsock, ip, estimator, clock)
+    cached = cache.get(ip)
+    if cached is None or not cached.path or not cached.path[-1]:
+        result = prober.result(prober.trace(1, max_silent))
+        cache.put(ip, result.path, result.rtts)
+        return result
+
+    path, rtts = cached.path, cached.rtts
+    dest_ttl = len(path)
+    # The last two hops show whether the destination moved closer or
+    # farther; an earlier hop that was silent last time can't confirm
+    # anything.
+    answering = [ttl for ttl in range(1, dest_ttl - 1) if path[ttl - 1]]
+    checks = set((rng or random).sample(answering,
+                                        min(samples, len(answering))))
+    checks.update(ttl for ttl in (dest_ttl - 1, dest_ttl)
+                  if ttl >= 1 and path[ttl - 1])
+
+    confirmed = 0
+    diverged = False
+    for ttl in sorted(checks):
+        hop = prober.probe(ttl, until_answered=True)
+        dest_answered = prober.reached == ttl
+        if (not hop or not set(hop) <= set(path[ttl - 1])
+                or dest_answered != (ttl == dest_ttl)):
+            diverged = True
+            break
+        confirmed = ttl
+
+    # Unprobed hops keep what the cache has; probed ones get fresh RTTs.
+    for ttl in range(1, (dest_ttl if not diverged else confirmed) + 1):
+        hop = prober.routers.setdefault(ttl, {})
+        for router, cached_rtts in rtts[ttl - 1].items():
+            if router not in hop:
+                hop[router] = list(cached_rtts)
+    if not diverged:
+        prober.reached = dest_ttl
+        result = prober.result(None)
+    else:
+        for ttl in range(confirmed + 1, TRACEROUTE_MAX_TTL + 1):
+            prober.routers.pop(ttl, None)
+        prober.reached = TRACEROUTE_MAX_TTL + 1
+        result = prober.result(prober.trace(confirmed + 1, max_silent))
+    cache.put(ip, result.path, result.rtts)
+    return result
+
+
+class StopSet:
+    """ Interfaces already traced through, for traceroute_doubletree().
+
+    Maps (interface, destination prefix) to the path on which it was seen
+    and its TTL there.  With destination-based routing, every destination
+    in a prefix is reached through an interface by the same hops, so a
+    trace that meets a known pair can take the hops before it from the
+    earlier path instead of probing them.  A prefix_len of 0 makes every
+    interface count regardless of destination (Doubletree's "local" stop
+    set), which saves more probes but may borrow hops from a different
+    path.
+
+    Also counts what traceroute_doubletree() did with it:
+    traces -- Destinations traced.
+    probes_sent -- Probes sent.
+    probes_saved -- Probes a full traceroute_adaptive() of the same paths
+        would have sent to the borrowed hops (PROBE_ATTEMPT_COUNT per hop).
+    stops -- Traces cut short by a known interface.
+    """
+
+    def __init__(self, prefix_len: int = 24):
+        self.prefix_len = prefix_len
+        self._seen: dict[tuple[str, ipaddress.IPv4Network],
+                         tuple[list[list[str]], int]] = {}
+        self._lengths: list[int] = []
+        self.traces = 0
+        self.probes_sent = 0
+        self.probes_saved = 0
+        self.stops = 0
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def prefix(self, ip: str) -> ipaddress.IPv4Network:
+        return ipaddress.IPv4Network((ip, self.prefix_len), strict=False)
+
+    def lookup(self, router: str, ip: str) \
+            -> tuple[list[list[str]], int] | None:
+        """ Returns (path, ttl) where `router` was seen on the way to
+        `ip`'s prefix, or None. """
+        return self._seen.get((router, self.prefix(ip)))
+
+    def add(self, ip: str, path: list[list[str]]):
+        """ Records every router on `path`, a path to `ip`. """
+        prefix = self.prefix(ip)
+        for ttl, hop in enumerate(path, 1):
+            for router in hop:
+                self._seen.setdefault((router, prefix), (path, ttl))
+        if path and path[-1]:
+            self._lengths.append(len(path))
+
+    def start_ttl(self) -> int:
+        """ A TTL about halfway along the paths traced so far. """
+        if not self._lengths:
+            return 1
+        lengths = sorted(self._lengths)
+        return max(1, lengths[len(lengths) // 2] // 2)
+
+
+def traceroute_doubletree(sendsock: util.Socket, recvsock: util.Socket,
+                          ips: Iterable[str], stop_set: StopSet | None = None,
+                          start_ttl: int | None = None,
+                          estimator: RttEstimator | None = None,
+                          max_silent: int = 5,
+                          clock: Callable[[], float] = time.monotonic) \
+        -> Iterator[tuple[str, TimedResult]]:
+    """ Traceroutes many destinations, skipping hops already traced.
+
+    Each trace starts in the middle of the path: it probes forwards from
+    `start_ttl` to the destination, as traceroute_adaptive() does, then
+    backwards from `start_ttl` until some router answering a hop is in the
+    stop set for the destination's prefix.  The hops before that one are
+    taken from the path it was seen on (with no RTTs), and everything the
+    trace found goes into the stop set for the traces after it.
+
+    Yields (ip, result) for each distinct destination in turn.  The stop
+    set's counters are updated as it goes.
+
+    Arguments:
+    stop_set -- Shared between calls to carry what one batch learned into
+        the next; a new one by default.
+    start_ttl -- Where to start each trace.  By default, halfway along the
+        paths traced so far (StopSet.start_ttl()).
+    """
+    if stop_set is None:
+        stop_set = StopSet()
+    if estimator is None:
+        estimator = RttEstimator()
+    for ip in dict.fromkeys(ips):
+        prober = _HopProber(sendsock, recvsock, ip, estimator, clock)
+        first = start_ttl if start_ttl is not None else stop_set.start_ttl()
+        first = min(max(first, 1), TRACEROUTE_MAX_TTL)
+        gave_up_after = prober.trace(first, max_silent)
+
+        ttl = min(first, prober.reached)
+        while ttl >= 1:
+            hop = (prober.routers[ttl] if ttl in prober.routers
+                   else prober.probe(ttl))
+            known = [stop_set.lookup(r, ip) for r in hop]
+            known = [k for k in known if k is not None]
+            if known and ttl < prober.reached:
+                # Line the earlier path up so that the known router falls
+                # on this TTL (they only differ with a short prefix_len).
+                path, seen_at = known[0]
+                offset = seen_at - ttl
+                for borrowed in range(1, ttl):
+                    old = borrowed + offset
+                    routers = path[old - 1] if old >= 1 else ()
+                    prober.routers[borrowed] = {r: [] for r in routers}
+                stop_set.stops += 1
+                stop_set.probes_saved += (ttl - 1) * PROBE_ATTEMPT_COUNT
+                break
+            ttl -= 1
+
+        result = prober.result(gave_up_after)
+        stop_set.add(ip, result.path)
+        stop_set.traces += 1
+        stop_set.probes_sent += result.probes_sent
+        yield ip, result
+
+
 if __name__ == '__main__':
     args = util.parse_args()
     ip_addr = util.gethostbyname(args.host)
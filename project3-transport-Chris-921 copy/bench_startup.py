@@ -0,0 +1,119 @@
+# Copyright 2011-2022 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark for component rendezvous at startup
+
+Registers a number of synthetic components, each of which first asks
+call_when_ready() to be told when a few random others are up, in random
+order.  It does this twice: once with POXCore's dependency index, and once
+the way register() used to work, retrying every waiting entry (and
+rechecking all of its dependencies) after each registration.
+
+Run from the POX directory:
+  python bench_startup.py [components] [dependencies each] [seed]
+"""
+
+import random
+import sys
+import time
+
+from pox.core import POXCore, ComponentRegistered
+
+
+class _Component (object):
+  def __init__ (self, name):
+    self._core_name = name
+    self.ready = False
+
+  def _all_ready (self):
+    self.ready = True
+
+
+def _make_core ():
+  return POXCore(threaded_selecthub=False, handle_signals=False)
+
+
+def _legacy_call_when_ready (core, callback, components):
+  entry = (callback, callback.__name__, list(components), (), {})
+  core._pending[id(entry)] = entry
+  core._try_waiter(entry)
+
+
+def _legacy_register (core, component):
+  name = component._core_name
+  core.components[name] = component
+  core.raiseEventNoErrors(ComponentRegistered, name, component)
+  core._try_waiters()
+
+
+def _indexed_call_when_ready (core, callback, components):
+  core.call_when_ready(callback, components)
+
+
+def _indexed_register (core, component):
+  core.register(component)
+
+
+def run (count=1000, deps=3, seed=0, legacy=False):
+  """
+  Returns the time taken to set up and register count components
+  """
+  rng = random.Random(seed)
+  names = ["component%s" % (i,) for i in range(count)]
+  components = [_Component(n) for n in names]
+  wants = [rng.sample(names, min(deps, count)) for _ in names]
+  order = list(range(count))
+  rng.shuffle(order)
+
+  if legacy:
+    call_when_ready = _legacy_call_when_ready
+    register = _legacy_register
+  else:
+    call_when_ready = _indexed_call_when_ready
+    register = _indexed_register
+
+  core = _make_core()
+  start = time.time()
+  for i in order:
+    call_when_ready(core, components[i]._all_ready, wants[i])
+    register(core, components[i])
+  elapsed = time.time() - start
+
+  assert all(c.ready for c in components)
+  assert not core._waiters
+  return elapsed
+
+
+def main ():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  deps = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+  seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+
+  indexed = run(count, deps, seed)
+  legacy = run(count, deps, seed, legacy=True)
+  print("{0} components, {1} dependencies each".format(count, deps))
+  print("  rescan all waiters: {0:8.1f} ms".format(legacy * 1000))
+  print("  dependency index:   {0:8.1f} ms".format(indexed * 1000))
+  print("  speedup:            {0:8.1f}x".format(legacy / indexed))
+
+  print("Dependency index, per registration:")
+  for scale in (1, 2, 4, 8, 16):
+    n = count * scale
+    elapsed = run(n, deps, seed)
+    print("  {0:7} components: {1:8.2f} us".format(n, elapsed / n * 1e6))
+
+
+if __name__ == "__main__":
+  main()
@@ -25,6 +25,8 @@
 
 from __future__ import print_function
 
+import importlib.util
+import json
 import logging
 import logging.config
 import os
@@ -34,15 +36,20 @@ import time
 import inspect
 import types
 import threading
+import pickle
+import zlib
 import pox.core
+from pox.startup_profile import StartupProfile
 core = None
 
 ...
 
-def _do_import (name):
+def _do_import (name, names_to_try=None):
   """
   Try to import the named component.
   Returns its module name if it was loaded or False on failure.
+
+  By default, tries the module names pox.<name> and <name>.
   """
   #TODO: Update to use the Python 3 import facilities
 
@@ -101,7 +108,177 @@ def _do_import (name):
       show_fail()
       return False
 
-  return do_import2(name, ["pox." + name, name])
+  if names_to_try is None:
+    names_to_try = ["pox." + name, name]
+  return do_import2(name, list(names_to_try))
+
+
+class _ImportPlanner (object):
+  """
+  Works out which module each component is, then imports them
+
+  Resolving a component to a module uses importlib.util.find_spec(), which
+  finds the module without running it (though it does import the packages
+  it is in), so a misspelled component is reported before anything is
+  imported.  Resolutions can be kept in a manifest file between runs; an
+  entry is reused as long as sys.path is the same and the module's file
+  has the same mtime.
+
+  Also keeps how long each component took to resolve and to import (the
+  latter includes importing whatever the module imports that wasn't
+  already loaded).
+  """
+  def __init__ (self, manifest_file=None):
+    self.manifest_file = manifest_file
+    self.manifest = {}
+    self.changed = False
+    self.times = {} # component -> [resolve seconds, import seconds]
+    self.known = {} # component -> module name, trusted without checking
+    self.resolved = {} # component -> module name, for all resolve()s
+    if manifest_file and os.path.exists(manifest_file):
+      try:
+        with open(manifest_file) as f:
+          saved = json.load(f)
+        if saved.get("path") == sys.path:
+          self.manifest = saved.get("components", {})
+      except Exception:
+        # A broken manifest is just an empty one
+        pass
+
+  def _cached (self, name):
+    entry = self.manifest.get(name)
+    if entry is None: return None
+    try:
+      if os.stat(entry["origin"]).st_mtime == entry["mtime"]:
+        return entry["module"]
+    except (OSError, KeyError, TypeError):
+      pass
+    del self.manifest[name]
+    self.changed = True
+    return None
+
+  def resolve (self, name):
+    """
+    Returns the name of the module for component name, or None
+    """
+    start = time.time()
+    module_name = self.known.get(name)
+    if module_name is None:
+      module_name = self._cached(name)
+    if module_name is None:
+      for candidate in ("pox." + name, name):
+        if candidate in sys.modules:
+          module_name = candidate
+          break
+        try:
+          spec = importlib.util.find_spec(candidate)
+        except (ImportError, ValueError):
+          # Some package it would be in doesn't exist
+          spec = None
+        if spec is None: continue
+        module_name = candidate
+        if spec.has_location and spec.origin:
+          self.manifest[name] = dict(module=candidate, origin=spec.origin,
+                                     mtime=os.stat(spec.origin).st_mtime)
+          self.changed = True
+        break
+    end = time.time()
+    if module_name is not None:
+      self.resolved[name] = module_name
+    self.times.setdefault(name, [0, 0])[0] += end - start
+    if _profile is not None:
+      _profile.add("resolve " + name, start, end, module=str(module_name))
+    return module_name
+
+  def load (self, name, module_name=None):
+    """
+    Imports component name (as module_name, if it was resolved)
+
+    Returns (module name, module, members) or False on failure.
+    """
+    start = time.time()
+    if module_name is None:
+      # Let _do_import() try the usual names and explain what went wrong
+      r = _do_import(name)
+    else:
+      r = _do_import(name, [module_name])
+    end = time.time()
+    self.times.setdefault(name, [0, 0])[1] += end - start
+    if _profile is not None:
+      _profile.add("import " + name, start, end)
+    if r is False and module_name is not None \
+        and self.known.get(name) == module_name:
+      # The module name came from a snapshot and may be stale, so forget
+      # it and resolve the component as usual
+      del self.known[name]
+      self.resolved.pop(name, None)
+      retry = self.resolve(name)
+      if retry is not None and retry != module_name:
+        return self.load(name, retry)
+    if r is False:
+      return False
+    return (r, sys.modules[r], dict(inspect.getmembers(sys.modules[r])))
+
+  def save (self):
+    if not self.manifest_file or not self.changed: return
+    tmp = self.manifest_file + ".tmp"
+    try:
+      with open(tmp, "w") as f:
+        json.dump(dict(path=sys.path, components=self.manifest), f)
+      os.replace(tmp, self.manifest_file)
+      self.changed = False
+    except Exception:
+      # It's only a cache
+      pass
+
+  def report (self):
+    """
+    Prints the time taken by each component, slowest import first
+    """
+    print("Component import times (ms):")
+    print(" {0:30} {1:>10} {2:>10}".format("Component", "Resolve", "Import"))
+    for name,(r,i) in sorted(self.times.items(), key=lambda x: -x[1][1]):
+      print(" {0:30} {1:10.1f} {2:10.1f}".format(name, r * 1000, i * 1000))
+
+
+class _LazyModules (dict):
+  """
+  _do_imports()'s result, importing each component only once it's used
+  """
+  def __init__ (self, planner, resolved):
+    super(_LazyModules, self).__init__()
+    self._planner = planner
+    self._resolved = resolved
+
+  def __missing__ (self, name):
+    r = self._planner.load(name, self._resolved[name])
+    self[name] = r
+    return r
+
+
+_import_planner = None
+
+# The StartupProfile, if --profile-startup was given
+_profile = None
+
+
+def _profile_span (name, **args):
+  """
+  A context manager timing a startup phase (if it's being profiled)
+  """
+  if _profile is None:
+    return _no_span
+  return _profile.span(name, **args)
+
+
+class _NoSpan (object):
+  def __enter__ (self):
+    pass
+
+  def __exit__ (self, *exc_info):
+    return False
+
+_no_span = _NoSpan()
 
 
 def _do_imports (components):
@@ -110,11 +287,40 @@ def _do_imports (components):
 
   Returns map of component_name->name,module,members on success,
   or False on failure
+
+  Every component is resolved to a module first.  With --lazy-imports,
+  each one is then imported only when the map is first asked for it (so
+  just before its launch function runs), and the map's value is False if
+  that fails.
   """
-  ...
+  global _import_planner
+  if _import_planner is None:
+    _import_planner = _ImportPlanner(_options.import_manifest)
+    if _snapshot is not None:
+      _import_planner.known.update(_snapshot["modules"])
+  planner = _import_planner
+
+  resolved = {}
+  for name in components:
+    if name not in resolved:
+      resolved[name] = planner.resolve(name)
+  planner.save()
+
+  if _options.lazy_imports and None not in resolved.values():
+    return _LazyModules(planner, resolved)
+
+  done = {}
+  for name,module_name in resolved.items():
+    r = planner.load(name, module_name)
+    if r is False:
+      return False
+    done[name] = r
+  return done
 
 
 def _do_launch (argv, skip_startup=False):
+  global _profile
+  started = time.time()
   component_order = []
   components = {}
 
@@ -140,18 +346,27 @@ def _do_launch (argv, skip_startup=False):
 
   if not skip_startup:
     _options.process_options(pox_options)
+    if _options.profile_startup and _profile is None:
+      _profile = StartupProfile()
+      _profile.add("parse commandline", started, time.time())
     global core
-    if pox.core.core is not None:
-      core = pox.core.core
-      core.getLogger('boot').debug('Using existing POX core')
-    else:
-      core = pox.core.initialize(_options.threaded_selecthub,
-                                 _options.epoll_selecthub,
-                                 _options.handle_signals)
-
-    _pre_startup()
-
-  modules = _do_imports(n.split("=")[0].split(':')[0] for n in component_order)
+    with _profile_span("initialize core"):
+      if pox.core.core is not None:
+        core = pox.core.core
+        core.getLogger('boot').debug('Using existing POX core')
+      else:
+        core = pox.core.initialize(_options.threaded_selecthub,
+                                   _options.epoll_selecthub,
+                                   _options.handle_signals)
+    if _profile is not None:
+      core._startup_profile = _profile
+
+    with _profile_span("_pre_startup"):
+      _pre_startup()
+
+  with _profile_span("_do_imports"):
+    modules = _do_imports(n.split("=")[0].split(':')[0]
+                          for n in component_order)
   if modules is False:
     return False
 
@@ -165,6 +380,9 @@ def _do_launch (argv, skip_startup=False):
     name = name[0]
     first_arg = params.pop(None, None)
 
+    if modules[name] is False:
+      # A lazy import failed
+      return False
     name,module,members = modules[name]
 
     if launch in members:
@@ -213,7 +431,9 @@ def _do_launch (argv, skip_startup=False):
           pparams = (first_arg,)
         else:
           pparams = ()
-        if f(*pparams, **params) is False:
+        with _profile_span("launch " + cname, instance=inst[cname]):
+          result = f(*pparams, **params)
+        if result is False:
           # Abort startup
           return False
       except TypeError as exc:
@@ -290,6 +510,9 @@ def _do_launch (argv, skip_startup=False):
             "arguments" % (name, launch))
       return False
 
+  if _options.import_times and _import_planner is not None:
+    _import_planner.report()
+
   return True
 
 
@@ -334,6 +557,21 @@ Notable POX options include:
   --no-openflow   Don't automatically load the OpenFlow module
   --log-config=F  Load a Python log configuration file (if you include the
                   option without specifying F, it defaults to logging.cfg)
+  --import-manifest=F
+                  Remember which module each component is in F between
+                  runs (defaults to .import_manifest.json)
+  --lazy-imports  Import each component just before launching it
+  --import-times  Print how long each component took to import
+  --shutdown-timeout=S
+                  How long to wait for threads to finish when exiting
+                  before giving up on them (default 2 seconds)
+  --snapshot=F    Save component state to F (default pox.snapshot) when
+                  going down, and restore it when starting again with the
+                  same components (or none, to rerun the saved ones)
+  --profile-startup=P
+                  Write a timeline of startup to P.json (Chrome trace
+                  format) and a summary to P.txt (P defaults to
+                  startup_profile)
 
 C1, C2, etc. are component names (e.g., Python modules).  Options they
 support are up to the module.  As an example, you can load a learning
@@ -355,6 +593,12 @@ class POXOptions (Options):
     self.threaded_selecthub = True
     self.epoll_selecthub = False
     self.handle_signals = True
+    self.import_manifest = None
+    self.lazy_imports = False
+    self.import_times = False
+    self.profile_startup = None
+    self.shutdown_timeout = 2.0
+    self.snapshot = None
 
   def _set_h (self, given_name, name, value):
     self._set_help(given_name, name, value)
@@ -390,6 +634,26 @@ class POXOptions (Options):
       value = os.path.join(p, "..", "logging.cfg")
     self.log_config = value
 
+  def _set_import_manifest (self, given_name, name, value):
+    if value is True:
+      p = os.path.dirname(os.path.realpath(__file__))
+      value = os.path.join(p, "..", ".import_manifest.json")
+    self.import_manifest = value
+
+  def _set_profile_startup (self, given_name, name, value):
+    if value is True:
+      value = "startup_profile"
+    self.profile_startup = value
+
+  def _set_snapshot (self, given_name, name, value):
+    # boot() has already acted on it; see _snapshot_file()
+    if value is True:
+      value = _DEFAULT_SNAPSHOT
+    self.snapshot = value
+
+  def _set_shutdown_timeout (self, given_name, name, value):
+    self.shutdown_timeout = float(value)
+
   def _set_debug (self, given_name, name, value):
     value = str_to_bool(value)
     if value:
@@ -450,6 +714,123 @@ def set_main_function (f):
   ...
 
 
+def _write_profile (started):
+  """
+  Writes out the startup profile (if there is one) and stops profiling
+  """
+  global _profile
+  if _profile is None: return
+  profile = _profile
+  _profile = None
+  core._startup_profile = None
+  profile.add("boot", started, time.time())
+  try:
+    files = profile.write(_options.profile_startup)
+  except Exception:
+    core.getLogger('boot').exception("Couldn't write startup profile")
+    return
+  core.getLogger('boot').info("Startup profile written to %s and %s",
+                              *files)
+
+
+_SNAPSHOT_MAGIC = b"POXSNAP\x01"
+_DEFAULT_SNAPSHOT = "pox.snapshot"
+
+# What was read from --snapshot's file, if anything
+_snapshot = None
+
+
+def _option_name (arg):
+  """
+  Returns the name of a commandline option like --foo-bar=baz ("foo_bar")
+  """
+  return arg.lstrip("-").split("=", 1)[0].replace("-", "_")
+
+
+def _snapshot_file (options):
+  """
+  Returns the filename given by --snapshot in options (not yet processed)
+  """
+  for arg in options:
+    if _option_name(arg) == "snapshot":
+      if "=" not in arg:
+        return _DEFAULT_SNAPSHOT
+      return arg.split("=", 1)[1]
+  return None
+
+
+def _merge_options (saved, given):
+  """
+  Returns the saved options with the given ones in place of any of the
+  same name
+  """
+  names = set(_option_name(arg) for arg in given)
+  return [arg for arg in saved if _option_name(arg) not in names] + given
+
+
+def _read_snapshot (filename):
+  """
+  Returns the contents of a snapshot file, or None if there isn't one
+  (or it can't be used)
+
+  Snapshots are pickles, so only use ones you would trust as code.
+  """
+  try:
+    with open(filename, "rb") as f:
+      data = f.read()
+  except OSError:
+    return None
+  if not data.startswith(_SNAPSHOT_MAGIC):
+    print("Not a POX snapshot:", filename)
+    return None
+  try:
+    snapshot = pickle.loads(zlib.decompress(data[len(_SNAPSHOT_MAGIC):]))
+  except Exception:
+    print("Couldn't read snapshot:", filename)
+    return None
+  if snapshot.get("python") != tuple(sys.version_info[:2]):
+    print("Ignoring snapshot from a different version of Python")
+    return None
+  return snapshot
+
+
+def _write_snapshot (filename, options, components, modules):
+  """
+  Writes the commandline, component modules and checkpointed state
+  """
+  snapshot = dict(options=list(options), components=list(components),
+                  modules=dict(modules), state=core.checkpoint(),
+                  python=tuple(sys.version_info[:2]), time=time.time())
+  data = zlib.compress(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+  tmp = filename + ".tmp"
+  with open(tmp, "wb") as f:
+    f.write(_SNAPSHOT_MAGIC + data)
+  os.replace(tmp, filename)
+  core.getLogger('boot').info("Wrote snapshot to %s (%s bytes)", filename,
+                              len(data) + len(_SNAPSHOT_MAGIC))
+
+
+def _new_threads (before):
+  """
+  Returns the non-daemon threads which aren't in before (or this one)
+  """
+  current = threading.current_thread()
+  return [t for t in threading.enumerate()
+          if t not in before and t is not current and not t.daemon]
+
+
+def _join_threads (threads, timeout):
+  """
+  Joins threads, giving up once timeout seconds have passed in all
+
+  Returns the ones which are still running.
+  """
+  deadline = time.time() + float(timeout)
+  for t in threads:
+    t.join(max(0, deadline - time.time()))
+  return [t for t in threads if t.is_alive()]
+
+
 def boot (argv = None):
   """
   Start up POX.
@@ -460,7 +841,8 @@ def boot (argv = None):
   sys.path.insert(0, os.path.abspath(os.path.join(base, 'pox')))
   sys.path.insert(0, os.path.abspath(os.path.join(base, 'ext')))
 
-  thread_count = threading.active_count()
+  started = time.time()
+  initial_threads = set(threading.enumerate())
 
   quiet = False
 
@@ -476,11 +858,35 @@ def boot (argv = None):
         pre.append(argv.pop(0))
       else:
         break
+
+    global _snapshot
+    snapshot_file = _snapshot_file(pre)
+    if snapshot_file is not None:
+      _snapshot = _read_snapshot(snapshot_file)
+    if _snapshot is not None:
+      if not argv:
+        # Run what was running (options given now win)
+        argv = list(_snapshot["components"])
+        pre = _merge_options(_snapshot["options"], pre)
+      elif argv != _snapshot["components"]:
+        print("Not restoring snapshot; it was for a different commandline")
+        _snapshot = None
+    components = list(argv)
     argv = pre + "py --disable".split() + argv
 
     if _do_launch(argv):
-      _post_startup()
-      core.goUp()
+      if _snapshot is not None:
+        with _profile_span("restore snapshot"):
+          core.restore_checkpoints(_snapshot["state"])
+      if snapshot_file is not None:
+        # Added last so that it runs before the other shutdown steps
+        core.add_shutdown_step("snapshot", lambda: _write_snapshot(
+            snapshot_file, pre, components, _import_planner.resolved))
+      with _profile_span("_post_startup"):
+        _post_startup()
+      with _profile_span("core.goUp()"):
+        core.goUp()
+      _write_profile(started)
     else:
       #return
       quiet = True
@@ -497,11 +903,9 @@ def boot (argv = None):
     # the going down event on core even though we never went up?
 
     try:
-      for _ in range(4):
-        if threading.active_count() <= thread_count:
-          # Normal exit
-          return
-        time.sleep(0.25)
+      if not _join_threads(_new_threads(initial_threads), 1):
+        # Normal exit
+        return
     except:
       pass
 
@@ -511,20 +915,31 @@ def boot (argv = None):
   if _main_thread_function:
     _main_thread_function()
   else:
-    #core.acquire()
+    # quit() clears core.running before it notifies quit_condition, so
+    # checking it with the lock held can't miss the wakeup.
     try:
-      while True:
-        if core.quit_condition.acquire(False):
-          core.quit_condition.wait(10)
-          core.quit_condition.release()
-        if not core.running: break
+      with core.quit_condition:
+        while core.running:
+          core.quit_condition.wait()
     except:
       pass
-    #core.scheduler._thread.join() # Sleazy
 
   try:
     pox.core.core.quit()
   except:
     pass
 
+  stuck = _join_threads(_new_threads(initial_threads),
+                        _options.shutdown_timeout)
+  if stuck:
+    # Waiting on these at interpreter exit could take forever
+    core.getLogger('boot').warning("Threads still running after %s "
+        "seconds: %s", _options.shutdown_timeout,
+        ", ".join(t.name for t in stuck))
+    logging.shutdown()
+    # os._exit() won't flush them for us
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(pox.core.core._exit_code)
+
   sys.exit(pox.core.core._exit_code)
@@ -23,6 +23,54 @@ This includes things like component rendezvous, logging, system status
 ...
 
 
+class _WaiterIndex (object):
+  """
+  The call_when_ready() entries still waiting, by component name
+
+  Each entry keeps a count of the components it is still missing, so that
+  registering a component only has to look at the entries that are
+  waiting for it rather than rechecking every entry's full list.
+  """
+  def __init__ (self):
+    self._by_component = {} # name -> [entry, ...]
+    # id(entry) -> [entry, missing count].  Holding the entry keeps its id
+    # from being reused while it's in here.
+    self._missing = {}
+
+  def __len__ (self):
+    return len(self._missing)
+
+  def add (self, entry, missing):
+    """
+    Indexes entry under each of the (distinct) component names in missing
+    """
+    self._missing[id(entry)] = [entry, len(missing)]
+    for name in missing:
+      self._by_component.setdefault(name, []).append(entry)
+
+  def satisfy (self, name):
+    """
+    Notes that the named component has been registered
+
+    Returns the entries which were waiting on nothing else.
+    """
+    ready = []
+    for entry in self._by_component.pop(name, ()):
+      state = self._missing.get(id(entry))
+      if state is None: continue
+      state[1] -= 1
+      if state[1] == 0:
+        del self._missing[id(entry)]
+        ready.append(entry)
+    return ready
+
+  def waiting_for (self):
+    """
+    Returns the names of the components that entries are waiting for
+    """
+    return list(self._by_component)
+
+
 class POXCore (EventMixin):
   """
   A nexus of of the POX API.
@@ -45,6 +93,17 @@ class POXCore (EventMixin):
   """
   ...
 
+  # A pox.startup_profile.StartupProfile while startup is being profiled
+  _startup_profile = None
+
+  # See add_shutdown_step()
+  _shutdown_steps = None
+  shutdown_report = None
+
+  # See add_checkpoint()
+  _checkpoints = None # name -> (save, restore)
+  _restored_state = None # name -> state from a snapshot not yet restored
+
   def call_later (_self, _func, *args, **kw):
     # first arg is `_self` rather than `self` in case the user wants
     # to specify self as a keyword argument
@@ -95,7 +154,44 @@ class POXCore (EventMixin):
       log.warn("Warning: Registered '%s' multipled times" % (name,))
     self.components[name] = component
     self.raiseEventNoErrors(ComponentRegistered, name, component)
-    self._try_waiters()
+    for entry in self._waiter_index.satisfy(name):
+      self._try_waiter(entry)
+
+  @property
+  def _waiters (self):
+    """
+    The call_when_ready() entries not yet called, oldest first
+
+    They're kept in _pending, by id, so that calling one doesn't mean
+    searching for it in a list; this is a copy.
+    """
+    return list(self._pending.values())
+
+  @_waiters.setter
+  def _waiters (self, entries):
+    self._pending_ = dict((id(entry), entry) for entry in entries)
+
+  @property
+  def _pending (self):
+    """
+    id(entry) -> entry for the entries in _waiters (made on first use)
+
+    Holding the entry keeps its id from being reused while it's in here.
+    """
+    pending = self.__dict__.get('_pending_')
+    if pending is None:
+      pending = self._pending_ = {}
+    return pending
+
+  @property
+  def _waiter_index (self):
+    """
+    The _WaiterIndex of the entries in _waiters (made on first use)
+    """
+    index = self.__dict__.get('_waiter_index_')
+    if index is None:
+      index = self._waiter_index_ = _WaiterIndex()
+    return index
 
   def call_when_ready (self, callback, components=[], name=None, args=(),
                        kw={}):
@@ -129,8 +225,15 @@ class POXCore (EventMixin):
         # exception printing in try_waiter().
         name += " in " + callback.__module__
     entry = (callback, name, components, args, kw)
-    self._waiters.append(entry)
-    self._try_waiter(entry)
+    self._pending[id(entry)] = entry
+    missing = set(c for c in components if not self.hasComponent(c))
+    if missing:
+      # register() will try it once the last of these shows up
+      self._waiter_index.add(entry, missing)
+      if self._startup_profile is not None:
+        self._startup_profile.waiter_added(entry)
+    else:
+      self._try_waiter(entry)
 
   def _try_waiter (self, entry):
     """
@@ -139,7 +242,129 @@ class POXCore (EventMixin):
     Calls the callback, removes from _waiters, and returns True if
     all are satisfied.
     """
-    ...
+    pending = self._pending
+    if id(entry) not in pending:
+      # Already handled
+      return False
+    callback, name, components, args_, kw_ = entry
+    for c in components:
+      if not self.hasComponent(c):
+        return False
+    del pending[id(entry)]
+    profile = self._startup_profile
+    if profile is not None:
+      profile.waiter_started(entry)
+    try:
+      callback(*args_, **kw_)
+    except:
+      msg = "Exception while trying to notify " + name
+      import inspect
+      try:
+        msg += " at " + inspect.getfile(callback)
+        msg += ":" + str(inspect.getsourcelines(callback)[1])
+      except:
+        pass
+      log.exception(msg)
+    if profile is not None:
+      profile.waiter_finished(entry)
+    return True
+
+  def add_shutdown_step (self, name, callback, deadline=None):
+    """
+    Has callback() called as POX goes down
+
+    Steps run when GoingDown is raised, one at a time, in the reverse of
+    the order they were added (so a component which added its step after
+    one it depends on is stopped first).  If deadline is given, the step
+    runs in its own thread, and if it hasn't finished after that many
+    seconds, it is logged and left behind so the rest can go on.
+
+    How long each step took ends up in shutdown_report, a list of
+    (name, seconds, finished) in the order they ran.
+    """
+    if self._shutdown_steps is None:
+      self._shutdown_steps = []
+      self.addListenerByName("GoingDownEvent", self._run_shutdown_steps)
+    self._shutdown_steps.append((name, callback, deadline))
+
+  def _run_shutdown_steps (self, event=None):
+    import threading
+    import time
+
+    def run (name, callback):
+      try:
+        callback()
+      except:
+        log.exception("While stopping %s", name)
+
+    report = []
+    for name,callback,deadline in reversed(self._shutdown_steps or []):
+      start = time.time()
+      if deadline is None:
+        run(name, callback)
+        finished = True
+      else:
+        t = threading.Thread(target=run, args=(name, callback),
+                             name="Stopping " + name)
+        t.daemon = True
+        t.start()
+        t.join(deadline)
+        finished = not t.is_alive()
+      elapsed = time.time() - start
+      report.append((name, elapsed, finished))
+      if finished:
+        log.debug("Stopped %s in %0.1f ms", name, elapsed * 1000)
+      else:
+        log.warning("%s didn't stop within %s seconds", name, deadline)
+    self.shutdown_report = report
+
+  def add_checkpoint (self, name, save, restore=None):
+    """
+    Opts a component in to having its state kept across restarts
+
+    If POX is run with --snapshot, save() is called as it goes down and
+    should return the component's state as something picklable (e.g., a
+    learned table).  When POX next starts from that snapshot, the state is
+    passed to restore() -- right away if it has already been loaded, or
+    otherwise as soon as it is (before core goes up).
+    """
+    if self._checkpoints is None:
+      self._checkpoints = {}
+    self._checkpoints[name] = (save, restore)
+    if self._restored_state and name in self._restored_state:
+      self._restore_checkpoint(name, self._restored_state.pop(name))
+
+  def checkpoint (self):
+    """
+    Returns {name: state} from every component which opted in
+    """
+    state = {}
+    for name,(save,restore) in (self._checkpoints or {}).items():
+      try:
+        state[name] = save()
+      except:
+        log.exception("While saving state of %s", name)
+    return state
+
+  def restore_checkpoints (self, state):
+    """
+    Hands saved state to the components it came from
+
+    State for components which haven't called add_checkpoint() yet is kept
+    until they do.
+    """
+    self._restored_state = dict(state)
+    for name in list(self._restored_state):
+      if name in (self._checkpoints or {}):
+        self._restore_checkpoint(name, self._restored_state.pop(name))
+
+  def _restore_checkpoint (self, name, state):
+    restore = self._checkpoints[name][1]
+    if restore is None: return
+    try:
+      restore(state)
+    except:
+      log.exception("While restoring state of %s", name)
 
   def listen_to_dependencies (self, sink, components=None, attrs=True,
                               short_attrs=False, listen_args={}):
@@ -0,0 +1,178 @@
+# Copyright 2011-2022 James McCauley
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at:
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Records where startup time goes (see the --profile-startup option)
+
+pox.boot records a span for each startup phase (parsing the commandline,
+importing each component, each launch function, _post_startup, goUp...),
+and core records how long each call_when_ready() callback was blocked
+waiting for its dependencies and how long it then took to run.  Spans
+nest by time, so a callback which runs when some launch function
+registers the last component it needed shows up inside that launch.
+
+The result can be written as Chrome trace JSON (load it in
+chrome://tracing or https://ui.perfetto.dev) and as a text summary sorted
+by time.
+"""
+
+from __future__ import print_function
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StartupProfile (object):
+  def __init__ (self):
+    self.spans = [] # (name, category, start, end, thread id, args)
+    self.blocked = [] # (name, start, end, components, still waiting)
+    self._thread_names = {}
+    self._waiting = {} # id(entry) -> (entry, time it started waiting)
+    self._running = {} # id(entry) -> time its callback started
+
+  def add (self, name, start, end, category="startup", **args):
+    """
+    Records a span which has already finished
+    """
+    t = threading.current_thread()
+    self._thread_names[t.ident] = t.name
+    self.spans.append((name, category, start, end, t.ident, args))
+
+  @contextmanager
+  def span (self, name, category="startup", **args):
+    """
+    Records the time taken by the body of a with statement
+    """
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.add(name, start, time.time(), category, **args)
+
+  def waiter_added (self, entry):
+    """
+    Called by core when a call_when_ready() entry has to wait
+    """
+    self._waiting[id(entry)] = (entry, time.time())
+
+  def waiter_started (self, entry):
+    """
+    Called by core just before calling an entry's callback
+    """
+    now = time.time()
+    waiting = self._waiting.pop(id(entry), None)
+    if waiting is not None:
+      self.blocked.append((entry[1], waiting[1], now, list(entry[2]), False))
+    self._running[id(entry)] = now
+
+  def waiter_finished (self, entry):
+    """
+    Called by core after an entry's callback returns (or raises)
+    """
+    start = self._running.pop(id(entry), None)
+    if start is not None:
+      self.add(entry[1], start, time.time(), "waiter")
+
+  def finish (self):
+    """
+    Closes the spans of entries which are still waiting
+    """
+    now = time.time()
+    for entry,start in self._waiting.values():
+      self.blocked.append((entry[1], start, now, list(entry[2]), True))
+    self._waiting.clear()
+
+  def chrome_trace (self):
+    """
+    Returns the profile as a Chrome trace (a JSON-able dict)
+    """
+    events = []
+    for ident,name in self._thread_names.items():
+      events.append(dict(name="thread_name", ph="M", pid=1, tid=ident,
+                         args=dict(name=name)))
+    for name,category,start,end,ident,args in self.spans:
+      events.append(dict(name=name, cat=category, ph="X", pid=1, tid=ident,
+                         ts=start * 1e6, dur=(end - start) * 1e6,
+                         args=args))
+    # Blocked time overlaps everything else, so it goes in async spans
+    for i,(name,start,end,components,still) in enumerate(self.blocked):
+      args = dict(waiting_on=components)
+      if still: args['still_waiting'] = True
+      common = dict(name=name, cat="blocked", id=i, pid=1, tid=0)
+      events.append(dict(common, ph="b", ts=start * 1e6, args=args))
+      events.append(dict(common, ph="e", ts=end * 1e6))
+    return dict(traceEvents=events, displayTimeUnit="ms")
+
+  def _self_times (self):
+    """
+    Returns {index into spans: time not spent in a nested span}
+    """
+    result = {}
+    by_thread = {}
+    for i,span in enumerate(self.spans):
+      by_thread.setdefault(span[4], []).append(i)
+    for indexes in by_thread.values():
+      # Outer spans before the spans they contain
+      indexes.sort(key=lambda i: (self.spans[i][2], -self.spans[i][3]))
+      stack = []
+      for i in indexes:
+        start,end = self.spans[i][2:4]
+        while stack and self.spans[stack[-1]][3] < end:
+          stack.pop()
+        result[i] = end - start
+        if stack:
+          result[stack[-1]] -= end - start
+        stack.append(i)
+    return result
+
+  def summary (self):
+    """
+    Returns a text summary, slowest first, as a list of lines
+    """
+    self_times = self._self_times()
+    lines = ["{0:>10} {1:>10}  {2}".format("Total ms", "Self ms", "Phase")]
+    order = sorted(range(len(self.spans)),
+                   key=lambda i: self.spans[i][2] - self.spans[i][3])
+    for i in order:
+      name,category,start,end = self.spans[i][:4]
+      if category != "startup": name = category + ": " + name
+      lines.append("{0:10.1f} {1:10.1f}  {2}".format((end - start) * 1000,
+                   self_times[i] * 1000, name))
+    if self.blocked:
+      lines.append("")
+      lines.append("{0:>10}  {1}".format("Blocked ms",
+                                         "Waiter (waiting on)"))
+      for name,start,end,components,still in sorted(self.blocked,
+          key=lambda b: b[1] - b[2]):
+        lines.append("{0:10.1f}  {1} ({2}){3}".format((end - start) * 1000,
+                     name, ", ".join(components),
+                     " -- still waiting" if still else ""))
+    return lines
+
+  def write (self, prefix):
+    """
+    Writes <prefix>.json (Chrome trace) and <prefix>.txt (summary)
+
+    Returns the two filenames.
+    """
+    self.finish()
+    trace_file = prefix + ".json"
+    summary_file = prefix + ".txt"
+    with open(trace_file, "w") as f:
+      json.dump(self.chrome_trace(), f)
+    with open(summary_file, "w") as f:
+      f.write("\n".join(self.summary()) + "\n")
+    return trace_file, summary_file